@@ -0,0 +1,196 @@
+# alignment.py
+# Alignment stage for the block-feature matcher. extract_features compares
+# 16x16 cells position by position, so a finger placed shifted or rotated on
+# the sensor lands in other cells and loses score. For every shortlisted
+# candidate the rotation and translation between probe and enrolled image are
+# estimated by FFT phase correlation of ridge maps, one pass each: the
+# rotation from the polar-resampled magnitude spectra, which do not depend on
+# translation, then the translation between the derotated probe and the
+# candidate. The probe is warped accordingly and its features are scored
+# again against that candidate's template. The aligned score replaces the
+# template score even when it is lower: a candidate the probe cannot be
+# aligned to is most likely another finger.
+
+import os
+import time
+import cv2
+import numpy as np
+from feature_extraction import extract_features, prepare_image, IMAGE_SIZE
+from utils import save_npz_atomic
+
+ALIGN_SIZE = 128  # Side of the ridge maps: the prepared image, halved
+RIDGE_SIGMA = 1.5  # Gaussian subtracted from the map, leaving the ridge pattern
+ANGLE_BINS = 360  # Polar spectrum rows per turn; the spectrum repeats every 180 degrees
+MIN_ROTATION = 1.0  # Degrees; smaller corrections are not worth re-extracting features
+MIN_SHIFT = 2.0  # Pixels of the prepared image; same
+SHORTLIST_K = 3  # Enrolled images aligned per probe (more lets impostors align by chance)
+
+_WINDOW = cv2.createHanningWindow((ALIGN_SIZE, ALIGN_SIZE), cv2.CV_32F)
+
+
+def alignment_maps(prepared):
+    """
+    (ridge map, polar spectrum) of a prepared image (feature_extraction.prepare_image):
+    the windowed high-pass ALIGN_SIZE map, and its centred magnitude spectrum
+    resampled to ANGLE_BINS / 2 angles (rows) by ALIGN_SIZE / 2 radii.
+    """
+    small = cv2.resize(prepared, (ALIGN_SIZE, ALIGN_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    ridge = (small - cv2.GaussianBlur(small, (0, 0), RIDGE_SIGMA)) * _WINDOW
+    spectrum = cv2.dft(ridge, flags=cv2.DFT_COMPLEX_OUTPUT)
+    magnitude = np.fft.fftshift(cv2.magnitude(spectrum[..., 0], spectrum[..., 1]))
+    center = (ALIGN_SIZE / 2, ALIGN_SIZE / 2)
+    polar = cv2.warpPolar(magnitude, (ALIGN_SIZE // 2, ANGLE_BINS), center, ALIGN_SIZE / 2, cv2.WARP_POLAR_LINEAR)
+    polar = polar[:ANGLE_BINS // 2]  # Half a turn is one full period of the spectrum
+    # Phase correlation ignores the scale; unit peaks keep the float16 copies in range
+    return ridge / max(float(np.abs(ridge).max()), 1e-6), polar / max(float(polar.max()), 1e-6)
+
+
+def estimate_alignment(probe_maps, gallery_maps):
+    """
+    Rotation (degrees, in [-90, 90)) and translation (pixels of the prepared
+    image) that map the probe onto the enrolled image, and the translation
+    phase-correlation peak (near 0 when the estimate is unreliable).
+    """
+    probe_ridge, probe_polar = probe_maps
+    gallery_ridge, gallery_polar = gallery_maps
+    (_, rows), _ = cv2.phaseCorrelate(np.float32(gallery_polar), probe_polar)
+    angle = (-rows * 360.0 / ANGLE_BINS + 90.0) % 180.0 - 90.0
+    center = (ALIGN_SIZE / 2, ALIGN_SIZE / 2)
+    derotated = cv2.warpAffine(probe_ridge, cv2.getRotationMatrix2D(center, -angle, 1.0), (ALIGN_SIZE, ALIGN_SIZE))
+    (dx, dy), response = cv2.phaseCorrelate(np.float32(gallery_ridge), derotated)
+    scale = IMAGE_SIZE / ALIGN_SIZE
+    return angle, -dx * scale, -dy * scale, response
+
+
+def align_image(prepared, angle, dx, dy):
+    """Rotate a prepared image by -angle about its centre, then shift it by (dx, dy)."""
+    matrix = cv2.getRotationMatrix2D((IMAGE_SIZE / 2, IMAGE_SIZE / 2), -angle, 1.0)
+    matrix[:, 2] += (dx, dy)
+    return cv2.warpAffine(prepared, matrix, (IMAGE_SIZE, IMAGE_SIZE), borderMode=cv2.BORDER_REPLICATE)
+
+
+class AlignmentGallery:
+    """
+    Alignment maps of every enrolled image, stored as float16. Map i belongs
+    to gallery row i.
+    """
+
+    def __init__(self, ridges, polars, hashes):
+        self.ridges = ridges
+        self.polars = polars
+        self.hashes = np.asarray(hashes, dtype=str)
+
+    @classmethod
+    def from_gallery(cls, gallery, cache_path, verbose=True):
+        """
+        Maps for every image of a gallery dict (gallery.py). Images whose
+        content hash is already in cache_path are not recomputed; the cache
+        is rewritten when anything changed.
+        """
+        cached = {}
+        if os.path.exists(cache_path):
+            with np.load(cache_path, allow_pickle=False) as data:
+                # Each data[...] access reads the whole array again, so read them once
+                cached_ridges, cached_polars = data['ridges'], data['polars']
+                if cached_ridges.shape[1:] == (ALIGN_SIZE, ALIGN_SIZE):
+                    for i, digest in enumerate(data['hashes']):
+                        cached[str(digest)] = (cached_ridges[i], cached_polars[i])
+        n = len(gallery['hashes'])
+        ridges = np.zeros((n, ALIGN_SIZE, ALIGN_SIZE), dtype=np.float16)
+        polars = np.zeros((n, ANGLE_BINS // 2, ALIGN_SIZE // 2), dtype=np.float16)
+        computed = 0
+        for i, (path, digest) in enumerate(zip(gallery['paths'], gallery['hashes'])):
+            maps = cached.get(str(digest))
+            if maps is None:
+                image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+                if image is None:
+                    if verbose:
+                        print(f"Failed to read {path}; enrolled without alignment maps")
+                    continue
+                maps = alignment_maps(prepare_image(image))
+                computed += 1
+            ridges[i], polars[i] = maps
+        self = cls(ridges, polars, gallery['hashes'])
+        # Duplicate images share one cache entry, so compare with the distinct hashes
+        if computed or len(cached) != len(set(self.hashes)):
+            save_npz_atomic(cache_path, ridges=ridges, polars=polars, hashes=self.hashes)
+        if verbose:
+            print(f"Alignment maps: {n} images ({computed} computed, {n - computed} cached)")
+        return self
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def maps(self, i):
+        return np.float32(self.ridges[i]), np.float32(self.polars[i])
+
+
+class AlignedIdentifier:
+    """
+    Template matching with alignment of the shortlist: the shortlist_k best
+    templates (GalleryIndex.top_templates) are scored again after aligning
+    the probe to each of them. Candidates needing less than min_rotation
+    and min_shift keep their template score. gallery is a GalleryIndex and
+    maps an AlignmentGallery of the same gallery dict.
+    """
+
+    def __init__(self, gallery, maps, shortlist_k=SHORTLIST_K, min_rotation=MIN_ROTATION, min_shift=MIN_SHIFT):
+        if len(gallery) != len(maps):
+            raise ValueError("Template gallery and alignment maps do not have the same images")
+        self.gallery = gallery
+        self.maps = maps
+        self.shortlist_k = shortlist_k
+        self.min_rotation = min_rotation
+        self.min_shift = min_shift
+        self.persons = gallery.persons
+        self.version = f"aligned:{gallery.version}"
+        self.last_timings = {}
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def candidates(self, probe_image):
+        """
+        Returns (rows, template_scores, aligned_scores, alignments) for the
+        shortlisted images, alignments being (angle, dx, dy, response) rows;
+        per-stage milliseconds are left in self.last_timings.
+        """
+        t0 = time.perf_counter()
+        prepared = prepare_image(probe_image)
+        features = extract_features(prepared, prepared=True)
+        t1 = time.perf_counter()
+        template_scores, rows = self.gallery.top_templates(features, self.shortlist_k)
+        t2 = time.perf_counter()
+        probe_maps = alignment_maps(prepared)
+        alignments = np.array([estimate_alignment(probe_maps, self.maps.maps(row)) for row in rows],
+                              dtype=np.float32).reshape(len(rows), 4)
+        t3 = time.perf_counter()
+        aligned_scores = np.array(template_scores, dtype=np.float32)
+        # Re-extract only where the correction is large enough to move the cells
+        moved = (np.abs(alignments[:, 0]) >= self.min_rotation) | (np.hypot(alignments[:, 1], alignments[:, 2])
+                                                                    >= self.min_shift)
+        if moved.any():
+            aligned = np.array([extract_features(align_image(prepared, *alignments[j, :3]), prepared=True)
+                                for j in np.flatnonzero(moved)])
+            aligned_scores[moved] = self.gallery.pair_scores(rows[moved], aligned)
+        t4 = time.perf_counter()
+        self.last_timings = {'features': (t1 - t0) * 1000, 'shortlist': (t2 - t1) * 1000,
+                             'align': (t3 - t2) * 1000, 'rescore': (t4 - t3) * 1000, 'total': (t4 - t0) * 1000}
+        return rows, template_scores, aligned_scores, alignments
+
+    def identify(self, probe_image, k=2):
+        """
+        Rank a grayscale probe image by aligned template score (best image
+        per person); returns (ranked, margin) like GalleryIndex.identify.
+        Persons without a shortlisted image are not ranked.
+        """
+        rows, _, aligned_scores, _ = self.candidates(probe_image)
+        per_person = {}
+        for row, score in zip(rows, aligned_scores):
+            person = str(self.persons[self.gallery.label_ids[row]])
+            per_person[person] = max(per_person.get(person, -1.0), float(score))
+        ranked = sorted(per_person.items(), key=lambda item: -item[1])
+        if not ranked:
+            return [], 0.0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        return ranked[:k], ranked[0][1] - runner_up
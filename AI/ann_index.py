@@ -0,0 +1,177 @@
+# ann_index.py
+# Nearest-neighbor indexes over L2-normalized template vectors (cosine score =
+# dot product). BruteForceIndex is the exact baseline; IVFIndex is an
+# approximate inverted-file index with a spherical k-means coarse quantizer.
+
+import numpy as np
+from utils import save_npz_atomic
+
+
+class BruteForceIndex:
+    """Exact search: scores the query against every vector."""
+
+    kind = 'exact'
+
+    def __init__(self):
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+
+    @property
+    def built(self):
+        return len(self.vectors) > 0
+
+    def build(self, vectors):
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        return self
+
+    def attach(self, vectors):
+        """Score against vectors (same rows as the built ones) from now on."""
+        self.vectors = vectors
+        return self
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, query, k=10):
+        """Return (scores, rows) of the k best vectors, best first."""
+        scores = self.vectors @ np.asarray(query, dtype=np.float32)
+        return _top_k(scores, np.arange(len(scores)), k)
+
+    def state(self):
+        return {'vectors': self.vectors}
+
+    def load_state(self, state):
+        self.vectors = state['vectors']
+        return self
+
+
+class IVFIndex:
+    """
+    Inverted-file index. Vectors are clustered into nlist cells by spherical
+    k-means and their row ids are stored cell by cell; a query only scores
+    the rows of the nprobe cells whose centroids are closest to it. Raising
+    nprobe trades speed for recall (nprobe == nlist is exact).
+    The index keeps no copy of the vectors: it scores rows of the matrix
+    given to build() or attach(), which may be a memmap or a
+    quantize.QuantizedTemplates, so the gallery's storage is shared.
+    """
+
+    kind = 'ivf'
+
+    def __init__(self, nlist=64, nprobe=8, n_iter=20, train_size=256, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.n_iter = n_iter
+        self.train_size = train_size  # Training points per cell
+        self.seed = seed
+        self.centroids = None
+        self.vectors = None  # Scored rows; not part of the saved state
+        self.rows = None     # Row ids grouped by cell
+        self.offsets = None  # Cell c holds rows[offsets[c]:offsets[c + 1]]
+        self.version = ''    # Caller's tag of the vectors the index was built from
+
+    @property
+    def built(self):
+        return self.centroids is not None
+
+    def build(self, vectors):
+        """Cluster float32 vectors and score against them until attach()."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        nlist = max(1, min(self.nlist, len(vectors)))
+        self.centroids = _spherical_kmeans(vectors, nlist, self.n_iter, self.train_size * nlist, self.seed)
+        assignment = _assign(vectors, self.centroids)
+        order = np.argsort(assignment, kind='stable')
+        self.vectors = vectors
+        self.rows = order
+        self.offsets = np.searchsorted(assignment[order], np.arange(nlist + 1))
+        return self
+
+    def attach(self, vectors):
+        """Score against vectors (same rows as the built ones, any storage) from now on."""
+        self.vectors = vectors
+        return self
+
+    def __len__(self):
+        return 0 if self.rows is None else len(self.rows)
+
+    def search(self, query, k=10, nprobe=None):
+        """Return (scores, rows) of the k best vectors found in the probed cells, best first."""
+        query = np.asarray(query, dtype=np.float32)
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        centroid_scores = self.centroids @ query
+        cells = np.argpartition(-centroid_scores, nprobe - 1)[:nprobe]
+        rows = np.concatenate([self.rows[self.offsets[c]:self.offsets[c + 1]] for c in cells])
+        if len(rows) == 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        # Gather only the probed rows, dequantized if the storage is quantized
+        block = self.vectors[rows] if isinstance(self.vectors, np.ndarray) else self.vectors.take(rows)
+        return _top_k(block @ query, rows, k)
+
+    def state(self):
+        return {'centroids': self.centroids, 'rows': self.rows, 'offsets': self.offsets,
+                'params': np.array([self.nlist, self.nprobe])}
+
+    def load_state(self, state):
+        self.centroids = state['centroids']
+        self.rows = state['rows']
+        self.offsets = state['offsets']
+        self.nlist, self.nprobe = (int(v) for v in state['params'])
+        return self
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (BruteForceIndex, IVFIndex)}
+
+
+def save_index(index, path, version=''):
+    """
+    Save an index to an .npz file (no pickling), tagged with version.
+    An IVFIndex is saved without vectors: attach() them after loading.
+    """
+    save_npz_atomic(path, kind=np.array(index.kind), version=np.array(version), **index.state())
+
+
+def load_index(path):
+    """Load an index written by save_index; its tag is in index.version."""
+    with np.load(path, allow_pickle=False) as data:
+        state = {key: data[key] for key in data.files}
+    version = str(state.pop('version', ''))
+    index = INDEX_TYPES[str(state.pop('kind'))]().load_state(state)
+    index.version = version
+    return index
+
+
+def _top_k(scores, rows, k):
+    k = min(k, len(scores))
+    if k == 0:
+        return scores[:0], rows[:0]
+    top = np.argpartition(-scores, k - 1)[:k]
+    top = top[np.argsort(-scores[top], kind='stable')]
+    return scores[top], rows[top]
+
+
+def _assign(vectors, centroids, chunk=8192):
+    """Index of the best-scoring centroid for every vector."""
+    out = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), chunk):
+        out[i:i + chunk] = np.argmax(vectors[i:i + chunk] @ centroids.T, axis=1)
+    return out
+
+
+def _spherical_kmeans(vectors, k, n_iter, max_train, seed):
+    rng = np.random.default_rng(seed)
+    train = vectors
+    if len(vectors) > max_train:
+        train = vectors[rng.choice(len(vectors), max_train, replace=False)]
+    centroids = train[rng.choice(len(train), k, replace=False)].copy()
+    for _ in range(n_iter):
+        assignment = _assign(train, centroids)
+        sums = np.zeros_like(centroids)
+        order = np.argsort(assignment, kind='stable')
+        cells = assignment[order]
+        starts = np.flatnonzero(np.r_[True, cells[1:] != cells[:-1]])
+        sums[cells[starts]] = np.add.reduceat(train[order], starts, axis=0)
+        empty = np.bincount(assignment, minlength=k) == 0
+        # Re-seed empty cells with random training points
+        sums[empty] = train[rng.choice(len(train), int(empty.sum()))]
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = sums / np.maximum(norms, 1e-12)
+    return centroids.astype(np.float32)
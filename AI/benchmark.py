@@ -0,0 +1,866 @@
+# benchmark.py
+# Latency and throughput benchmarks for the matcher components.
+# Usage: python benchmark.py <name> [options]   (python benchmark.py -h for the list)
+
+import os
+import glob
+import time
+import queue
+import shutil
+import argparse
+import tempfile
+import threading
+import numpy as np
+
+
+def percentiles(samples_ms):
+    """Format p50/p95/max of a list of millisecond samples."""
+    if not samples_ms:
+        return "no samples"
+    a = np.asarray(samples_ms)
+    return f"p50 {np.percentile(a, 50):.2f} ms, p95 {np.percentile(a, 95):.2f} ms, max {a.max():.2f} ms"
+
+
+def bench_watcher(args):
+    """
+    Drop captures into a temp scans/ folder with the temp-then-rename handshake
+    and measure how long each takes to come out of the ScanWatcher queue.
+    """
+    from scan_watcher import ScanWatcher, atomic_write
+
+    sources = sorted(glob.glob(os.path.join('scans', '*.bmp')))[:args.count] or [None]
+    payloads = []
+    for path in sources:
+        if path is None:
+            payloads.append(os.urandom(256 * 288))
+        else:
+            with open(path, 'rb') as f:
+                payloads.append(f.read())
+
+    modes = ['inotify', 'polling'] if args.mode == 'both' else [args.mode]
+    for mode in modes:
+        tmp = tempfile.mkdtemp()
+        try:
+            watcher = ScanWatcher(os.path.join(tmp, 'scans'), prefix='fingerprint_',
+                                  use_inotify=(mode == 'inotify')).start()
+            if watcher.mode != mode:
+                print(f"{mode}: not available on this platform")
+                watcher.stop()
+                continue
+            written = {}
+
+            def writer():
+                for i in range(args.count):
+                    data = payloads[i % len(payloads)]
+                    path = os.path.join(watcher.scans_dir, f"fingerprint_{i:06d}.bmp")
+
+                    def write(temp_path, data=data):
+                        with open(temp_path, 'wb') as f:
+                            f.write(data)
+                    written[path] = time.perf_counter()
+                    atomic_write(path, write)
+                    if args.interval:
+                        time.sleep(args.interval)
+
+            t = threading.Thread(target=writer)
+            t.start()
+            latencies = []
+            seen = set()
+            duplicates = 0
+            t.join()
+            while True:
+                try:
+                    path, detected_at = watcher.get(timeout=args.timeout)
+                except queue.Empty:
+                    break
+                if path in seen:
+                    duplicates += 1
+                    continue
+                seen.add(path)
+                latencies.append((detected_at - written[path]) * 1000)
+            watcher.stop()
+            missed = args.count - len(seen)
+            print(f"{mode}: {len(seen)}/{args.count} captures queued, {missed} missed, {duplicates} duplicates; "
+                  f"detection latency {percentiles(latencies)}")
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def _stub_api(received, delay, state):
+    """
+    Start a local stand-in for the results API that records every result it
+    gets. While state['down'] is set it answers 503 and drops the connection.
+    """
+    import json
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            if state['down']:
+                self.close_connection = True
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if delay:
+                time.sleep(delay)
+            received.extend(body if isinstance(body, list) else [body])
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _wait_for(condition, timeout):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def bench_publisher(args):
+    """
+    Publish results to a local stub API: measure enqueue cost and delivery
+    time, then take the stub down, publish through the outage and check that
+    everything spilled to the outbox is delivered once it comes back.
+    """
+    from publisher import ResultPublisher, image_fields
+
+    bmp_paths = sorted(glob.glob(os.path.join('scans', 'fingerprint_*.bmp')))[:1]
+    bmp = open(bmp_paths[0], 'rb').read() if bmp_paths else os.urandom(256 * 288)
+    fields = image_fields(args.image_mode, bmp_bytes=bmp, scan_id='bench')
+    received = []
+    state = {'down': False}
+    server = _stub_api(received, args.delay, state)
+    port = server.server_address[1]
+    tmp = tempfile.mkdtemp()
+    publisher = ResultPublisher(f"http://127.0.0.1:{port}/fingerprint", batch_size=args.batch,
+                                timeout=1, outbox_dir=os.path.join(tmp, 'outbox'), retry_interval=0.2).start()
+    try:
+        def publish(n, offset):
+            enqueue = []
+            for i in range(n):
+                t0 = time.perf_counter()
+                publisher.publish({"name": "bench", **fields, "score": 0.9, "matched": True, "latency": 0.0, "seq": offset + i})
+                enqueue.append((time.perf_counter() - t0) * 1000)
+            return enqueue
+
+        t0 = time.perf_counter()
+        enqueue = publish(args.count, 0)
+        delivered = _wait_for(lambda: len(received) >= args.count, 30)
+        print(f"online: {len(received)}/{args.count} delivered in {time.perf_counter() - t0:.2f} s "
+              f"(batch {args.batch}, image '{args.image_mode}', {len(fields.get('fingerprint_img') or '')} chars); "
+              f"enqueue {percentiles(enqueue)}")
+        if not delivered:
+            return
+
+        state['down'] = True
+        enqueue = publish(args.count, args.count)
+        _wait_for(lambda: publisher.pending_outbox() > 0 and publisher.queue.empty(), 30)
+        print(f"outage: spilled {publisher.stats['spilled']} results to {publisher.pending_outbox()} outbox files; "
+              f"enqueue {percentiles(enqueue)}")
+        state['down'] = False
+        t0 = time.perf_counter()
+        _wait_for(lambda: len(received) >= 2 * args.count, 60)
+        seqs = [r["seq"] for r in received]
+        print(f"recovered: {len(received)}/{2 * args.count} delivered {time.perf_counter() - t0:.2f} s after the API came back, "
+              f"{len(seqs) - len(set(seqs))} duplicates, in order: {seqs == sorted(seqs)}")
+    finally:
+        publisher.stop(timeout=10)
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def synthetic_gallery(n_templates, impressions=4, dim=1536, queries=200, seed=0):
+    """
+    Synthetic L2-normalized templates: a shared mean direction (real templates
+    all score ~0.85 against each other) plus a per-person direction, with
+    per-impression noise. Returns (templates, labels, query_vectors, query_labels).
+    """
+    rng = np.random.default_rng(seed)
+    n_persons = max(1, n_templates // impressions)
+    common = np.abs(rng.standard_normal(dim)).astype(np.float32)
+    common /= np.linalg.norm(common)
+    centers = rng.standard_normal((n_persons, dim)).astype(np.float32)
+    centers /= np.linalg.norm(centers, axis=1, keepdims=True)
+    centers = 2.0 * common + centers
+
+    def impressions_of(persons):
+        v = centers[persons] + 0.6 * rng.standard_normal((len(persons), dim)).astype(np.float32) / np.sqrt(dim)
+        return (v / np.linalg.norm(v, axis=1, keepdims=True)).astype(np.float32)
+
+    labels = np.arange(n_templates) % n_persons
+    query_labels = rng.integers(0, n_persons, queries)
+    return impressions_of(labels), labels.astype(str), impressions_of(query_labels), query_labels.astype(str)
+
+
+def bench_ann(args):
+    """
+    Recall@1 (against exact search) and queries/second of the ann_index
+    indexes as the gallery grows synthetically.
+    """
+    from ann_index import BruteForceIndex, IVFIndex, save_index, load_index
+
+    for n in args.sizes:
+        templates, labels, queries, query_labels = synthetic_gallery(n, queries=args.queries)
+        exact = BruteForceIndex().build(templates)
+        t0 = time.perf_counter()
+        truth = [exact.search(q, 1)[1][0] for q in queries]
+        exact_qps = len(queries) / (time.perf_counter() - t0)
+        person_acc = np.mean(labels[truth] == query_labels)
+        print(f"n={n}: exact {exact_qps:.0f} q/s (rank-1 person accuracy {person_acc:.3f})")
+
+        nlist = args.nlist or max(1, int(np.sqrt(n)))
+        t0 = time.perf_counter()
+        ivf = IVFIndex(nlist=nlist).build(templates)
+        build_s = time.perf_counter() - t0
+        path = os.path.join(tempfile.mkdtemp(), 'ivf.npz')
+        save_index(ivf, path)
+        ivf = load_index(path).attach(templates)
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        for nprobe in args.nprobe:
+            if nprobe > nlist:
+                continue
+            t0 = time.perf_counter()
+            found = [ivf.search(q, 1, nprobe=nprobe)[1] for q in queries]
+            qps = len(queries) / (time.perf_counter() - t0)
+            recall = np.mean([len(f) and f[0] == t for f, t in zip(found, truth)])
+            print(f"  ivf nlist={nlist} nprobe={nprobe}: recall@1 {recall:.3f}, {qps:.0f} q/s "
+                  f"({qps / exact_qps:.1f}x exact), build {build_s:.1f} s")
+
+
+def load_labelled(root):
+    """Extract features for every <root>/<person>/*.bmp; returns (features, labels)."""
+    from gallery import list_enrollment_images
+    from feature_extraction import extract_features_batch
+
+    entries = list_enrollment_images(root)
+    features, failures = extract_features_batch([p for _, p in entries], workers=1)
+    keep = [i for i in range(len(entries)) if i not in failures]
+    return features[keep], np.array([entries[i][0] for i in keep])
+
+
+def bench_quant(args):
+    """
+    Accuracy of float16/int8 template storage against float32 (dataset/ as
+    gallery, distorted_dataset/ as probes), then memory and scoring speed on a
+    synthetic gallery.
+    """
+    from gallery import GalleryIndex
+    from quantize import TEMPLATE_DTYPES
+
+    gallery_features, gallery_labels = load_labelled(args.gallery)
+    probes, probe_labels = load_labelled(args.probes)
+    reference = None
+    for dtype in TEMPLATE_DTYPES:
+        index = GalleryIndex(gallery_features, gallery_labels, template_dtype=dtype)
+        scores = np.array([index.person_scores(p) for p in probes])
+        genuine = scores[np.arange(len(probes)), np.searchsorted(index.persons, probe_labels)]
+        impostor = np.where(index.persons[None, :] == probe_labels[:, None], -np.inf, scores).max(axis=1)
+        rank1 = index.persons[scores.argmax(axis=1)]
+        if reference is None:
+            reference = (scores, rank1)
+        print(f"{dtype:>8}: max |score - float32| {np.abs(scores - reference[0]).max():.2e}, "
+              f"rank-1 agreement {np.mean(rank1 == reference[1]):.3f}, rank-1 accuracy {np.mean(rank1 == probe_labels):.3f}, "
+              f"mean genuine-impostor gap {np.mean(genuine - impostor):+.4f}")
+
+    templates, labels, queries, _ = synthetic_gallery(args.size, queries=50)
+    for dtype in TEMPLATE_DTYPES:
+        index = GalleryIndex(templates, labels, template_dtype=dtype)
+        index.identify(queries[0])
+        t0 = time.perf_counter()
+        for q in queries:
+            index.identify(q)
+        ms = (time.perf_counter() - t0) / len(queries) * 1000
+        t0 = time.perf_counter()
+        index.templates @ queries.T
+        batch_ms = (time.perf_counter() - t0) / len(queries) * 1000
+        nbytes = index.templates.nbytes
+        print(f"{dtype:>8}: {args.size} templates in {nbytes / 2**20:.1f} MiB "
+              f"({2**30 / (nbytes / args.size):,.0f} templates/GiB), identify {ms:.2f} ms/probe, "
+              f"batched scoring {batch_ms:.2f} ms/probe")
+
+
+def bench_profiles(args):
+    """
+    Per-image latency of each preprocessing profile (preprocess.py) and the
+    genuine/impostor separation it gives: dataset/ enhanced as the gallery,
+    distorted_dataset/ enhanced as probes, scored with the template matcher.
+    'none' is the raw images, for reference.
+    """
+    import cv2
+    from enhance import enhance_image
+    from gallery import GalleryIndex, list_enrollment_images
+    from pipeline import PROFILES
+    from preprocess import preprocess_image
+    from feature_extraction import extract_features_batch
+
+    sets = {}
+    for role, root in (('gallery', args.gallery), ('probes', args.probes)):
+        entries = list_enrollment_images(root)
+        sets[role] = ([p for _, p in entries], np.array([person for person, _ in entries]),
+                      [cv2.imread(p, cv2.IMREAD_GRAYSCALE) for _, p in entries])
+    all_paths = sets['gallery'][0] + sets['probes'][0]
+
+    for profile in ('none',) + PROFILES:
+        line = f"{profile:>9}:"
+        enhanced = {}
+        if profile == 'none':
+            enhanced = {role: images for role, (_, _, images) in sets.items()}
+        else:
+            enhance_ms = []
+            for role, (_, _, images) in sets.items():
+                enhanced[role] = []
+                for image in images:
+                    t0 = time.perf_counter()
+                    enhanced[role].append(enhance_image(image, profile))
+                    enhance_ms.append((time.perf_counter() - t0) * 1000)
+            preprocess_ms = []
+            for path in all_paths[:args.count]:
+                t0 = time.perf_counter()
+                preprocess_image(path, profile)
+                preprocess_ms.append((time.perf_counter() - t0) * 1000)
+            line += f" enhance_image {percentiles(enhance_ms)}; preprocess_image {percentiles(preprocess_ms)};"
+
+        gallery_features, _ = extract_features_batch(enhanced['gallery'], workers=1)
+        probe_features, _ = extract_features_batch(enhanced['probes'], workers=1)
+        labels, probe_labels = sets['gallery'][1], sets['probes'][1]
+        # Every probe against every gallery template
+        pair_scores = probe_features @ gallery_features.T
+        same = probe_labels[:, None] == labels[None, :]
+        genuine, impostor = pair_scores[same], pair_scores[~same]
+        d_prime = (genuine.mean() - impostor.mean()) / np.sqrt((genuine.var() + impostor.var()) / 2)
+        index = GalleryIndex(gallery_features, labels)
+        rank1 = np.mean([index.rank(f, 1)[0][0] == label for f, label in zip(probe_features, probe_labels)])
+        print(f"{line} genuine {genuine.mean():.4f}, impostor {impostor.mean():.4f}, "
+              f"d' {d_prime:.2f}, rank-1 {rank1:.3f}")
+
+
+def bench_distort(args):
+    """
+    Augmentation throughput (images/s, one process) of distort_dataset:
+    elastic_transform alone and the full strong_distort chain, for the
+    original float64 path and the fast and field-bank modes.
+    """
+    import cv2
+    import distort_dataset as dd
+
+    images = [cv2.imread(p, cv2.IMREAD_GRAYSCALE) for p in sorted(glob.glob(os.path.join('dataset', '*', '*.bmp')))]
+    t0 = time.perf_counter()
+    bank = dd.FieldBank(images[0].shape, args.bank_size)
+    print(f"field bank: {args.bank_size} fields built in {time.perf_counter() - t0:.2f} s")
+    modes = {'exact': {}, 'fast': {'fast': True}, 'bank': {'bank': bank}}
+    elastic = {'exact': lambda img, rng: dd.elastic_transform(img, 15, 7, rng),
+               'fast': lambda img, rng: dd.elastic_transform_fast(img, 15, 7, rng),
+               'bank': lambda img, rng: dd.elastic_transform_fast(img, 15, 7, rng, bank)}
+    baseline = {}
+    for stage in ('elastic', 'strong_distort'):
+        for mode, options in modes.items():
+            rng = np.random.default_rng(0)
+            t0 = time.perf_counter()
+            for i in range(args.count):
+                img = images[i % len(images)]
+                if stage == 'elastic':
+                    elastic[mode](img, rng)
+                else:
+                    dd.strong_distort(img, rng, **options)
+            rate = args.count / (time.perf_counter() - t0)
+            baseline.setdefault(stage, rate)
+            print(f"{stage:>14} {mode:>5}: {rate:7.0f} images/s ({rate / baseline[stage]:.1f}x exact)")
+
+
+def bench_cascade(args):
+    """
+    Cascade identification (cascade.py) of distorted_dataset/ probes against
+    dataset/: per-stage latency, how often the template shortlist missed the
+    true person, and rank-1 against template-only matching. With --fit, the
+    fusion weights are refitted on the shortlisted pairs first.
+    """
+    import cv2
+    from gallery import build_gallery, list_enrollment_images, GalleryIndex
+    from keypoint_gallery import KeypointGallery
+    from cascade import CascadeIdentifier, fit_fusion, fuse_scores, FUSION_WEIGHTS
+    from feature_extraction import extract_features
+
+    tmp = tempfile.mkdtemp()
+    try:
+        enrolled = build_gallery(args.gallery, os.path.join(tmp, 'gallery.tpl'), verbose=False)
+        keypoints = KeypointGallery.from_gallery(enrolled, os.path.join(tmp, 'keypoints.npz'), args.method,
+                                                 verbose=False)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    gallery = GalleryIndex.from_gallery(enrolled)
+    cascade = CascadeIdentifier(gallery, keypoints, shortlist_k=args.k, score_floor=args.floor)
+    probes = [(person, cv2.imread(path, cv2.IMREAD_GRAYSCALE)) for person, path in list_enrollment_images(args.probes)]
+
+    timings = {}
+    results = []
+    for person, image in probes:
+        rows, template_scores, keypoint_scores, _ = cascade.candidates(image)
+        for stage, ms in cascade.last_timings.items():
+            timings.setdefault(stage, []).append(ms)
+        candidates = gallery.persons[gallery.label_ids[rows]]
+        results.append((person, candidates, template_scores, keypoint_scores))
+
+    weights = FUSION_WEIGHTS
+    if args.fit:
+        pairs = [(t, k, c == person) for person, cands, ts, ks in results for c, t, k in zip(cands, ts, ks)]
+        t, k, genuine = (np.array(v) for v in zip(*pairs))
+        weights = fit_fusion(t, k, genuine)
+        print(f"fitted FUSION_WEIGHTS = ({weights[0]:.2f}, {weights[1]:.2f}, {weights[2]:.2f}) "
+              f"on {int(genuine.sum())} genuine / {int((~genuine).sum())} impostor pairs")
+
+    template_rank1 = np.mean([gallery.rank(extract_features(image), 1)[0][0] == person for person, image in probes])
+    missed = cascade_rank1 = 0
+    for person, candidates, template_scores, keypoint_scores in results:
+        if person not in candidates:
+            missed += 1
+            continue
+        fused = fuse_scores(template_scores, keypoint_scores, weights)
+        cascade_rank1 += candidates[int(np.argmax(fused))] == person
+    print(f"{args.method} verification, shortlist k={args.k}, floor {args.floor}: "
+          f"shortlist missed the true person for {missed}/{len(probes)} probes")
+    print(f"rank-1: cascade {cascade_rank1 / len(probes):.3f}, template only {template_rank1:.3f}")
+    for stage, samples in timings.items():
+        print(f"  {stage:>9}: {percentiles(samples)}")
+
+
+def bench_service(args):
+    """
+    Throughput of match_service.MatchService with `clients` concurrent
+    submitters, with batching (--batch-size) and without (batch size 1), for
+    each worker count. Probes are the distorted_dataset/ images as BMP bytes,
+    repeated, so the result cache is disabled.
+    """
+    import asyncio
+    import match_scan
+    from match_service import MatchService
+
+    payloads = []
+    for path in sorted(glob.glob(os.path.join(args.probes, '*', '*.bmp'))):
+        with open(path, 'rb') as f:
+            payloads.append(f.read())
+    match_scan.MATCH_MODE = args.mode
+
+    async def run(workers, batch_size):
+        service = await MatchService(workers=workers, batch_size=batch_size, cache_size=0).start()
+        latencies = []
+
+        async def client(i):
+            for j in range(i, args.count, args.clients):
+                result = await service.identify(payloads[j % len(payloads)])
+                latencies.append(result['latency'] * 1000)
+
+        try:
+            t0 = time.perf_counter()
+            await asyncio.gather(*(client(i) for i in range(args.clients)))
+            elapsed = time.perf_counter() - t0
+        finally:
+            await service.close()
+        batch = service.metrics.snapshot()['stages']['batch_size']
+        print(f"{args.mode}, {workers} workers, batch size {batch_size:>3}: {args.count / elapsed:7.1f} probes/s, "
+              f"mean batch {args.count / batch['count']:.1f}, latency {percentiles(latencies)}")
+
+    for workers in args.workers:
+        for batch_size in (1, args.batch_size):
+            asyncio.run(run(workers, batch_size))
+
+
+# Run in a fresh interpreter by bench_startup; prints one JSON line of stage times
+_FIRST_MATCH_SCRIPT = """
+import time, json, sys
+t0 = time.perf_counter()
+import cv2
+import match_scan
+t1 = time.perf_counter()
+match_scan.MATCH_MODE = sys.argv[1]
+gallery = match_scan.load_gallery_index(enroll=False)
+t2 = time.perf_counter()
+if sys.argv[2] == 'warm':
+    match_scan.warm_up(gallery)
+t3 = time.perf_counter()
+probe = cv2.imread(sys.argv[3], cv2.IMREAD_GRAYSCALE)
+t4 = time.perf_counter()
+match_scan.identify_probe(probe, gallery)
+t5 = time.perf_counter()
+match_scan.identify_probe(probe, gallery)
+t6 = time.perf_counter()
+print(json.dumps({'import': t1 - t0, 'load': t2 - t1, 'warm_up': t3 - t2,
+                  'first_match': t5 - t4, 'second_match': t6 - t5, 'ready': t3 - t0}))
+"""
+
+
+def bench_startup(args):
+    """
+    Import time of the entry-point modules, each in a fresh interpreter, and
+    time-to-first-match of match_scan with and without warm_up(): the gallery
+    is memory-mapped, then one probe is identified twice.
+    """
+    import json
+    import subprocess
+    import sys
+    import match_scan
+
+    for module in args.modules:
+        code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+        samples = []
+        for _ in range(args.repeat):
+            out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True)
+            if out.returncode != 0:
+                samples = None
+                break
+            samples.append(float(out.stdout.strip().splitlines()[-1]) * 1000)
+        print(f"import {module:>18}: " + ('failed' if samples is None else f"{min(samples):7.1f} ms (best of {args.repeat})"))
+
+    probe = sorted(glob.glob(os.path.join(args.probes, '*', '*.bmp')))[0]
+    for mode in args.modes:
+        # Enroll (and cache keypoints) up front so only loading is timed
+        match_scan.MATCH_MODE = mode
+        match_scan.load_gallery_index()
+        for warm in ('cold', 'warm'):
+            out = subprocess.run([sys.executable, '-c', _FIRST_MATCH_SCRIPT, mode, warm, probe],
+                                 capture_output=True, text=True)
+            t = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{mode:>8} {warm}: import {t['import'] * 1000:.0f} ms, gallery {t['load'] * 1000:.0f} ms, "
+                  f"warm-up {t['warm_up'] * 1000:.0f} ms, ready after {t['ready'] * 1000:.0f} ms; "
+                  f"first match {t['first_match'] * 1000:.1f} ms, second {t['second_match'] * 1000:.1f} ms")
+
+
+# Synthetic unusable captures made from real ones, for bench_quality
+def _blank(image):
+    return (235 + np.random.default_rng(0).integers(0, 6, image.shape)).astype(np.uint8)
+
+
+def _partial(image):
+    out = np.full_like(image, 235)
+    out[-image.shape[0] // 6:] = image[-image.shape[0] // 6:]
+    return out
+
+
+def _smudged(image):
+    import cv2
+    return cv2.GaussianBlur(image, (0, 0), 4)
+
+
+def _faint(image):
+    return (235 - (235 - image.astype(np.float32)) * 0.12).clip(0, 255).astype(np.uint8)
+
+
+def _noise(image):
+    return np.random.default_rng(1).integers(150, 256, image.shape).astype(np.uint8)
+
+
+DEGRADATIONS = {'blank': _blank, 'partial': _partial, 'smudged': _smudged, 'faint': _faint, 'noise': _noise}
+
+
+def bench_quality(args):
+    """
+    quality.assess_quality cost and what the gate rejects: real captures
+    (scans/ unlabelled, distorted_dataset/ labelled), and synthetic blank,
+    partial, smudged, faint and noise captures made from scans/. For every
+    rejected capture the template matcher's decision (against dataset/)
+    shows what the gate changed; the match time it skips is the saving.
+    """
+    import cv2
+    import match_scan
+    from metrics import Metrics
+    from quality import assess_quality
+    from gallery import build_gallery, list_enrollment_images, GalleryIndex
+
+    tmp = tempfile.mkdtemp()
+    try:
+        gallery = GalleryIndex.from_gallery(build_gallery(args.gallery, os.path.join(tmp, 'gallery.tpl'),
+                                                          verbose=False))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    scans = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in sorted(glob.glob(os.path.join(args.scans, '*.bmp')))]
+    sets = [('scans', [(None, image) for image in scans]),
+            ('distorted', [(person, cv2.imread(path, cv2.IMREAD_GRAYSCALE))
+                           for person, path in list_enrollment_images(args.probes)])]
+    sets += [(name, [(None, degrade(image)) for image in scans]) for name, degrade in DEGRADATIONS.items()]
+
+    quality_ms, match_ms = [], []
+    for name, probes in sets:
+        rejected = matched = correct_rejected = 0
+        for person, image in probes:
+            t0 = time.perf_counter()
+            quality = assess_quality(image)
+            t1 = time.perf_counter()
+            best_person = match_scan.identify_probe(image, gallery, Metrics())[0]
+            t2 = time.perf_counter()
+            quality_ms.append((t1 - t0) * 1000)
+            match_ms.append((t2 - t1) * 1000)
+            if not quality.ok:
+                rejected += 1
+                matched += best_person != "Unknown"
+                correct_rejected += person is not None and best_person == person
+        line = f"{name:>10}: rejected {rejected:>2}/{len(probes)}"
+        if rejected:
+            line += f", {matched} of them would have been matched"
+            if probes[0][0] is not None:
+                line += f" ({correct_rejected} correctly)"
+        print(line)
+    quality_p50, match_p50 = np.percentile(quality_ms, 50), np.percentile(match_ms, 50)
+    print(f"assess_quality: {percentiles(quality_ms)}")
+    print(f"template match: {percentiles(match_ms)}")
+    print(f"each rejected capture saves {match_p50 - quality_p50:.2f} ms of matching plus the API call; "
+          f"the gate adds {quality_p50:.2f} ms to accepted ones")
+
+
+def bench_cache(args):
+    """
+    Result cache (result_cache.py) on repeat presentations: every scans/
+    capture is presented --repeats times, alternately byte-identical and
+    re-read with sensor noise, in template mode against dataset/. Reports
+    the hit rate, hit and miss latency, and how many cached decisions differ
+    from matching the probe afresh (also how often a fresh match of a noisy
+    re-read changes its own decision). Then near-duplicate hits between the
+    different images of scans/, dataset/ and distorted_dataset/, split into
+    same person and different persons (the latter should be none).
+    """
+    import cv2
+    import match_scan
+    from metrics import Metrics
+    from result_cache import ResultCache, CACHE_COUNTERS
+    from gallery import build_gallery, GalleryIndex
+
+    tmp = tempfile.mkdtemp()
+    try:
+        gallery = GalleryIndex.from_gallery(build_gallery(args.gallery, os.path.join(tmp, 'gallery.tpl'),
+                                                          verbose=False))
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    metrics = Metrics(counters=CACHE_COUNTERS)
+    cache = ResultCache(metrics=metrics)
+    rng = np.random.default_rng(0)
+    scans = [cv2.imread(path, cv2.IMREAD_GRAYSCALE) for path in sorted(glob.glob(os.path.join(args.scans, '*.bmp')))]
+
+    hit_ms, miss_ms = [], []
+    changed = {'exact': 0, 'noisy': 0}
+    unstable = 0
+    for image in scans:
+        first = None
+        for r in range(args.repeats):
+            probe, kind = image, 'exact'
+            if r % 2 == 0 and r:
+                probe, kind = (image + rng.normal(0, 3, image.shape)).clip(0, 255).astype(np.uint8), 'noisy'
+            t0 = time.perf_counter()
+            decision, key = cache.lookup(probe, gallery.version)
+            first = first or decision
+            if decision is None:
+                decision = first = match_scan.identify_probe(probe, gallery, Metrics())
+                cache.store(key, decision)
+                miss_ms.append((time.perf_counter() - t0) * 1000)
+                continue
+            hit_ms.append((time.perf_counter() - t0) * 1000)
+            fresh = match_scan.identify_probe(probe, gallery, Metrics())
+            changed[kind] += decision[0] != fresh[0]
+            unstable += kind == 'noisy' and fresh[0] != first[0]
+    counters = metrics.snapshot()['counters']
+    print(f"{len(scans)} captures x {args.repeats}: {counters['cache_hits']} exact hits, "
+          f"{counters['cache_near_hits']} near-duplicate hits, {counters['cache_misses']} misses")
+    print(f"cached decision differs from a fresh match: {changed['exact']} exact repeats, "
+          f"{changed['noisy']} noisy re-reads (a fresh match of the noisy re-read itself changed "
+          f"the original decision {unstable} times)")
+    print(f"  hit: {percentiles(hit_ms)}")
+    print(f" miss: {percentiles(miss_ms)} (lookup, match and store)")
+
+    distinct = ResultCache(capacity=1024)
+    images = {}
+    for pattern in (os.path.join(args.scans, '*.bmp'), os.path.join(args.gallery, '*', '*.bmp'),
+                    os.path.join(args.probes, '*', '*.bmp')):
+        for path in sorted(glob.glob(pattern)):
+            # Persons of the labelled sets; every unlabelled scan is its own
+            person = path if pattern.startswith(args.scans) else os.path.basename(os.path.dirname(path))
+            image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            images.setdefault(image.tobytes(), (person, image))  # Byte-identical files count once
+    same = different = 0
+    for person, image in images.values():
+        cached, key = distinct.lookup(image)
+        if cached is not None:
+            same += cached == person
+            different += cached != person
+        distinct.store(key, person)
+    print(f"{len(images)} distinct images: near-duplicate hits between images of the same person {same}, "
+          f"of different persons {different}")
+
+
+def bench_align(args):
+    """
+    Alignment stage (alignment.py). First the estimator alone: dataset/
+    images rotated and shifted by random known amounts, aligned back to the
+    original (rotation error, template score before and after). Then
+    distorted_dataset/ probes against dataset/ for each shortlist size:
+    rank-1 and decisions at TEMPLATE_MATCH_THRESHOLD with and without
+    alignment, mean score change of genuine and impostor shortlist pairs,
+    and the per-probe cost of the stage.
+    """
+    import cv2
+    import match_scan
+    from alignment import alignment_maps, estimate_alignment, align_image, AlignmentGallery, AlignedIdentifier
+    from feature_extraction import extract_features, prepare_image, IMAGE_SIZE
+    from gallery import build_gallery, list_enrollment_images, GalleryIndex
+
+    tmp = tempfile.mkdtemp()
+    try:
+        enrolled = build_gallery(args.gallery, os.path.join(tmp, 'gallery.tpl'), verbose=False)
+        maps = AlignmentGallery.from_gallery(enrolled, os.path.join(tmp, 'gallery.align.npz'), verbose=False)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    gallery = GalleryIndex.from_gallery(enrolled)
+
+    rng = np.random.default_rng(0)
+    angle_errors, before, after = [], [], []
+    for row, (_, path) in enumerate(list_enrollment_images(args.gallery)):
+        prepared = prepare_image(cv2.imread(path, cv2.IMREAD_GRAYSCALE))
+        angle = rng.uniform(-args.max_angle, args.max_angle)
+        matrix = cv2.getRotationMatrix2D((IMAGE_SIZE / 2, IMAGE_SIZE / 2), angle, 1.0)
+        matrix[:, 2] += rng.uniform(-args.max_shift, args.max_shift, 2)
+        moved = cv2.warpAffine(prepared, matrix, (IMAGE_SIZE, IMAGE_SIZE), borderMode=cv2.BORDER_REPLICATE)
+        estimate = estimate_alignment(alignment_maps(moved), maps.maps(row))
+        angle_errors.append(abs(estimate[0] - angle))
+        template = gallery.templates[row]
+        before.append(float(extract_features(moved, prepared=True) @ template))
+        after.append(float(extract_features(align_image(moved, *estimate[:3]), prepared=True) @ template))
+    print(f"known transforms (up to {args.max_angle} deg, {args.max_shift} px) of {len(before)} images: rotation error "
+          f"median {np.median(angle_errors):.2f} deg, max {max(angle_errors):.2f} deg; template score "
+          f"{np.mean(before):.3f} -> {np.mean(after):.3f} after alignment (1.0 = perfect)")
+
+    probes = [(person, cv2.imread(path, cv2.IMREAD_GRAYSCALE)) for person, path in list_enrollment_images(args.probes)]
+    threshold = match_scan.TEMPLATE_MATCH_THRESHOLD
+    for k in args.k:
+        identifier = AlignedIdentifier(gallery, maps, shortlist_k=k)
+        rank1 = {'template': 0, 'aligned': 0}
+        accepted = {'template': [0, 0], 'aligned': [0, 0]}  # Correct, wrong
+        change = {True: [], False: []}
+        timings = {}
+        realigned = candidates = 0
+        for person, image in probes:
+            rows, template_scores, aligned_scores, _ = identifier.candidates(image)
+            for stage, ms in identifier.last_timings.items():
+                timings.setdefault(stage, []).append(ms)
+            labels = gallery.persons[gallery.label_ids[rows]]
+            for name, scores in (('template', template_scores), ('aligned', aligned_scores)):
+                best = int(np.argmax(scores))
+                rank1[name] += labels[best] == person
+                if scores[best] >= threshold:
+                    accepted[name][labels[best] != person] += 1
+            for label, t, a in zip(labels, template_scores, aligned_scores):
+                change[label == person].append(a - t)
+            realigned += int(np.sum(aligned_scores != template_scores))
+            candidates += len(rows)
+        print(f"shortlist k={k}: rank-1 template {rank1['template'] / len(probes):.3f}, aligned "
+              f"{rank1['aligned'] / len(probes):.3f}; accepted at {threshold} correct/wrong: template "
+              f"{accepted['template'][0]}/{accepted['template'][1]}, aligned {accepted['aligned'][0]}/"
+              f"{accepted['aligned'][1]}")
+        print(f"  mean score change: genuine pairs {np.mean(change[True]):+.4f}, impostor pairs "
+              f"{np.mean(change[False]):+.4f}; {realigned}/{candidates} candidates rescored")
+        for stage in ('features', 'shortlist', 'align', 'rescore', 'total'):
+            print(f"  {stage:>9}: {percentiles(timings[stage])}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest='name', required=True)
+
+    p = sub.add_parser('watcher', help='scan detection latency of scan_watcher.ScanWatcher')
+    p.add_argument('--count', type=int, default=200)
+    p.add_argument('--interval', type=float, default=0.002, help='seconds between captures (0 = burst)')
+    p.add_argument('--mode', choices=['inotify', 'polling', 'both'], default='both')
+    p.add_argument('--timeout', type=float, default=2.0, help='seconds to wait for a late capture before counting it missed')
+    p.set_defaults(func=bench_watcher)
+
+    p = sub.add_parser('publisher', help='publisher.ResultPublisher against a local stub API, with an outage')
+    p.add_argument('--count', type=int, default=200)
+    p.add_argument('--batch', type=int, default=1)
+    p.add_argument('--delay', type=float, default=0.0, help='seconds the stub API takes per request')
+    p.add_argument('--image-mode', choices=['full', 'thumbnail', 'id'], default='full')
+    p.set_defaults(func=bench_publisher)
+
+    p = sub.add_parser('ann', help='recall@1 and q/s of ann_index on synthetic galleries')
+    p.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 20000])
+    p.add_argument('--queries', type=int, default=200)
+    p.add_argument('--nlist', type=int, help='IVF cells (default: sqrt(n))')
+    p.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16])
+    p.set_defaults(func=bench_ann)
+
+    p = sub.add_parser('quant', help='accuracy, memory and speed of quantized template storage')
+    p.add_argument('--gallery', default='dataset')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--size', type=int, default=20000, help='synthetic gallery size for the speed test')
+    p.set_defaults(func=bench_quant)
+
+    p = sub.add_parser('profiles', help='latency and genuine/impostor separation of the preprocessing profiles')
+    p.add_argument('--gallery', default='dataset')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--count', type=int, default=20, help='images timed through preprocess_image')
+    p.set_defaults(func=bench_profiles)
+
+    p = sub.add_parser('distort', help='augmentation throughput of distort_dataset modes')
+    p.add_argument('--count', type=int, default=500, help='images per measurement')
+    p.add_argument('--bank-size', type=int, default=256)
+    p.set_defaults(func=bench_distort)
+
+    p = sub.add_parser('cascade', help='per-stage latency and shortlist misses of the cascade identifier')
+    p.add_argument('--gallery', default='dataset')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--method', choices=['orb', 'sift'], default='orb')
+    p.add_argument('--k', type=int, default=5, help='shortlist size')
+    p.add_argument('--floor', type=float, default=0.60, help='template score floor')
+    p.add_argument('--fit', action='store_true', help='refit the fusion weights on these pairs')
+    p.set_defaults(func=bench_cascade)
+
+    p = sub.add_parser('service', help='throughput of the batched matching service per worker count')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--mode', choices=['template', 'orb', 'sift', 'cascade'], default='template')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, os.cpu_count() or 1])
+    p.add_argument('--clients', type=int, default=8, help='concurrent submitters')
+    p.add_argument('--count', type=int, default=500, help='probes submitted')
+    p.add_argument('--batch-size', type=int, default=32)
+    p.set_defaults(func=bench_service)
+
+    p = sub.add_parser('startup', help='import time and time-to-first-match, with and without warm-up')
+    p.add_argument('--modules', nargs='+', default=['match_scan', 'match_service', 'publisher', 'preprocess',
+                                                    'scanbmp', 'evaluate'])
+    p.add_argument('--modes', nargs='+', choices=['template', 'orb', 'sift', 'cascade'], default=['template', 'cascade'])
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_startup)
+
+    p = sub.add_parser('quality', help='cost of the capture quality gate and what it rejects')
+    p.add_argument('--gallery', default='dataset')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--scans', default='scans')
+    p.set_defaults(func=bench_quality)
+
+    p = sub.add_parser('cache', help='hit rate, latency and safety of the result cache on repeat presentations')
+    p.add_argument('--gallery', default='dataset')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--scans', default='scans')
+    p.add_argument('--repeats', type=int, default=3)
+    p.set_defaults(func=bench_cache)
+
+    p = sub.add_parser('align', help='accuracy and cost of aligning the template shortlist')
+    p.add_argument('--gallery', default='dataset')
+    p.add_argument('--probes', default='distorted_dataset')
+    p.add_argument('--k', type=int, nargs='+', default=[3, 5, 10])
+    p.add_argument('--max-angle', type=float, default=20.0)
+    p.add_argument('--max-shift', type=float, default=16.0)
+    p.set_defaults(func=bench_align)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
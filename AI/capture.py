@@ -0,0 +1,293 @@
+# capture.py
+# In-process capture-to-match pipeline: the capture loop hands raw sensor
+# buffers straight to the matcher through a queue, and BMP archiving runs on a
+# background thread off the critical path.
+
+import os
+import glob
+import time
+import queue
+import threading
+from abc import ABC, abstractmethod
+import cv2
+import numpy as np
+from scan_watcher import atomic_write
+
+IMAGE_X, IMAGE_Y = 256, 288  # Sensor frame size (same as scanbmp.py)
+REOPEN_BACKOFF = (0.5, 10.0)  # seconds, first and maximum delay before reopening a failed device
+SCANS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scans')
+
+
+def frame_to_image(frame):
+    """Wrap a raw sensor buffer as an IMAGE_Y x IMAGE_X uint8 image without copying."""
+    return np.frombuffer(frame, dtype=np.uint8).reshape(IMAGE_Y, IMAGE_X)
+
+
+class CaptureSource(ABC):
+    """
+    Interface for a fingerprint sensor. Subclasses implement capture(); open()
+    and close() may be called again after a device error to reconnect.
+    """
+
+    def open(self):
+        return self
+
+    @abstractmethod
+    def capture(self):
+        """
+        Block until a finger is presented and return the raw IMAGE_Y x IMAGE_X
+        pixels as a bytes-like object that stays valid after the next capture.
+        Raises TimeoutError when no finger shows up, RuntimeError on device errors.
+        """
+
+    def request_recapture(self, reasons):
+        """Ask for the finger again after a capture failed the quality gate."""
+        print(f"Capture rejected ({', '.join(reasons)}). Place finger on the sensor again …")
+
+    def save_bmp(self, frame, path):
+        """Write a frame as a BMP file."""
+        if not cv2.imwrite(path, frame_to_image(frame)):
+            raise RuntimeError(f"Failed to write {path}")
+
+    def close(self):
+        pass
+
+
+class DllSensor(CaptureSource):
+    """The real sensor, through the vendor DLL wrapped by scanbmp.py (Windows only)."""
+
+    def __init__(self, timeout_s=None):
+        self.timeout_s = timeout_s
+        self.handle = None
+        self._scanbmp = None
+
+    def open(self):
+        import scanbmp  # The vendor DLL itself loads on the first device call
+        self._scanbmp = scanbmp
+        self.handle, mode = scanbmp.open_device_resilient()
+        print(f"Opened in {mode} mode. Place finger on the sensor …")
+        return self
+
+    def capture(self):
+        timeout_s = self.timeout_s or self._scanbmp.TIMEOUT_SECONDS
+        return self._scanbmp.wait_for_finger_and_capture(
+            self.handle, self._scanbmp.DEFAULT_ADDR, timeout_s, copy=False)
+
+    def save_bmp(self, frame, path):
+        self._scanbmp.save_bmp_via_dll(bytes(frame), path)
+
+    def close(self):
+        if self._scanbmp is not None:
+            self._scanbmp.close_device(self.handle)
+        self.handle = None
+
+
+class ReplaySensor(CaptureSource):
+    """
+    Fake sensor replaying BMP captures (e.g. from scans/) as raw frames, so the
+    pipeline can run and be benchmarked without the DLL.
+    """
+
+    def __init__(self, folder=SCANS_DIR, interval=0.0, loop=True, limit=None):
+        self.paths = sorted(glob.glob(os.path.join(folder, 'fingerprint_*.bmp')))[:limit]
+        if not self.paths:
+            raise FileNotFoundError(f"No captures to replay in {folder}")
+        self.interval = interval
+        self.loop = loop
+        self.frames = []
+        self._next = 0
+
+    def open(self):
+        # Decode up front so capture() costs what a sensor upload costs: nothing here
+        for path in self.paths:
+            img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+            if img is not None and img.shape == (IMAGE_Y, IMAGE_X):
+                self.frames.append(img.tobytes())
+        return self
+
+    def capture(self):
+        if self._next >= len(self.frames):
+            if not self.loop:
+                raise EOFError("Replay finished")
+            self._next = 0
+        if self.interval:
+            time.sleep(self.interval)
+        frame = self.frames[self._next]
+        self._next += 1
+        return frame
+
+
+class Archiver:
+    """Writes captured frames to scans/ as BMP files on a background thread."""
+
+    def __init__(self, source, scans_dir=SCANS_DIR, max_pending=64):
+        self.source = source
+        self.scans_dir = scans_dir
+        self.queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        os.makedirs(self.scans_dir, exist_ok=True)
+        self._thread.start()
+        return self
+
+    def submit(self, frame, name):
+        try:
+            self.queue.put_nowait((frame, name))
+        except queue.Full:
+            print(f"Archive queue full, not archiving {name}")
+
+    def stop(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            frame, name = item
+            path = os.path.join(self.scans_dir, name)
+            try:
+                atomic_write(path, lambda temp_path: self.source.save_bmp(frame, temp_path))
+            except Exception as e:
+                print(f"Failed to archive {path}: {e}")
+
+
+def run_pipeline(source, on_frame, archive=True, scans_dir=SCANS_DIR, max_frames=None, max_pending=4):
+    """
+    Capture frames on a background thread and call on_frame(image, frame_id,
+    captured_at) on the calling thread for each one, in order. image is a
+    zero-copy view of the raw buffer. When on_frame rejects a capture by
+    returning a quality.QualityResult with ok False, the frame is not
+    archived and source.request_recapture(reasons) is called. Stops after
+    max_frames, when the source runs out, or on Ctrl+C.
+    """
+    frames = queue.Queue(maxsize=max_pending)
+    stop = threading.Event()
+    archiver = Archiver(source, scans_dir).start() if archive else None
+
+    def reopen(delay):
+        """Close and reopen the source after a device error, backing off between tries."""
+        while not stop.is_set():
+            source.close()
+            stop.wait(delay)
+            delay = min(delay * 2, REOPEN_BACKOFF[1])
+            try:
+                source.open()
+                return
+            except Exception as e:
+                print(f"Reopening capture device failed: {e}")
+
+    def capture_loop():
+        count = 0
+        try:
+            while not stop.is_set() and (max_frames is None or count < max_frames):
+                try:
+                    frame = source.capture()
+                except TimeoutError as e:
+                    print(f"Error during capture: {e}")
+                    continue
+                except RuntimeError as e:
+                    print(f"Error during capture: {e}. Reopening device …")
+                    reopen(REOPEN_BACKOFF[0])
+                    continue
+                frame_id = f"fingerprint_{os.urandom(16).hex()}"
+                frames.put((frame, frame_id, time.perf_counter()))
+                count += 1
+        except EOFError:
+            pass
+        finally:
+            frames.put(None)
+
+    source.open()
+    thread = threading.Thread(target=capture_loop, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            frame, frame_id, captured_at = item
+            rejected = on_frame(frame_to_image(frame), frame_id, captured_at)
+            if rejected is not None and not rejected.ok:
+                source.request_recapture(rejected.reasons)
+                continue
+            if archiver is not None:
+                archiver.submit(frame, frame_id + '.bmp')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        if archiver is not None:
+            archiver.stop()
+        source.close()
+
+
+def main():
+    import argparse
+    import match_scan
+    from metrics import MetricsReporter
+    from publisher import ResultPublisher, image_fields
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--replay', metavar='DIR', help='replay BMP captures from DIR instead of the sensor')
+    parser.add_argument('--count', type=int, help='stop after this many captures')
+    parser.add_argument('--dry-run', action='store_true', help='match and log only, do not send results to the API')
+    parser.add_argument('--publish', action='store_true', help='send results to the API even in --replay mode')
+    args = parser.parse_args()
+    # Replayed captures are never sent to the API unless explicitly asked for
+    publish = not args.dry_run and (args.publish or not args.replay)
+
+    gallery = match_scan.load_gallery_index()
+    source = ReplaySensor(args.replay, loop=False) if args.replay else DllSensor()
+    metrics = match_scan.METRICS
+    latencies = []
+
+    def on_frame(image, frame_id, captured_at):
+        # Same counters and stages as match_scan.process_scan; 'detect' is
+        # the time the frame waited in the capture queue
+        metrics.increment('scans')
+        metrics.observe('detect', (time.perf_counter() - captured_at) * 1000)
+        with metrics.stage('cache'):
+            decision, key = match_scan.RESULT_CACHE.lookup(image, gallery.version)
+        if decision is None:
+            rejected = match_scan.quality_gate(image, metrics)
+            if rejected is not None:
+                return rejected
+            decision = match_scan.identify_probe(image, gallery, metrics)
+            match_scan.RESULT_CACHE.store(key, decision)
+        best_person, best_score, sorted_scores, margin = decision
+        metrics.increment('unknowns' if best_person == "Unknown" else 'matches')
+        latency = time.perf_counter() - captured_at
+        latencies.append(latency)
+        metrics.observe('total', latency * 1000)
+        if not publish:
+            print(f"{frame_id}: {best_person} ({best_score:.2%}, margin {margin:.2%}) in {latency * 1000:.2f} ms")
+            return
+        print(f"{frame_id}: matching completed in {latency:.4f} seconds.")
+        with metrics.stage('publish'):
+            fields = image_fields(match_scan.IMAGE_MODE, image=image, scan_id=frame_id)
+            match_scan.report_result(best_person, best_score, sorted_scores, margin, latency, fields, publisher)
+
+    publisher = ResultPublisher().start() if publish else None
+    reporter = MetricsReporter(metrics, match_scan.METRICS_PATH, match_scan.METRICS_INTERVAL,
+                               match_scan.METRICS_PORT).start()
+    if reporter.server is not None:
+        print(f"Metrics at http://127.0.0.1:{reporter.port}/metrics")
+    start = time.perf_counter()
+    try:
+        run_pipeline(source, on_frame, archive=not args.replay, max_frames=args.count)
+    finally:
+        if publisher is not None:
+            publisher.stop(timeout=10)
+        reporter.stop()
+    elapsed = time.perf_counter() - start
+    if latencies:
+        ms = np.asarray(latencies) * 1000
+        print(f"{len(ms)} captures in {elapsed:.2f} s ({len(ms) / elapsed:.1f}/s); capture-to-decision "
+              f"p50 {np.percentile(ms, 50):.2f} ms, p95 {np.percentile(ms, 95):.2f} ms, max {ms.max():.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# cascade.py
+# Two-stage identification: the cheap template score (GalleryIndex) shortlists
+# the best enrolled images, and only those are verified with keypoint
+# matching plus a RANSAC homography (matcher.py). Both scores are fused into
+# one calibrated match probability by a logistic model.
+
+import time
+import numpy as np
+from feature_extraction import extract_features
+from matcher import detect_keypoints, match_features, calculate_match_confidence
+
+SHORTLIST_K = 5  # Enrolled images verified per probe
+SCORE_FLOOR = 0.60  # Images with a lower template score are never verified
+# Logistic fusion of (template score, keypoint confidence) into P(genuine),
+# fitted on distorted_dataset/ probes against dataset/ with
+# `python benchmark.py cascade --fit --k 10 --floor 0` (ORB verification)
+FUSION_WEIGHTS = (30.06, 2.19, -25.90)
+
+
+def fuse_scores(template_scores, keypoint_scores, weights=FUSION_WEIGHTS):
+    """Match probability from template and keypoint scores (arrays or floats)."""
+    w_template, w_keypoint, bias = weights
+    z = w_template * np.asarray(template_scores) + w_keypoint * np.asarray(keypoint_scores) + bias
+    return 1.0 / (1.0 + np.exp(-z))
+
+
+def fit_fusion(template_scores, keypoint_scores, genuine, n_iter=5000, learning_rate=0.5, l2=1e-3):
+    """
+    Fit FUSION_WEIGHTS by logistic regression (batch gradient descent) on
+    labelled candidate pairs. Returns (w_template, w_keypoint, bias).
+    """
+    x = np.column_stack([template_scores, keypoint_scores]).astype(np.float64)
+    y = np.asarray(genuine, dtype=np.float64)
+    mean, std = x.mean(axis=0), x.std(axis=0) + 1e-12
+    xs = (x - mean) / std
+    w, b = np.zeros(2), 0.0
+    for _ in range(n_iter):
+        p = 1.0 / (1.0 + np.exp(-(xs @ w + b)))
+        w -= learning_rate * (xs.T @ (p - y) / len(y) + l2 * w)
+        b -= learning_rate * np.mean(p - y)
+    # Undo the standardization so the weights apply to raw scores
+    w_raw = w / std
+    return float(w_raw[0]), float(w_raw[1]), float(b - np.sum(w * mean / std))
+
+
+class CascadeIdentifier:
+    """
+    Shortlist with the template score, verify the shortlist geometrically.
+    gallery is a GalleryIndex and keypoints a KeypointGallery built from the
+    same gallery dict, so row i of one is image i of the other.
+    """
+
+    def __init__(self, gallery, keypoints, shortlist_k=SHORTLIST_K, score_floor=SCORE_FLOOR,
+                 weights=FUSION_WEIGHTS):
+        if len(gallery) != len(keypoints):
+            raise ValueError("Template and keypoint galleries do not have the same images")
+        self.gallery = gallery
+        self.keypoints = keypoints
+        self.method = keypoints.method
+        self.shortlist_k = shortlist_k
+        self.score_floor = score_floor
+        self.weights = weights
+        self.persons = gallery.persons
+        self.version = f"cascade:{keypoints.version}"
+        self.last_timings = {}
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def shortlist(self, probe_features):
+        """(template scores, rows) of the images worth verifying, best first."""
+        scores, rows = self.gallery.top_templates(probe_features, self.shortlist_k)
+        keep = scores >= self.score_floor
+        return scores[keep], rows[keep]
+
+    def verify(self, probe_points, probe_descriptors, rows):
+        """Keypoint match confidence (matcher.calculate_match_confidence) of the probe against each row."""
+        confidences = np.zeros(len(rows), dtype=np.float32)
+        for j, row in enumerate(rows):
+            points, descriptors = self.keypoints.image_features(row)
+            if len(descriptors) == 0 or len(probe_descriptors) == 0:
+                continue
+            matches = match_features(probe_descriptors, descriptors, self.method)
+            confidences[j] = calculate_match_confidence(probe_descriptors, descriptors, matches,
+                                                        probe_points, points, self.method)
+        return confidences
+
+    def candidates(self, probe_image):
+        """
+        Run both stages. Returns (rows, template_scores, keypoint_scores,
+        fused) for the shortlisted images; per-stage milliseconds are left
+        in self.last_timings.
+        """
+        t0 = time.perf_counter()
+        features = extract_features(probe_image)
+        t1 = time.perf_counter()
+        template_scores, rows = self.shortlist(features)
+        t2 = time.perf_counter()
+        keypoint_scores = np.zeros(len(rows), dtype=np.float32)
+        t3 = t2
+        if len(rows):
+            points, descriptors = detect_keypoints(probe_image, self.method, self.keypoints.n_features)
+            t3 = time.perf_counter()
+            keypoint_scores = self.verify(points, descriptors, rows)
+        t4 = time.perf_counter()
+        self.last_timings = {'features': (t1 - t0) * 1000, 'shortlist': (t2 - t1) * 1000,
+                             'keypoints': (t3 - t2) * 1000, 'verify': (t4 - t3) * 1000,
+                             'total': (t4 - t0) * 1000}
+        fused = fuse_scores(template_scores, keypoint_scores, self.weights)
+        return rows, template_scores, keypoint_scores, fused
+
+    def identify(self, probe_image, k=2):
+        """
+        Rank a grayscale probe image by fused match probability (best image
+        per person); returns (ranked, margin) like GalleryIndex.identify.
+        Persons without a shortlisted image are not ranked.
+        """
+        rows, _, _, fused = self.candidates(probe_image)
+        per_person = {}
+        for row, p in zip(rows, fused):
+            person = str(self.persons[self.gallery.label_ids[row]])
+            per_person[person] = max(per_person.get(person, 0.0), float(p))
+        ranked = sorted(per_person.items(), key=lambda item: -item[1])
+        if not ranked:
+            return [], 0.0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        return ranked[:k], ranked[0][1] - runner_up
@@ -1,13 +1,24 @@
 import cv2
 import numpy as np
-import random
 import os
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from scan_watcher import atomic_write
+from utils import iter_images
 
-def elastic_transform(image, alpha, sigma):
-	random_state = np.random.RandomState(None)
+# Every distortion takes an rng (numpy Generator). distort_dataset derives one
+# per output from (image path, variant index, seed), so a run is reproducible,
+# can be split across processes and resumed, and yields the same files.
+
+def _rng(rng):
+	return np.random.default_rng() if rng is None else rng
+
+def elastic_transform(image, alpha, sigma, rng=None):
+	rng = _rng(rng)
 	shape = image.shape
-	dx = (random_state.rand(*shape) * 2 - 1)
-	dy = (random_state.rand(*shape) * 2 - 1)
+	dx = (rng.random(shape) * 2 - 1)
+	dy = (rng.random(shape) * 2 - 1)
 	dx = cv2.GaussianBlur(dx, (17, 17), sigma) * alpha
 	dy = cv2.GaussianBlur(dy, (17, 17), sigma) * alpha
 	x, y = np.meshgrid(np.arange(shape[1]), np.arange(shape[0]))
@@ -15,104 +26,230 @@ def elastic_transform(image, alpha, sigma):
 	map_y = (y + dy).astype(np.float32)
 	return cv2.remap(image, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
 
-def random_affine(image):
+# Batched/fast elastic mode. All captures share one shape, so the coordinate
+# grid is built once per shape, and displacement fields are float32 (half the
+# memory traffic of the float64 path above, and remap needs float32 anyway).
+_GRIDS = {}
+
+def coordinate_grid(shape):
+	"""Cached float32 (x, y) pixel coordinate grids for an image shape."""
+	if shape not in _GRIDS:
+		y, x = np.indices(shape, dtype=np.float32)
+		_GRIDS[shape] = (x, y)
+	return _GRIDS[shape]
+
+def random_fields(shape, sigma, rng=None, count=1):
+	"""count smoothed (dx, dy) unit displacement fields, float32 (count, 2, h, w), drawn in one batch."""
+	rng = _rng(rng)
+	fields = rng.random((count, 2) + shape, dtype=np.float32)
+	fields *= 2
+	fields -= 1
+	for field in fields.reshape((-1,) + shape):
+		cv2.GaussianBlur(field, (17, 17), sigma, dst=field)
+	return fields
+
+class FieldBank:
+	"""
+	Precomputed displacement fields to draw from instead of generating them
+	per image: n_sigma blur levels across sigma_range, size fields in total.
+	Elastic distortions then cost only a scaled add and a remap.
+	"""
+
+	def __init__(self, shape, size=256, sigma_range=(5, 9), n_sigma=8, seed=0):
+		rng = np.random.default_rng(seed)
+		self.sigmas = np.linspace(sigma_range[0], sigma_range[1], n_sigma)
+		per_sigma = max(1, size // n_sigma)
+		self.fields = [random_fields(shape, sigma, rng, per_sigma) for sigma in self.sigmas]
+
+	def draw(self, sigma, rng=None):
+		"""A (2, h, w) field blurred with the bank sigma closest to sigma."""
+		rng = _rng(rng)
+		level = self.fields[int(np.argmin(np.abs(self.sigmas - sigma)))]
+		return level[rng.integers(len(level))]
+
+def elastic_transform_fast(image, alpha, sigma, rng=None, bank=None):
+	"""elastic_transform on float32 fields and a cached grid; draws the field from bank if given."""
+	x, y = coordinate_grid(image.shape)
+	field = bank.draw(sigma, rng) if bank is not None else random_fields(image.shape, sigma, rng)[0]
+	map_x = x + alpha * field[0]
+	map_y = y + alpha * field[1]
+	return cv2.remap(image, map_x, map_y, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+
+def _randint(rng, a, b):
+	# Inclusive bounds, like random.randint
+	return int(rng.integers(a, b + 1))
+
+def random_affine(image, rng=None):
+	rng = _rng(rng)
 	rows, cols = image.shape
 	pts1 = np.float32([[0,0], [cols-1,0], [0,rows-1]])
 	shift = 10
 	pts2 = np.float32([
-		[random.randint(0,shift), random.randint(0,shift)],
-		[cols-1-random.randint(0,shift), random.randint(0,shift)],
-		[random.randint(0,shift), rows-1-random.randint(0,shift)]
+		[_randint(rng, 0, shift), _randint(rng, 0, shift)],
+		[cols-1-_randint(rng, 0, shift), _randint(rng, 0, shift)],
+		[_randint(rng, 0, shift), rows-1-_randint(rng, 0, shift)]
 	])
 	M = cv2.getAffineTransform(pts1, pts2)
 	return cv2.warpAffine(image, M, (cols, rows), borderMode=cv2.BORDER_REFLECT)
 
-def add_noise_and_blur(image):
+def add_noise_and_blur(image, rng=None):
+	rng = _rng(rng)
 	blurred = cv2.GaussianBlur(image, (7, 7), 0)
-	noise = np.random.normal(0, 15, image.shape).astype(np.int16)
+	noise = rng.normal(0, 15, image.shape).astype(np.int16)
 	noisy = np.clip(blurred.astype(np.int16) + noise, 0, 255).astype(np.uint8)
 	return noisy
 
-def partial_occlusion(image):
+def partial_occlusion(image, rng=None):
+	rng = _rng(rng)
 	img = image.copy()
 	h, w = img.shape
 	# 50% chance rectangle, 50% ellipse
-	if random.random() < 0.5:
-		x1, y1 = random.randint(0, w//2), random.randint(0, h//2)
-		x2, y2 = x1 + random.randint(10, w//2), y1 + random.randint(10, h//2)
+	if rng.random() < 0.5:
+		x1, y1 = _randint(rng, 0, w//2), _randint(rng, 0, h//2)
+		x2, y2 = x1 + _randint(rng, 10, w//2), y1 + _randint(rng, 10, h//2)
 		cv2.rectangle(img, (x1, y1), (x2, y2), (0,), -1)
 	else:
-		center = (random.randint(w//4, 3*w//4), random.randint(h//4, 3*h//4))
-		axes = (random.randint(10, w//3), random.randint(10, h//3))
-		angle = random.randint(0, 180)
+		center = (_randint(rng, w//4, 3*w//4), _randint(rng, h//4, 3*h//4))
+		axes = (_randint(rng, 10, w//3), _randint(rng, 10, h//3))
+		angle = _randint(rng, 0, 180)
 		cv2.ellipse(img, center, axes, angle, 0, 360, (0,), -1)
 	return img
-def random_erasing(image, max_rect=3):
+def random_erasing(image, max_rect=3, rng=None):
+	rng = _rng(rng)
 	img = image.copy()
 	h, w = img.shape
-	for _ in range(random.randint(1, max_rect)):
-		x1 = random.randint(0, w-1)
-		y1 = random.randint(0, h-1)
-		rect_w = random.randint(5, w//5)
-		rect_h = random.randint(5, h//5)
+	for _ in range(_randint(rng, 1, max_rect)):
+		x1 = _randint(rng, 0, w-1)
+		y1 = _randint(rng, 0, h-1)
+		rect_w = _randint(rng, 5, w//5)
+		rect_h = _randint(rng, 5, h//5)
 		x2 = min(w, x1 + rect_w)
 		y2 = min(h, y1 + rect_h)
-		img[y1:y2, x1:x2] = random.randint(0, 40)  # dark patch
+		img[y1:y2, x1:x2] = _randint(rng, 0, 40)  # dark patch
 	return img
 
-def add_line_artifacts(image, max_lines=5):
+def add_line_artifacts(image, max_lines=5, rng=None):
+	rng = _rng(rng)
 	img = image.copy()
 	h, w = img.shape
-	for _ in range(random.randint(1, max_lines)):
-		x1, y1 = random.randint(0, w-1), random.randint(0, h-1)
-		x2, y2 = random.randint(0, w-1), random.randint(0, h-1)
-		thickness = random.randint(1, 3)
-		color = random.randint(0, 80)
+	for _ in range(_randint(rng, 1, max_lines)):
+		x1, y1 = _randint(rng, 0, w-1), _randint(rng, 0, h-1)
+		x2, y2 = _randint(rng, 0, w-1), _randint(rng, 0, h-1)
+		thickness = _randint(rng, 1, 3)
+		color = _randint(rng, 0, 80)
 		cv2.line(img, (x1, y1), (x2, y2), color, thickness)
 	return img
 
-def random_intensity_contrast(image):
+def random_intensity_contrast(image, rng=None):
+	rng = _rng(rng)
 	# Random brightness and contrast
-	alpha = random.uniform(0.7, 1.3)  # contrast
-	beta = random.randint(-30, 30)    # brightness
+	alpha = rng.uniform(0.7, 1.3)  # contrast
+	beta = _randint(rng, -30, 30)    # brightness
 	img = cv2.convertScaleAbs(image, alpha=alpha, beta=beta)
 	return img
 
-def strong_distort(image):
-	img = elastic_transform(image, alpha=random.uniform(10, 20), sigma=random.uniform(5, 9))
-	img = random_affine(img)
-	img = add_noise_and_blur(img)
-	img = random_intensity_contrast(img)
+def strong_distort(image, rng=None, fast=False, bank=None):
+	# fast (or a FieldBank) uses elastic_transform_fast; the other steps are unchanged
+	rng = _rng(rng)
+	alpha, sigma = rng.uniform(10, 20), rng.uniform(5, 9)
+	if fast or bank is not None:
+		img = elastic_transform_fast(image, alpha, sigma, rng, bank)
+	else:
+		img = elastic_transform(image, alpha=alpha, sigma=sigma, rng=rng)
+	img = random_affine(img, rng)
+	img = add_noise_and_blur(img, rng)
+	img = random_intensity_contrast(img, rng)
 	# Advanced: random erasing
-	if random.random() < 0.7:
-		img = random_erasing(img, max_rect=3)
+	if rng.random() < 0.7:
+		img = random_erasing(img, max_rect=3, rng=rng)
 	# Advanced: line artifacts
-	if random.random() < 0.5:
-		img = add_line_artifacts(img, max_lines=4)
+	if rng.random() < 0.5:
+		img = add_line_artifacts(img, max_lines=4, rng=rng)
 	# Advanced: partial occlusion (rectangle or ellipse)
-	if random.random() < 0.7:
-		img = partial_occlusion(img)
+	if rng.random() < 0.7:
+		img = partial_occlusion(img, rng)
 	return img
 
-def distort_dataset(input_root="dataset", output_root="distorted_dataset"):
-	for person in os.listdir(input_root):
-		in_dir = os.path.join(input_root, person)
+def sample_seed(source, variant, seed=0):
+	"""Deterministic 64-bit seed for one variant of one source image (person/file name)."""
+	digest = hashlib.sha256(f"{seed}:{source}:{variant}".encode()).digest()
+	return int.from_bytes(digest[:8], 'little')
+
+# One bank per worker process, keyed by (shape, size, seed) so every worker builds the same one
+_BANKS = {}
+
+def _distort_one(task):
+	in_path, out_path, sample, mode, bank_size, seed = task
+	img = cv2.imread(in_path, cv2.IMREAD_GRAYSCALE)
+	if img is None:
+		return f"Failed to read {in_path}"
+	bank = None
+	if mode == 'bank':
+		key = (img.shape, bank_size, seed)
+		if key not in _BANKS:
+			_BANKS[key] = FieldBank(img.shape, bank_size, seed=seed)
+		bank = _BANKS[key]
+	distorted = strong_distort(img, np.random.default_rng(sample), fast=(mode == 'fast'), bank=bank)
+	def write(temp_path):
+		if not cv2.imwrite(temp_path, distorted):
+			raise OSError(f"Failed to write {temp_path}")
+	# Temp-then-rename: an interrupted run never leaves a file that looks done
+	atomic_write(out_path, write)
+	return None
+
+DISTORT_MODES = ('exact', 'fast', 'bank')
+
+def distort_dataset(input_root="dataset", output_root="distorted_dataset", variants=1, workers=None, seed=0,
+					mode='exact', bank_size=256, shard=0, num_shards=1):
+	"""
+	Write `variants` distorted copies of every input_root/<person>/*.bmp.
+	With one variant the file keeps its name (the original layout), otherwise
+	variant k is saved as <name>_v<k>.bmp. Outputs that already exist are
+	skipped, so an interrupted run can simply be restarted.
+	mode 'fast' uses float32 elastic fields on a cached grid, 'bank' draws
+	them from a FieldBank of bank_size fields (see benchmark.py distort).
+	shard/num_shards split the source images between machines (utils.iter_images).
+	"""
+	if mode not in DISTORT_MODES:
+		raise ValueError(f"Unknown distortion mode: {mode}")
+	tasks = []
+	skipped = 0
+	for person, in_path, _ in iter_images(input_root, shard=shard, num_shards=num_shards):
 		out_dir = os.path.join(output_root, person)
-		if not os.path.isdir(in_dir):
-			continue
 		os.makedirs(out_dir, exist_ok=True)
-		for fname in os.listdir(in_dir):
-			if not fname.lower().endswith('.bmp'):
+		fname = os.path.basename(in_path)
+		stem, ext = os.path.splitext(fname)
+		for k in range(variants):
+			out_name = fname if variants == 1 else f"{stem}_v{k:03d}{ext}"
+			out_path = os.path.join(out_dir, out_name)
+			if os.path.exists(out_path):
+				skipped += 1
 				continue
-			in_path = os.path.join(in_dir, fname)
-			out_path = os.path.join(out_dir, fname)
-			img = cv2.imread(in_path, cv2.IMREAD_GRAYSCALE)
-			if img is None:
-				print(f"Failed to read {in_path}")
-				continue
-			distorted = strong_distort(img)
-			cv2.imwrite(out_path, distorted)
-			print(f"Distorted and saved: {out_path}")
+			tasks.append((in_path, out_path, sample_seed(f"{person}/{fname}", k, seed),
+						  mode, bank_size, seed))
+	workers = workers or os.cpu_count() or 1
+	if workers == 1:
+		errors = [_distort_one(task) for task in tasks]
+	else:
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			errors = list(pool.map(_distort_one, tasks, chunksize=max(1, len(tasks) // (workers * 8))))
+	errors = [e for e in errors if e]
+	for error in errors:
+		print(error)
+	failed = len(errors)
+	print(f"Distorted and saved {len(tasks) - failed} images to {output_root} ({skipped} already present, {failed} failed)")
 
 if __name__ == "__main__":
-	distort_dataset()
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--input', default='dataset')
+	parser.add_argument('--output', default='distorted_dataset')
+	parser.add_argument('--variants', type=int, default=1, help='distorted copies per source image')
+	parser.add_argument('--workers', type=int, help='processes (default: CPU count)')
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--mode', choices=DISTORT_MODES, default='exact', help='elastic field generation')
+	parser.add_argument('--bank-size', type=int, default=256, help='fields in the bank (--mode bank)')
+	parser.add_argument('--shard', type=int, default=0, help='index of this machine\'s share of the sources')
+	parser.add_argument('--num-shards', type=int, default=1)
+	args = parser.parse_args()
+	distort_dataset(args.input, args.output, args.variants, args.workers, args.seed, args.mode, args.bank_size,
+					args.shard, args.num_shards)
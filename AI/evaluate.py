@@ -1,22 +1,283 @@
-# Example script to train or evaluate fingerprint recognition
-# This is a template for you to expand with your dataset and logic
+# evaluate.py
+# Accuracy and speed benchmark of every matcher mode in one run.
+# All images of the given datasets are compared pairwise (same person =
+# genuine, different person = impostor); the first dataset is also used as the
+# gallery for rank-1 identification of the others. Features are cached per
+# file content, and each mode runs in a fresh process so its peak RSS is its own.
+# Usage: python evaluate.py [--modes template orb ...] [--output evaluation.json] [--baseline old.json]
 
-from preprocess import preprocess_image
-from feature_extraction import extract_minutiae_features
-from matcher import match_minutiae_features
-from utils import list_images
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import cv2
+import numpy as np
+from cascade import fuse_scores
+from feature_extraction import extract_features, extract_minutiae
+from matcher import (detect_keypoints, match_features, calculate_match_confidence, match_minutiae,
+                     minutiae_similarity, minutiae_triangles)
+from utils import iter_images
 
-# Example usage: compare all images in two folders
-folder1 = '../dataset/person1/normal/'
-folder2 = '../dataset/person1/distorted/'
+DATASETS = ('dataset', 'distorted_dataset', 'enhanced_dataset')
+MODES = ('template', 'orb', 'sift', 'cascade', 'minutiae')
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.eval_cache')
+CACHE_VERSION = 1  # Bump when an extractor changes so cached features are recomputed
+TARGET_FRR = (0.01, 0.05, 0.10)  # FAR is reported at these false reject rates
+CURVE_POINTS = 200  # ROC/DET points kept in the output
+TIMED_IMAGES = 20  # Images re-extracted without the cache to time extraction
+CASCADE_METHOD = 'orb'  # Keypoints of the cascade mode, as match_scan.CASCADE_METHOD
 
-images1 = list_images(folder1)
-images2 = list_images(folder2)
 
-for img1_path in images1:
-    term1, bif1 = extract_minutiae_features(img1_path)
-    for img2_path in images2:
-        term2, bif2 = extract_minutiae_features(img2_path)
-        match_score = match_minutiae_features(term1, bif1, term2, bif2)
-        print(f"{img1_path} vs {img2_path}: {match_score} minutiae matches")
+def extract(mode, image):
+    """Features of a grayscale image for one mode, as a tuple of arrays."""
+    if mode == 'template':
+        return (extract_features(image),)
+    if mode in ('orb', 'sift'):
+        return detect_keypoints(image, mode)
+    if mode == 'cascade':
+        return (extract_features(image),) + detect_keypoints(image, CASCADE_METHOD)
+    if mode == 'minutiae':
+        return (extract_minutiae(image),)
+    raise ValueError(f"Unknown matcher mode: {mode}")
+
+
+def prepare(mode, features):
+    """Per-template data computed once at enrollment (minutiae triangle tables)."""
+    if mode == 'minutiae':
+        return features + (minutiae_triangles(features[0]),)
+    return features
+
+
+def _keypoint_confidence(gallery, probe, method):
+    (gallery_points, gallery_descriptors), (probe_points, probe_descriptors) = gallery, probe
+    if len(gallery_descriptors) == 0 or len(probe_descriptors) == 0:
+        return 0.0
+    matches = match_features(probe_descriptors, gallery_descriptors, method)
+    return calculate_match_confidence(probe_descriptors, gallery_descriptors, matches,
+                                      probe_points, gallery_points, method)
+
+
+def compare(mode, gallery, probe):
+    """Match score of a probe against one enrolled image (higher = more alike)."""
+    if mode == 'template':
+        return float(gallery[0] @ probe[0])
+    if mode in ('orb', 'sift'):
+        return _keypoint_confidence(gallery, probe, mode)
+    if mode == 'cascade':
+        template = float(gallery[0] @ probe[0])
+        return float(fuse_scores(template, _keypoint_confidence(gallery[1:], probe[1:], CASCADE_METHOD)))
+    if mode == 'minutiae':
+        paired = match_minutiae(probe[0], gallery[0], gallery[1])
+        return minutiae_similarity(paired, len(probe[0]), len(gallery[0]))
+    raise ValueError(f"Unknown matcher mode: {mode}")
+
+
+class FeatureCache:
+    """Extracted features stored as .npz files named by sha1(file contents)."""
+
+    def __init__(self, cache_dir=CACHE_DIR, mode='template'):
+        self.cache_dir = os.path.join(cache_dir, f"{mode}-v{CACHE_VERSION}")
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+
+    def features(self, path, refresh=False):
+        """Cached or freshly extracted features of an image file (None if unreadable)."""
+        with open(path, 'rb') as f:
+            data = f.read()
+        cache_path = os.path.join(self.cache_dir, hashlib.sha1(data).hexdigest() + '.npz')
+        if not refresh and os.path.exists(cache_path):
+            self.hits += 1
+            with np.load(cache_path, allow_pickle=False) as arrays:
+                return tuple(arrays[f"arr_{i}"] for i in range(len(arrays.files)))
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+        if image is None:
+            return None
+        self.misses += 1
+        features = extract(self.mode, image)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, *features)
+        os.replace(tmp_path, cache_path)
+        return features
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MiB (None where unavailable)."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+
+
+def error_rates(genuine, impostor):
+    """(thresholds, FAR, FRR) at every distinct score, accepting score >= threshold."""
+    genuine, impostor = np.sort(genuine), np.sort(impostor)
+    thresholds = np.unique(np.concatenate([genuine, impostor]))
+    far = 1.0 - np.searchsorted(impostor, thresholds, 'left') / max(len(impostor), 1)
+    frr = np.searchsorted(genuine, thresholds, 'left') / max(len(genuine), 1)
+    return thresholds, far, frr
+
+
+def accuracy_metrics(genuine, impostor, target_frr=TARGET_FRR, curve_points=CURVE_POINTS):
+    """EER, FAR at fixed FRRs and a downsampled ROC/DET curve of genuine and impostor scores."""
+    thresholds, far, frr = error_rates(genuine, impostor)
+    # EER: interpolate between the thresholds where FAR - FRR changes sign
+    diff = far - frr
+    i = int(np.argmax(diff <= 0)) if (diff <= 0).any() else len(diff) - 1
+    if i > 0 and diff[i - 1] != diff[i]:
+        w = diff[i - 1] / (diff[i - 1] - diff[i])
+        eer = far[i - 1] + w * (far[i] - far[i - 1])
+    else:
+        eer = (far[i] + frr[i]) / 2
+    far_at_frr = {}
+    for target in target_frr:
+        ok = frr <= target
+        far_at_frr[f"{target:g}"] = float(far[ok].min()) if ok.any() else 1.0
+    keep = np.unique(np.linspace(0, len(thresholds) - 1, min(curve_points, len(thresholds))).astype(int))
+    genuine, impostor = np.asarray(genuine), np.asarray(impostor)
+    d_prime = (genuine.mean() - impostor.mean()) / np.sqrt((genuine.var() + impostor.var()) / 2 + 1e-12)
+    return {
+        'eer': float(eer),
+        'eer_threshold': float(thresholds[i]),
+        'far_at_frr': far_at_frr,
+        'genuine_mean': float(genuine.mean()),
+        'impostor_mean': float(impostor.mean()),
+        'd_prime': float(d_prime),
+        # (threshold, FAR, FRR); plot FAR vs 1 - FRR for ROC, or both on
+        # normal-deviate axes for DET
+        'curve': [[float(thresholds[k]), float(far[k]), float(frr[k])] for k in keep],
+    }
+
+
+def evaluate_mode(mode, images, gallery_set, cache_dir=CACHE_DIR, refresh=False, timed_images=TIMED_IMAGES):
+    """
+    Run one mode over images, a list of (dataset, person, path). Meant to run
+    in its own process; returns the mode's result dict.
+    """
+    cv2.setNumThreads(1)
+    cache = FeatureCache(cache_dir, mode)
+    features, kept = [], []
+    for image in images:
+        f = cache.features(image[2], refresh)
+        if f is None:
+            print(f"{mode}: failed to read {image[2]}")
+            continue
+        features.append(prepare(mode, f))
+        kept.append(image)
+
+    # Extraction time of a fixed sample, independent of the cache state; the
+    # first call is not timed (lazy imports, detector construction)
+    extract_ms = []
+    for k, (_, _, path) in enumerate(kept[:timed_images + 1]):
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        t0 = time.perf_counter()
+        extract(mode, image)
+        if k > 0:
+            extract_ms.append((time.perf_counter() - t0) * 1000)
+
+    # Every pair once; the image from the earlier dataset is the enrolled one
+    n = len(kept)
+    scores = np.full((n, n), np.nan)
+    t0 = time.perf_counter()
+    for i in range(n):
+        for j in range(i + 1, n):
+            scores[i, j] = compare(mode, features[i], features[j])
+    elapsed = time.perf_counter() - t0
+    n_pairs = n * (n - 1) // 2
+
+    persons = np.array([person for _, person, _ in kept])
+    upper = np.triu(np.ones((n, n), dtype=bool), 1)
+    same = persons[:, None] == persons[None, :]
+    result = accuracy_metrics(scores[upper & same], scores[upper & ~same])
+
+    # Rank-1: probes from the other datasets against the gallery dataset,
+    # best enrolled image per person
+    in_gallery = np.array([dataset == gallery_set for dataset, _, _ in kept])
+    rows, cols = np.nonzero(in_gallery)[0], np.nonzero(~in_gallery)[0]
+    correct = 0
+    if len(rows):
+        for j in cols:
+            best = rows[int(np.argmax(scores[rows, j]))]
+            correct += persons[best] == persons[j]
+    result.update({
+        'rank1': float(correct / len(cols)) if len(cols) and len(rows) else None,
+        'images': n,
+        'genuine_pairs': int((upper & same).sum()),
+        'impostor_pairs': int((upper & ~same).sum()),
+        'extraction_ms_per_image': float(np.mean(extract_ms)) if extract_ms else None,
+        'comparisons_per_s': float(n_pairs / elapsed) if elapsed > 0 else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'cache_hits': cache.hits,
+    })
+    return result
+
+
+SUMMARY = ('eer', 'rank1', 'd_prime', 'extraction_ms_per_image', 'comparisons_per_s', 'peak_rss_mb')
+
+
+def summary_line(mode, result, baseline=None):
+    """One printed line per mode, with the change from a baseline run if given."""
+    parts = []
+    for key in SUMMARY:
+        value = result.get(key)
+        text = 'n/a' if value is None else f"{value:.4g}"
+        old = (baseline or {}).get(key)
+        if value is not None and old is not None:
+            text += f" ({value - old:+.3g})"
+        parts.append(f"{key} {text}")
+    far = ', '.join(f"FAR@FRR{k} {v:.3f}" for k, v in result['far_at_frr'].items())
+    return f"{mode:>9}: " + ', '.join(parts) + f"; {far}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', nargs='+', default=list(DATASETS),
+                        help='dataset roots; the first is the rank-1 gallery')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=list(MODES))
+    parser.add_argument('--output', default='evaluation.json')
+    parser.add_argument('--baseline', help='earlier output to print the changes against')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    parser.add_argument('--refresh', action='store_true', help='re-extract instead of using cached features')
+    parser.add_argument('--timed-images', type=int, default=TIMED_IMAGES)
+    args = parser.parse_args()
+
+    images = [(root, r.person, r.path) for root in args.datasets if os.path.isdir(root)
+              for r in iter_images(root)]
+    for root in args.datasets:
+        if not os.path.isdir(root):
+            print(f"Skipping missing dataset {root}")
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f).get('modes', {})
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'datasets': {root: sum(1 for d, _, _ in images if d == root) for root in args.datasets},
+        'gallery': args.datasets[0],
+        'modes': {},
+    }
+    # A fresh spawned process per mode, so peak RSS and caches are not shared
+    context = multiprocessing.get_context('spawn')
+    for mode in args.modes:
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            result = pool.submit(evaluate_mode, mode, images, args.datasets[0], args.cache_dir,
+                                 args.refresh, args.timed_images).result()
+        report['modes'][mode] = result
+        print(summary_line(mode, result, baseline.get(mode)), flush=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(f"Results saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+# gallery.py
+# Enrollment step for the template matcher: extracts feature vectors for every
+# dataset/<person>/*.bmp once and keeps them in an on-disk gallery file
+# (the memory-mapped format described in gallery_file.py).
+
+import os
+import hashlib
+import numpy as np
+from feature_extraction import extract_features_batch, FEATURE_DIM
+from gallery_file import read_gallery_file, write_gallery_file, append_gallery_file, record_problem
+from quantize import quantize_templates
+from utils import iter_images
+
+DATASET_DIR = 'dataset'
+GALLERY_PATH = 'gallery.tpl'
+
+
+def file_digest(path):
+    """Return the SHA-1 hex digest of a file's contents."""
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def gallery_version(gallery):
+    """Digest of a gallery dict's labels and image hashes; changes with any enrollment change."""
+    h = hashlib.sha1()
+    for label, digest in zip(gallery['labels'], gallery['hashes']):
+        h.update(f"{label}\0{digest}\n".encode())
+    return h.hexdigest()
+
+
+def list_enrollment_images(dataset_root):
+    """List (person, path) pairs for every enrolled BMP, in a stable order."""
+    return [(r.person, r.path) for r in iter_images(dataset_root)]
+
+
+def load_gallery(gallery_path=GALLERY_PATH):
+    """
+    Load a gallery file. Returns a dict with 'templates' (N x D float32,
+    a read-only memmap shared between processes), 'labels', 'paths',
+    'mtimes', 'sizes' and 'hashes', or None if missing.
+    """
+    return read_gallery_file(gallery_path)
+
+
+def save_gallery(gallery, gallery_path=GALLERY_PATH, append=False):
+    """
+    Write a gallery dict atomically (temp file, then rename), or with
+    append=True add its rows to the end of the existing file in place.
+    """
+    if append and os.path.exists(gallery_path):
+        append_gallery_file(gallery_path, gallery)
+    else:
+        write_gallery_file(gallery_path, gallery)
+
+
+class GalleryIndex:
+    """
+    Stacked enrollment templates for one-shot probe scoring.
+    Scores of one matrix-vector product are gathered in person order so the
+    per-person max is a single reduceat. The template matrix itself is used
+    in file order, so a memmapped float32 gallery is scored without a copy.
+
+    Scoring is exact brute force and memory-bound: it reads the whole float32
+    matrix (6 KB per template) on every probe. Measured on one core, identify()
+    takes ~0.04 ms for 100 templates, ~0.4 ms for 1k, ~3 ms for 5k and
+    ~13 ms for 20k, so it stays under a millisecond only up to about 2k
+    templates. Pass an approximate ann_index index (e.g. IVFIndex) to score
+    only a fraction of the gallery per probe. version identifies the
+    enrollment (gallery_version) for caches of identification results.
+    """
+
+    def __init__(self, templates, labels, index=None, search_k=32, template_dtype='float32', version=None):
+        labels = np.asarray(labels, dtype=str)
+        persons, label_ids = np.unique(labels, return_inverse=True)
+        templates = np.asarray(templates, dtype=np.float32)
+        # float16/int8 storage (quantize.py) halves/quarters memory per template
+        self.templates = quantize_templates(templates, template_dtype)
+        self.label_ids = label_ids
+        self.persons = persons
+        self.version = version
+        # Rows grouped by person, and the start of each group, for np.maximum.reduceat
+        self.order = np.argsort(label_ids, kind='stable')
+        self.starts = np.searchsorted(label_ids[self.order], np.arange(len(persons)))
+        # Optional ann_index index (e.g. IVFIndex) for large galleries; its
+        # search_k best templates are reduced per person instead of all rows.
+        # It is built here unless already built or loaded, and scores the
+        # (possibly quantized, memory-mapped) templates above, never a copy
+        self.index = None
+        self.search_k = search_k
+        if index is not None and len(self.templates):
+            if not index.built:
+                index.build(templates)
+            self.index = index.attach(self.templates)
+
+    @classmethod
+    def from_gallery(cls, gallery, index=None, search_k=32, template_dtype='float32'):
+        """Build an index from a gallery dict as returned by load_gallery/build_gallery."""
+        return cls(gallery['templates'], gallery['labels'], index=index, search_k=search_k,
+                   template_dtype=template_dtype, version=f"template:{gallery_version(gallery)}")
+
+    def __len__(self):
+        return len(self.templates)
+
+    def person_scores(self, probe_features):
+        """Best cosine score per person (aligned with self.persons)."""
+        if len(self.templates) == 0:
+            return np.zeros(0, dtype=np.float32)
+        if self.index is not None:
+            # Persons without a template among the candidates get -inf
+            scores, rows = self.index.search(probe_features, self.search_k)
+            per_person = np.full(len(self.persons), -np.inf, dtype=np.float32)
+            np.maximum.at(per_person, self.label_ids[rows], scores)
+            return per_person
+        scores = self.templates @ np.asarray(probe_features, dtype=np.float32)
+        return np.maximum.reduceat(scores[self.order], self.starts)
+
+    def person_scores_batch(self, probe_features):
+        """
+        Best cosine score per person for every row of a (B x D) probe matrix,
+        as a (B x persons) matrix from one template-matrix product.
+        """
+        probes = np.asarray(probe_features, dtype=np.float32).reshape(-1, self.templates.shape[1])
+        if len(self.templates) == 0:
+            return np.zeros((len(probes), len(self.persons)), dtype=np.float32)
+        if self.index is not None:
+            return np.array([self.person_scores(p) for p in probes]).reshape(len(probes), len(self.persons))
+        scores = self.templates @ probes.T
+        return np.maximum.reduceat(scores[self.order], self.starts, axis=0).T
+
+    def top_templates(self, probe_features, k=10):
+        """Return (scores, rows) of the k best-scoring individual templates, best first."""
+        if self.index is not None:
+            return self.index.search(probe_features, k)
+        scores = self.templates @ np.asarray(probe_features, dtype=np.float32)
+        k = min(k, len(scores))
+        if k == 0:
+            return scores[:0], np.zeros(0, dtype=np.int64)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return scores[top], top
+
+    def pair_scores(self, rows, probe_features):
+        """Cosine score of template rows[i] against row i of a (len(rows) x D) probe matrix."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if isinstance(self.templates, np.ndarray):
+            templates = self.templates[rows]
+        else:
+            templates = self.templates.take(rows)
+        return np.einsum('ij,ij->i', templates, np.asarray(probe_features, dtype=np.float32).reshape(len(rows), -1))
+
+    def rank(self, probe_features, k=5):
+        """Return the top-k (person, score) pairs, best first."""
+        return self._rank(self.person_scores(probe_features), k)
+
+    def _rank(self, per_person, k):
+        k = min(k, int(np.isfinite(per_person).sum()))
+        if k == 0:
+            return []
+        top = np.argpartition(-per_person, k - 1)[:k]
+        top = top[np.argsort(-per_person[top], kind='stable')]
+        return [(str(self.persons[i]), float(per_person[i])) for i in top]
+
+    def identify(self, probe_features, k=2):
+        """
+        Rank the probe and return (ranked, margin), where margin is the gap
+        between the best and the runner-up person (the best score if only one
+        person is enrolled).
+        """
+        return self._identify(self.person_scores(probe_features), k)
+
+    def identify_batch(self, probe_features, k=2):
+        """identify() of every row of a (B x D) probe matrix, scored in one matrix product."""
+        return [self._identify(per_person, k) for per_person in self.person_scores_batch(probe_features)]
+
+    def _identify(self, per_person, k):
+        ranked = self._rank(per_person, max(k, 2))
+        if not ranked:
+            return [], 0.0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        return ranked[:k], ranked[0][1] - runner_up
+
+
+def build_gallery(dataset_root=DATASET_DIR, gallery_path=GALLERY_PATH, workers=1, verbose=True):
+    """
+    Enroll every image under dataset_root and save the gallery.
+    Only new or modified files are re-extracted: a file is reused when its
+    mtime and size match the previous gallery, or when its content hash does.
+    The rest are extracted with extract_features_batch across `workers` processes.
+    If nothing was removed or changed, new templates are appended to the
+    existing file instead of rewriting it.
+    """
+    previous = load_gallery(gallery_path)
+    known = {}
+    if previous is not None:
+        for i, path in enumerate(previous['paths']):
+            known[str(path)] = i
+
+    records = []
+    pending = []
+    reused = 0
+    refreshed = 0  # Reused by content hash; their stored mtime is stale
+    for person, path, st in iter_images(dataset_root):
+        problem = record_problem(person, path)
+        if problem is not None:
+            # Would not fit the gallery file's fixed-size label table
+            if verbose:
+                print(f"Skipping {path}: {problem}")
+            continue
+        row = known.get(path)
+        template = None
+        digest = None
+        if row is not None:
+            if previous['mtimes'][row] == st.st_mtime and previous['sizes'][row] == st.st_size:
+                template = previous['templates'][row]
+                digest = str(previous['hashes'][row])
+            else:
+                digest = file_digest(path)
+                if digest == previous['hashes'][row]:
+                    template = previous['templates'][row]
+                    refreshed += 1
+        if template is None:
+            pending.append(len(records))
+        else:
+            reused += 1
+        records.append([person, path, st, digest, template, row if template is not None else None])
+
+    # Decode and extract all new or modified images in one batch
+    features, failures = extract_features_batch([records[i][1] for i in pending], workers=workers)
+    for j, i in enumerate(pending):
+        if j in failures:
+            if verbose:
+                print(failures[j])
+            records[i] = None
+            continue
+        records[i][4] = features[j]
+        records[i][3] = records[i][3] or file_digest(records[i][1])
+    records = [r for r in records if r is not None]
+    extracted = len(pending) - len(failures)
+
+    # Keep surviving rows in their previous file order, new rows after them
+    records.sort(key=lambda r: (r[5] is None, r[5] if r[5] is not None else 0))
+    append = previous is not None and reused == len(previous['paths']) and not refreshed
+    if append:
+        records = records[reused:]
+
+    labels = [r[0] for r in records]
+    paths = [r[1] for r in records]
+    mtimes = [r[2].st_mtime for r in records]
+    sizes = [r[2].st_size for r in records]
+    hashes = [r[3] for r in records]
+    templates = [r[4] for r in records]
+
+    gallery = {
+        'templates': np.array(templates, dtype=np.float32).reshape(len(templates), FEATURE_DIM),
+        'labels': np.array(labels, dtype=str),
+        'paths': np.array(paths, dtype=str),
+        'mtimes': np.array(mtimes, dtype=np.float64),
+        'sizes': np.array(sizes, dtype=np.int64),
+        'hashes': np.array(hashes, dtype=str),
+    }
+    # Release the old memmap before the file is replaced (required on Windows)
+    del previous, records, templates
+    save_gallery(gallery, gallery_path, append=append)
+    # Return the memory-mapped file rather than the in-memory copy
+    gallery = load_gallery(gallery_path)
+    if verbose:
+        action = 'appended to' if append else 'saved to'
+        print(f"Gallery {action} {gallery_path}: {len(gallery['templates'])} templates "
+              f"({extracted} extracted, {reused} reused)")
+    return gallery
+
+
+if __name__ == "__main__":
+    build_gallery(workers=os.cpu_count())
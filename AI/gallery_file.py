@@ -0,0 +1,177 @@
+# gallery_file.py
+# Memory-mapped on-disk gallery. Matcher processes open the file read-only with
+# numpy.memmap, so every worker (and a restarted matcher) shares one page-cache
+# copy of the templates instead of loading its own.
+#
+# Layout (all integers little-endian):
+#
+#   offset 0      header, HEADER_SIZE bytes:
+#                   magic         8s   b'FPGALLRY'
+#                   version       u32  FORMAT_VERSION
+#                   dim           u32  template length (FEATURE_DIM)
+#                   record_size   u32  bytes per label-table record
+#                   reserved      u32
+#                   count         u64  committed rows; rows beyond it are ignored
+#                   capacity      u64  rows reserved in the table and the matrix
+#                   table_offset  u64  start of the label table
+#                   matrix_offset u64  start of the template matrix (page aligned)
+#   table_offset  label table: capacity records of RECORD_DTYPE
+#                 (person label, image path, SHA-1, mtime, size)
+#   matrix_offset template matrix: capacity x dim float32, row-major
+#
+# Appending writes the new records and rows into the reserved space and only
+# then bumps count in the header, so a crash mid-append leaves the previous
+# gallery intact. The file is rewritten (with doubled capacity) only when the
+# reserved space runs out or rows must be removed or replaced.
+
+import os
+import struct
+import numpy as np
+
+MAGIC = b'FPGALLRY'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<8sIIIIQQQQ')
+HEADER_SIZE = 64
+PAGE_SIZE = 4096
+MIN_CAPACITY = 64
+RECORD_DTYPE = np.dtype([
+    ('label', 'S64'),
+    ('path', 'S256'),
+    ('sha1', 'S40'),
+    ('mtime', '<f8'),
+    ('size', '<i8'),
+])
+
+
+def _layout(capacity):
+    table_offset = HEADER_SIZE
+    table_end = table_offset + capacity * RECORD_DTYPE.itemsize
+    matrix_offset = -(-table_end // PAGE_SIZE) * PAGE_SIZE
+    return table_offset, matrix_offset
+
+
+class GalleryFile:
+    """
+    An open gallery file. records and templates are memmaps limited to the
+    committed rows (read-only unless opened with mode='r+').
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path, 'rb') as f:
+            raw = f.read(HEADER.size)
+        if len(raw) < HEADER.size:
+            raise ValueError(f"{path}: truncated gallery header")
+        (magic, version, self.dim, record_size, _, self.count, self.capacity,
+         table_offset, matrix_offset) = HEADER.unpack(raw)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path}: not a version {FORMAT_VERSION} gallery file")
+        if record_size != RECORD_DTYPE.itemsize:
+            raise ValueError(f"{path}: unexpected record size {record_size}")
+        self._table = np.memmap(path, dtype=RECORD_DTYPE, mode=mode, offset=table_offset,
+                                shape=(self.capacity,))
+        self._matrix = np.memmap(path, dtype=np.float32, mode=mode, offset=matrix_offset,
+                                 shape=(self.capacity, self.dim))
+
+    @property
+    def records(self):
+        return self._table[:self.count]
+
+    @property
+    def templates(self):
+        return self._matrix[:self.count]
+
+    def as_gallery(self):
+        """
+        The gallery dict used by gallery.py. 'templates' stays a read-only
+        memmap; the small per-row fields are decoded into regular arrays.
+        """
+        records = self.records
+        return {
+            'templates': self.templates,
+            'labels': np.char.decode(records['label'], 'utf-8').astype(str),
+            'paths': np.char.decode(records['path'], 'utf-8').astype(str),
+            'mtimes': np.array(records['mtime']),
+            'sizes': np.array(records['size']),
+            'hashes': np.char.decode(records['sha1'], 'ascii').astype(str),
+        }
+
+
+def record_problem(label, path):
+    """Why a person label and image path do not fit a label-table record, or None."""
+    for name, value in (('label', label), ('path', path)):
+        limit = RECORD_DTYPE[name].itemsize
+        if len(str(value).encode('utf-8')) > limit:
+            return f"{name} longer than {limit} bytes"
+    return None
+
+
+def _records(labels, paths, hashes, mtimes, sizes):
+    records = np.zeros(len(labels), dtype=RECORD_DTYPE)
+    for name, values, encoding in (('label', labels, 'utf-8'), ('path', paths, 'utf-8'), ('sha1', hashes, 'ascii')):
+        encoded = [str(v).encode(encoding) for v in values]
+        limit = RECORD_DTYPE[name].itemsize
+        too_long = [v for v in encoded if len(v) > limit]
+        if too_long:
+            raise ValueError(f"{name} longer than {limit} bytes: {too_long[0]!r}")
+        records[name] = encoded
+    records['mtime'] = mtimes
+    records['size'] = sizes
+    return records
+
+
+def write_gallery_file(path, gallery, capacity=None):
+    """Write a complete gallery dict to a new file (temp file, then rename)."""
+    templates = np.asarray(gallery['templates'], dtype=np.float32)
+    count, dim = templates.shape
+    capacity = max(capacity or 0, count, MIN_CAPACITY)
+    table_offset, matrix_offset = _layout(capacity)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.truncate(matrix_offset + capacity * dim * 4)
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, dim, RECORD_DTYPE.itemsize, 0,
+                            count, capacity, table_offset, matrix_offset))
+        f.seek(table_offset)
+        f.write(_records(gallery['labels'], gallery['paths'], gallery['hashes'],
+                         gallery['mtimes'], gallery['sizes']).tobytes())
+        f.seek(matrix_offset)
+        f.write(np.ascontiguousarray(templates).tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def append_gallery_file(path, gallery):
+    """
+    Append the rows of a gallery dict to an existing file in place, growing
+    (rewriting) the file only when its reserved capacity is exhausted.
+    """
+    templates = np.asarray(gallery['templates'], dtype=np.float32)
+    if len(templates) == 0:
+        return
+    current = GalleryFile(path, mode='r+')
+    start, end = current.count, current.count + len(templates)
+    if end > current.capacity:
+        merged = current.as_gallery()
+        merged = {key: np.concatenate([merged[key], gallery[key]]) for key in merged}
+        del current
+        write_gallery_file(path, merged, capacity=max(2 * end, MIN_CAPACITY))
+        return
+    current._table[start:end] = _records(gallery['labels'], gallery['paths'], gallery['hashes'],
+                                         gallery['mtimes'], gallery['sizes'])
+    current._matrix[start:end] = templates
+    current._table.flush()
+    current._matrix.flush()
+    # Commit point: readers only see the new rows once count is updated
+    with open(path, 'r+b') as f:
+        f.seek(struct.calcsize('<8sIIII'))
+        f.write(struct.pack('<Q', end))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def read_gallery_file(path):
+    """Open a gallery file read-only and return its gallery dict, or None if missing."""
+    if not os.path.exists(path):
+        return None
+    return GalleryFile(path).as_gallery()
@@ -0,0 +1,177 @@
+# keypoint_gallery.py
+# Keypoint matching mode for the matcher service. ORB/SIFT keypoints and
+# descriptors are detected once per enrolled image and cached on disk; a probe
+# is matched against all cached descriptors at once through a single
+# brute-force or FLANN index, and each gallery image gets one vote per probe
+# descriptor that finds it among its nearest neighbours.
+
+import os
+import cv2
+import numpy as np
+from matcher import detect_keypoints, KEYPOINT_METHODS
+from gallery import gallery_version
+from utils import save_npz_atomic
+
+# FLANN index parameters (cv2.flann): LSH for binary ORB descriptors,
+# randomized kd-trees for float SIFT descriptors
+FLANN_INDEX_KDTREE = 1
+FLANN_INDEX_LSH = 6
+FLANN_MIN_DESCRIPTORS = 2000  # Exact brute-force matching only below this (a few images)
+KNN = 2
+ORB_MAX_DISTANCE = 40  # Hamming distance accepted as a vote
+SIFT_RATIO = 1.25  # A neighbour votes if within this factor of the best distance
+
+
+def keypoint_cache_path(gallery_path, method):
+    """Descriptor cache stored next to the gallery file."""
+    return f"{os.path.splitext(gallery_path)[0]}.{method}.npz"
+
+
+class KeypointGallery:
+    """
+    Cached keypoints of every enrolled image, with one descriptor index over
+    all of them. Image i owns descriptors offsets[i]:offsets[i + 1].
+    """
+
+    def __init__(self, method='orb', n_features=500, flann_min=FLANN_MIN_DESCRIPTORS):
+        if method not in KEYPOINT_METHODS:
+            raise ValueError(f"Unknown keypoint method: {method}")
+        self.method = method
+        self.n_features = n_features
+        self.flann_min = flann_min
+        self.labels = np.zeros(0, dtype=str)
+        self.hashes = np.zeros(0, dtype=str)
+        self.points = np.zeros((0, 2), dtype=np.float32)
+        self.descriptors = None
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.matcher = None
+        self.version = None
+
+    @classmethod
+    def from_gallery(cls, gallery, cache_path, method='orb', n_features=500, verbose=True):
+        """
+        Keypoints for every image of a gallery dict (gallery.py). Images whose
+        content hash is already in cache_path are not re-detected; the cache
+        is rewritten when anything changed.
+        """
+        self = cls(method, n_features)
+        cached = {}
+        if os.path.exists(cache_path):
+            with np.load(cache_path, allow_pickle=False) as data:
+                if str(data['method']) == method and int(data['n_features']) == n_features:
+                    # Each data[...] access reads the whole array again, so read them once
+                    offsets, points, descriptors = data['offsets'], data['points'], data['descriptors']
+                    for i, digest in enumerate(data['hashes']):
+                        rows = slice(offsets[i], offsets[i + 1])
+                        cached[str(digest)] = (points[rows], descriptors[rows])
+        points, descriptors = [], []
+        detected = 0
+        for path, digest in zip(gallery['paths'], gallery['hashes']):
+            features = cached.get(str(digest))
+            if features is None:
+                image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE)
+                if image is None:
+                    features = detect_keypoints(np.zeros((1, 1), np.uint8), method, n_features)
+                    if verbose:
+                        print(f"Failed to read {path}; enrolled without keypoints")
+                else:
+                    features = detect_keypoints(image, method, n_features)
+                detected += 1
+            points.append(features[0])
+            descriptors.append(features[1])
+        self.labels = np.asarray(gallery['labels'], dtype=str)
+        self.hashes = np.asarray(gallery['hashes'], dtype=str)
+        self.version = f"{method}:{gallery_version(gallery)}"
+        self._set(points, descriptors)
+        # Duplicate images share one cache entry, so compare with the distinct hashes
+        if detected or len(cached) != len(set(self.hashes)):
+            self.save(cache_path)
+        if verbose:
+            print(f"Keypoints ({method}): {len(self.hashes)} images, {len(self.descriptors)} descriptors "
+                  f"({detected} detected, {len(self.hashes) - detected} cached)")
+        return self
+
+    def _set(self, points, descriptors):
+        sizes = [len(d) for d in descriptors]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.points = np.concatenate(points) if points else np.zeros((0, 2), np.float32)
+        width, dtype = (128, np.float32) if self.method == 'sift' else (32, np.uint8)
+        self.descriptors = np.concatenate(descriptors) if descriptors else np.zeros((0, width), dtype)
+        self.owner = np.repeat(np.arange(len(sizes)), sizes)
+        self.persons, self.label_ids = np.unique(self.labels, return_inverse=True)
+        self.matcher = self._build_matcher()
+
+    def _build_matcher(self):
+        if len(self.descriptors) == 0:
+            return None
+        if len(self.descriptors) >= self.flann_min:
+            if self.method == 'orb':
+                params = dict(algorithm=FLANN_INDEX_LSH, table_number=6, key_size=12, multi_probe_level=1)
+            else:
+                params = dict(algorithm=FLANN_INDEX_KDTREE, trees=4)
+            matcher = cv2.FlannBasedMatcher(params, dict(checks=50))
+        else:
+            matcher = cv2.BFMatcher(cv2.NORM_L2 if self.method == 'sift' else cv2.NORM_HAMMING)
+        matcher.add([self.descriptors])
+        matcher.train()
+        return matcher
+
+    def save(self, cache_path):
+        save_npz_atomic(cache_path, method=np.array(self.method), n_features=np.array(self.n_features),
+                        hashes=self.hashes, points=self.points, descriptors=self.descriptors, offsets=self.offsets)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def image_features(self, i):
+        """(points, descriptors) of enrolled image i."""
+        rows = slice(self.offsets[i], self.offsets[i + 1])
+        return self.points[rows], self.descriptors[rows]
+
+    def image_votes(self, probe_descriptors):
+        """
+        Votes per enrolled image: each probe descriptor votes once for every
+        image among its KNN nearest gallery descriptors that passes the
+        method's acceptance test.
+        """
+        votes = np.zeros(len(self.hashes), dtype=np.float32)
+        if self.matcher is None or len(probe_descriptors) == 0:
+            return votes
+        for neighbours in self.matcher.knnMatch(probe_descriptors, k=KNN):
+            if not neighbours:
+                continue
+            best = neighbours[0].distance
+            voted = set()
+            for m in neighbours:
+                image = self.owner[m.trainIdx]
+                if image in voted:
+                    continue
+                if self.method == 'orb':
+                    accepted = m.distance < ORB_MAX_DISTANCE
+                else:
+                    accepted = m.distance <= SIFT_RATIO * best
+                if accepted:
+                    voted.add(image)
+                    votes[image] += 1
+        return votes
+
+    def person_scores(self, probe_image):
+        """
+        Best image score per person (aligned with self.persons): the fraction
+        of the probe's descriptors that voted for that image.
+        """
+        _, descriptors = detect_keypoints(probe_image, self.method, self.n_features)
+        votes = self.image_votes(descriptors) / max(len(descriptors), 1)
+        per_person = np.zeros(len(self.persons), dtype=np.float32)
+        np.maximum.at(per_person, self.label_ids, votes)
+        return per_person
+
+    def identify(self, probe_image, k=2):
+        """Rank a grayscale probe image; returns (ranked, margin) like GalleryIndex.identify."""
+        per_person = self.person_scores(probe_image)
+        order = np.argsort(-per_person, kind='stable')[:max(k, 2)]
+        ranked = [(str(self.persons[i]), float(per_person[i])) for i in order]
+        if not ranked:
+            return [], 0.0
+        runner_up = ranked[1][1] if len(ranked) > 1 else 0.0
+        return ranked[:k], ranked[0][1] - runner_up
@@ -4,123 +4,133 @@
 
 import os
 import cv2
+from feature_extraction import extract_features, prepare_image
+from gallery import build_gallery, load_gallery, gallery_version, GalleryIndex, GALLERY_PATH
+from ann_index import IVFIndex, save_index, load_index
+from keypoint_gallery import KeypointGallery, keypoint_cache_path
+from cascade import CascadeIdentifier
+from alignment import AlignmentGallery, AlignedIdentifier
+from scan_watcher import ScanWatcher
+from publisher import ResultPublisher, image_fields
+from metrics import Metrics, MetricsReporter, SignalProfiler
+from quality import assess_quality
+from result_cache import ResultCache, CACHE_COUNTERS
 import numpy as np
-from feature_extraction import extract_features
-import requests
-import base64
+import queue
 import time
 
-# Path to the latest scanned fingerprint (from scanbmp.py)
-INPUT_SCAN_PATH = os.path.join('scans', 'input_scan.bmp')
+# Folder and file prefix of the captures written by scanbmp.py
+SCANS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'scans')
+SCAN_PREFIX = 'fingerprint_'
 DATASET_DIR = 'dataset'
 MATCH_THRESHOLD = 0.65  # More permissive base threshold
 DISTINCTIVENESS_THRESHOLD = 0.05  # Minimum difference from second-best match
+ENFORCE_DISTINCTIVENESS = False  # Also require the margin above before accepting a match
+IVF_MIN_TEMPLATES = 20000  # Gallery size from which an IVF index beats exact search (benchmark.py ann)
+IVF_NPROBE = 8  # IVF cells scored per probe; higher is slower but closer to exact
+TEMPLATE_DTYPE = 'float32'  # In-memory template storage: 'float32', 'float16' or 'int8'
+IMAGE_MODE = 'full'  # Image sent with each result: 'full' BMP, 'thumbnail' or scan 'id' only
+# 'template' scores block-statistics vectors; 'orb' or 'sift' votes with cached
+# keypoint descriptors (keypoint_gallery.py), slower but more robust to distortion;
+# 'cascade' shortlists by template score and verifies geometrically (cascade.py);
+# 'aligned' scores the template shortlist again after aligning the probe (alignment.py)
+MATCH_MODE = 'template'
+CASCADE_METHOD = 'orb'  # Keypoints used to verify the cascade shortlist
+CASCADE_THRESHOLD = 0.5  # Minimum fused match probability
+# Minimum cosine score of a template match: the 0.70 the matcher used before it
+# was configurable. On distorted_dataset/ genuine template scores run from 0.83
+# to 0.94 and impostor scores from 0.74 to 0.87, all above it, so it only turns
+# away inputs unlike any enrolled print (blank or non-finger captures); the
+# ranking decides who it is.
+TEMPLATE_MATCH_THRESHOLD = 0.70
+# Minimum keypoint score (fraction of probe descriptors voting for the best
+# image), above the 90th percentile of impostor scores on distorted_dataset/
+KEYPOINT_MATCH_THRESHOLDS = {'orb': 0.03, 'sift': 0.22}
+# Stage timings and counters (metrics.py): written to METRICS_PATH every
+# METRICS_INTERVAL seconds, and served at http://127.0.0.1:<METRICS_PORT>/metrics
+# if a port is set. With PROFILE_ON_SIGNAL, SIGUSR1 (Ctrl+Break on Windows)
+# starts and stops a cProfile capture saved to PROFILE_DIR.
+METRICS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.json')
+METRICS_INTERVAL = 10.0
+METRICS_PORT = None
+PROFILE_ON_SIGNAL = True
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'profiles')
+# Captures failing quality.assess_quality are not matched or sent to the API
+QUALITY_GATE = True
+WARM_UP_SHAPE = (288, 256)  # Sensor frame (rows, columns) of the warm-up probe
+# Repeat presentations are answered from a result cache (result_cache.py) of
+# this many entries (0 disables it), each valid for RESULT_CACHE_TTL seconds
+RESULT_CACHE_SIZE = 128
+RESULT_CACHE_TTL = 60.0
+METRICS = Metrics(counters=('scans', 'matches', 'unknowns', 'rejected', 'errors') + CACHE_COUNTERS)
+RESULT_CACHE = ResultCache(RESULT_CACHE_SIZE, RESULT_CACHE_TTL, metrics=METRICS)
 
-def load_and_compare_fingerprint(image_path1, image_path2):
+# --- Matching ---
+
+def quality_gate(probe, metrics=METRICS):
     """
-    Load and compare two fingerprint images using template-based feature vectors.
+    Assess a capture before matching. Returns None if it may be matched,
+    otherwise its QualityResult (score and reasons), after logging and
+    counting the rejection; the caller should ask for a recapture.
     """
-    # Load images
-    img1 = cv2.imread(image_path1, cv2.IMREAD_GRAYSCALE)
-    img2 = cv2.imread(image_path2, cv2.IMREAD_GRAYSCALE)
-    
-    if img1 is None or img2 is None:
-        return 0.0
-    
-    # Extract feature vectors
-    features1 = extract_features(img1)
-    features2 = extract_features(img2)
-    
-    # --- Calculate Similarity Score using Cosine Similarity ---
-    # This is the standard way to compare two normalized feature vectors.
-    # A score of 1.0 means the vectors are identical.
-    # A score of 0.0 means they are completely different.
-    
-    dot_product = np.dot(features1, features2)
-    norm1 = np.linalg.norm(features1)
-    norm2 = np.linalg.norm(features2)
-    
-    # Avoid division by zero
-    if norm1 == 0 or norm2 == 0:
-        return 0.0
-        
-    similarity = dot_product / (norm1 * norm2)
-                  
-    return similarity
-
-# --- Main Watcher Loop ---
-
-def get_file_mtime(path):
-    try:
-        return os.path.getmtime(path)
-    except Exception:
+    with metrics.stage('quality'):
+        quality = assess_quality(probe)
+    if quality.ok or not QUALITY_GATE:
         return None
+    metrics.increment('rejected')
+    print(f"Capture rejected (quality {quality.score:.2f}: {', '.join(quality.reasons)}). Please scan again.")
+    return quality
 
-print("Watching for new input_scan.bmp files in scans/ ... Press Ctrl+C to stop.")
-last_mtime = get_file_mtime(INPUT_SCAN_PATH)
-while True:
-    time.sleep(1)
-    mtime = get_file_mtime(INPUT_SCAN_PATH)
-    if mtime is None or mtime == last_mtime:
-        continue
-    last_mtime = mtime
-    print(f"\nNew scan detected at {time.ctime(mtime)}. Matching...")
-    if not os.path.exists(INPUT_SCAN_PATH):
-        print(f"Input scan file not found: {INPUT_SCAN_PATH}")
-        continue
-    print("Successfully found input scan")
-    
-    dataset_root = os.path.join(os.path.dirname(__file__), DATASET_DIR)
-    print(f"Searching in dataset: {dataset_root}")
-    
-    if not os.path.exists(dataset_root):
-        print(f"Dataset directory {dataset_root} does not exist!")
-        continue
-        
-    people_found = os.listdir(dataset_root)
-    print(f"Found people: {people_found}")
+def identify_probe(probe, gallery, metrics=METRICS):
+    """
+    Identify a grayscale probe image against the gallery (a GalleryIndex,
+    KeypointGallery, CascadeIdentifier or AlignedIdentifier). Returns (best_person, best_score, sorted_scores, margin);
+    best_person is "Unknown" when the best candidate is not confident enough.
+    The preprocess, extract, score and decide stages are timed into metrics.
+    """
+    if isinstance(gallery, CascadeIdentifier):
+        sorted_scores, margin = gallery.identify(probe)
+        timings = gallery.last_timings
+        if 'total' in timings:
+            metrics.observe('extract', timings['features'] + timings['keypoints'])
+            metrics.observe('score', timings['shortlist'] + timings['verify'])
+        threshold = CASCADE_THRESHOLD
+    elif isinstance(gallery, AlignedIdentifier):
+        sorted_scores, margin = gallery.identify(probe)
+        timings = gallery.last_timings
+        metrics.observe('extract', timings['features'])
+        metrics.observe('align', timings['align'])
+        metrics.observe('score', timings['shortlist'] + timings['rescore'])
+        threshold = TEMPLATE_MATCH_THRESHOLD
+    elif isinstance(gallery, KeypointGallery):
+        # Keypoint detection happens inside identify, so it counts as scoring
+        with metrics.stage('score'):
+            sorted_scores, margin = gallery.identify(probe)
+        threshold = KEYPOINT_MATCH_THRESHOLDS[gallery.method]
+    else:
+        with metrics.stage('preprocess'):
+            prepared = prepare_image(probe)
+        with metrics.stage('extract'):
+            features = extract_features(prepared, prepared=True)
+        with metrics.stage('score'):
+            sorted_scores, margin = gallery.identify(features)
+        threshold = TEMPLATE_MATCH_THRESHOLD
 
-    start_time = time.time()
-    
-    scores_per_person = {}
-
-    for person in people_found:
-        person_dir = os.path.join(dataset_root, person)
-        if not os.path.isdir(person_dir):
-            continue
-            
-        print(f"Checking fingerprints for {person}...")
-        max_score_for_person = 0
-        for fp_file in os.listdir(person_dir):
-            if not fp_file.endswith('.bmp'):
-                continue
-                
-            fp_path = os.path.join(person_dir, fp_file)
-            try:
-                score = load_and_compare_fingerprint(INPUT_SCAN_PATH, fp_path)
-                
-                if score > max_score_for_person:
-                    max_score_for_person = score
-                    
-            except Exception as e:
-                print(f"Error processing {fp_path}: {e}")
-                continue
-        
-        if max_score_for_person > 0:
-            scores_per_person[person] = max_score_for_person
+    with metrics.stage('decide'):
+        return decide(sorted_scores, margin, threshold)
 
+def decide(sorted_scores, margin, threshold):
+    """Accept the best candidate if it clears threshold (and the margin, if enforced)."""
     best_person = "Unknown"
     best_score = 0
-    sorted_scores = []
 
-    # Analyze the collected scores to find the best match
-    if scores_per_person:
-        # Sort by score descending
-        sorted_scores = sorted(scores_per_person.items(), key=lambda item: item[1], reverse=True)
+    # Analyze the ranked scores to find the best match
+    if sorted_scores:
         best_person_candidate, best_score_candidate = sorted_scores[0]
+        distinct = margin >= DISTINCTIVENESS_THRESHOLD or not ENFORCE_DISTINCTIVENESS
         
-        # If confidence is above 70%, consider it a match
-        if best_score_candidate >= 0.70:
+        # If confidence is above the threshold (70% for templates), consider it a match
+        if best_score_candidate >= threshold and distinct:
             best_person = best_person_candidate
             best_score = best_score_candidate
         else:
@@ -128,60 +138,188 @@ while True:
             best_person = "Unknown"
             best_score = best_score_candidate
 
-    end_time = time.time()
-    latency = end_time - start_time
-    print(f"Matching completed in {latency:.4f} seconds.")
-
-    # Convert input scan to base64
-    try:
-        with open(INPUT_SCAN_PATH, "rb") as img_file:
-            img_b64 = 'data:image/bmp;base64,' + base64.b64encode(img_file.read()).decode("utf-8")
-    except Exception as e:
-        print(f"Failed to read image for base64: {e}")
-        img_b64 = None
+    return best_person, best_score, sorted_scores, margin
 
+def report_result(best_person, best_score, sorted_scores, margin, latency, fields, publisher):
+    """
+    Log a decision and hand it to the publisher; fields holds the image part of
+    the payload (see publisher.image_fields). Never blocks on the network.
+    """
     if best_person != "Unknown":
         print(f"\nMATCH FOUND!")
         print(f"Person: {best_person}")
-        print(f"Confidence: {best_score:.2%}")
-        
-        # Send success match to API
-        try:
-            response = requests.post(
-                'http://10.21.55.109:8080/fingerprint',
-                json={
-                    "name": best_person,
-                    "fingerprint_img": img_b64,
-                    "score": float(best_score),
-                    "matched": True,
-                    "latency": latency
-                },
-                timeout=5
-            )
-            print(f"API response: {response.status_code}")
-        except Exception as e:
-            print(f"Failed to send API request: {e}")
+        print(f"Confidence: {best_score:.2%} (margin to runner-up: {margin:.2%})")
     else:
         print("\nNo match found.")
-        if scores_per_person:
+        if sorted_scores:
             # Log the best candidate even if it wasn't a confident match
             best_candidate_person, best_candidate_score = sorted_scores[0]
-            print(f"Best candidate was {best_candidate_person} with confidence {best_candidate_score:.2%}, but it was not distinct or confident enough.")
-            
-        # Send no match to API
+            print(f"Best candidate was {best_candidate_person} with confidence {best_candidate_score:.2%} (margin {margin:.2%}), but it was not distinct or confident enough.")
+
+    publisher.publish({
+        "name": best_person,
+        **fields,
+        "score": float(best_score),
+        "matched": best_person != "Unknown",
+        "latency": latency
+    })
+
+def process_scan(scan_path, gallery, publisher, metrics=METRICS, cache=RESULT_CACHE):
+    """
+    Identify one capture file against the loaded gallery and queue the result for the API.
+    A repeat of a recent capture is answered from the result cache; since
+    only accepted captures are cached, the quality gate runs on misses only.
+    """
+    start_time = time.time()
+    metrics.increment('scans')
+
+    with metrics.stage('decode'):
+        try:
+            with open(scan_path, "rb") as img_file:
+                bmp_bytes = img_file.read()
+        except OSError as e:
+            print(f"Failed to read input scan {scan_path}: {e}")
+            metrics.increment('errors')
+            return
+        probe = cv2.imdecode(np.frombuffer(bmp_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if probe is None:
+        print(f"Failed to decode input scan: {scan_path}")
+        metrics.increment('errors')
+        return
+    with metrics.stage('cache'):
+        decision, key = cache.lookup(probe, gallery.version)
+    cached = decision is not None
+    if not cached:
+        if quality_gate(probe, metrics) is not None:
+            return
+        decision = identify_probe(probe, gallery, metrics)
+        cache.store(key, decision)
+    best_person, best_score, sorted_scores, margin = decision
+    metrics.increment('unknowns' if best_person == "Unknown" else 'matches')
+
+    end_time = time.time()
+    latency = end_time - start_time
+    metrics.observe('total', latency * 1000)
+    print(f"Matching completed in {latency:.4f} seconds{' (cached result)' if cached else ''}.")
+
+    with metrics.stage('publish'):
+        scan_id = os.path.splitext(os.path.basename(scan_path))[0]
+        fields = image_fields(IMAGE_MODE, bmp_bytes=bmp_bytes, image=probe, scan_id=scan_id)
+        report_result(best_person, best_score, sorted_scores, margin, latency, fields, publisher)
+
+# --- Main Watcher Loop ---
+
+def load_gallery_index(enroll=True):
+    """
+    Enroll the dataset (only new or modified images are re-extracted) and
+    return it as a GalleryIndex, as a KeypointGallery when MATCH_MODE is
+    'orb' or 'sift', or as a CascadeIdentifier or AlignedIdentifier. With enroll=False the existing gallery file
+    is only memory-mapped, so extra matcher workers start without touching
+    the dataset and share the page-cache copy of the templates.
+    """
+    dataset_root = os.path.join(os.path.dirname(__file__), DATASET_DIR)
+    gallery_path = os.path.join(os.path.dirname(__file__), GALLERY_PATH)
+    if enroll:
+        if not os.path.exists(dataset_root):
+            raise SystemExit(f"Dataset directory {dataset_root} does not exist!")
+        enrolled = build_gallery(dataset_root, gallery_path, workers=os.cpu_count())
+    else:
+        enrolled = load_gallery(gallery_path)
+        if enrolled is None:
+            raise SystemExit(f"Gallery file {gallery_path} does not exist!")
+    if MATCH_MODE in ('orb', 'sift'):
+        # Descriptors are cached next to the gallery, keyed by image hash
+        gallery = KeypointGallery.from_gallery(enrolled, keypoint_cache_path(gallery_path, MATCH_MODE), MATCH_MODE)
+        print(f"Loaded {MATCH_MODE} keypoint gallery for people: {list(gallery.persons)}")
+        return gallery
+    index = None
+    if len(enrolled['templates']) >= IVF_MIN_TEMPLATES:
+        # Approximate search once exhaustive scoring gets expensive (see benchmark.py ann)
+        index = load_ivf_index(enrolled, keypoint_cache_path(gallery_path, 'ivf'))
+    gallery = GalleryIndex.from_gallery(enrolled, index=index, template_dtype=TEMPLATE_DTYPE)
+    if MATCH_MODE == 'cascade':
+        keypoints = KeypointGallery.from_gallery(enrolled, keypoint_cache_path(gallery_path, CASCADE_METHOD),
+                                                 CASCADE_METHOD)
+        gallery = CascadeIdentifier(gallery, keypoints)
+    elif MATCH_MODE == 'aligned':
+        maps = AlignmentGallery.from_gallery(enrolled, keypoint_cache_path(gallery_path, 'align'))
+        gallery = AlignedIdentifier(gallery, maps)
+    print(f"Loaded gallery for people: {list(gallery.persons)}")
+    return gallery
+
+def load_ivf_index(enrolled, index_path):
+    """
+    The IVF index of a gallery dict: loaded from index_path if it was built
+    for this enrollment (gallery_version), otherwise built (k-means) and
+    saved there for the next start and the other matcher workers.
+    """
+    n = len(enrolled['templates'])
+    nlist = int(np.sqrt(n))
+    version = gallery_version(enrolled)
+    index = None
+    if os.path.exists(index_path):
         try:
-            response = requests.post(
-                'http://10.21.55.109:8080/fingerprint',
-                json={
-                    "name": "Unknown",
-                    "fingerprint_img": img_b64,
-                    "score": float(best_score),
-                    "matched": False,
-                    "latency": latency
-                },
-                timeout=5
-            )
-            print(f"API response: {response.status_code}")
-        except Exception as e:
-            print(f"Failed to send API request: {e}")
+            index = load_index(index_path)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Ignoring unreadable index {index_path}: {e}")
+    if not isinstance(index, IVFIndex) or index.version != version or index.nlist != nlist or len(index) != n:
+        t0 = time.perf_counter()
+        index = IVFIndex(nlist=nlist).build(enrolled['templates'])
+        save_index(index, index_path, version)
+        print(f"Built IVF index ({nlist} cells) in {time.perf_counter() - t0:.1f} s")
+    index.nprobe = IVF_NPROBE
+    return index
+
+def warm_up(gallery):
+    """
+    Identify one synthetic probe so that lazy imports, detector construction
+    and the first reads of the memory-mapped gallery happen now rather than
+    on the first real scan. Not recorded in METRICS.
+    """
+    t0 = time.perf_counter()
+    probe = np.random.default_rng(0).integers(0, 256, WARM_UP_SHAPE, dtype=np.uint8)
+    identify_probe(probe, gallery, Metrics())
+    print(f"Warm-up done in {(time.perf_counter() - t0) * 1000:.0f} ms")
+
+def main():
+    gallery = load_gallery_index()
+    warm_up(gallery)
+
+    # Every capture from scanbmp.py gets its own fingerprint_<uuid>.bmp, renamed
+    # into place once complete, so each one is queued and matched in order.
+    watcher = ScanWatcher(SCANS_DIR, prefix=SCAN_PREFIX).start()
+    publisher = ResultPublisher().start()
+    reporter = MetricsReporter(METRICS, METRICS_PATH, METRICS_INTERVAL, METRICS_PORT).start()
+    profiler = SignalProfiler(PROFILE_DIR)
+    if PROFILE_ON_SIGNAL and profiler.install():
+        print(f"Send signal {profiler.signum} to process {os.getpid()} to start/stop profiling")
+    if reporter.server is not None:
+        print(f"Metrics at http://127.0.0.1:{reporter.port}/metrics")
+    print(f"Ready. Watching for new captures in {SCANS_DIR} ({watcher.mode}) ... Press Ctrl+C to stop.")
+    try:
+        while True:
+            try:
+                # Short timeout keeps Ctrl+C responsive on Windows
+                scan_path, detected_at = watcher.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            # Detection stage: from the watcher seeing the file to it being picked up
+            queued_ms = (time.perf_counter() - detected_at) * 1000
+            METRICS.observe('detect', queued_ms)
+            print(f"\nNew scan detected: {os.path.basename(scan_path)} "
+                  f"({queued_ms:.1f} ms in queue). Matching...")
+            try:
+                process_scan(scan_path, gallery, publisher)
+            except Exception as e:
+                METRICS.increment('errors')
+                print(f"Failed to process {scan_path}: {e!r}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        profiler.stop()
+        watcher.stop()
+        publisher.stop(timeout=10)
+        reporter.stop()
 
+if __name__ == "__main__":
+    main()
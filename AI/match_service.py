@@ -0,0 +1,374 @@
+# match_service.py
+# Matching as a local service for several scanner stations. An asyncio front
+# end takes probes (encoded image bytes or grayscale arrays) and answers with
+# ranked identities. Concurrent probes are collected into batches, and each
+# batch runs in a pool of worker processes that memory-map the same gallery
+# file; in template mode a whole batch is scored with one matrix product.
+# Repeats of recent probes are answered by the front end from a result cache.
+# Batching can only pay off with several cores: it saves per-batch overhead,
+# while the per-probe feature extraction (~4 ms) dominates. On a single core
+# (benchmark.py service, template mode, 1 worker, 8 clients) runs vary from
+# 150 to 260 probes/s, and batches of 32 came out between 10% slower and 30%
+# faster than unbatched probes; more workers than cores is slower.
+# Usage: python match_service.py [--port 8765] [--workers N]
+#        then POST image bytes to http://127.0.0.1:8765/identify
+
+import os
+import json
+import time
+import asyncio
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import cv2
+import numpy as np
+import match_scan
+from gallery import GalleryIndex
+from feature_extraction import extract_features, prepare_image
+from metrics import Metrics
+from quality import assess_quality
+from result_cache import ResultCache, CACHE_COUNTERS
+
+HOST = '127.0.0.1'
+PORT = 8765
+BATCH_SIZE = 32  # Most probes scored together
+BATCH_WAIT = 0.002  # Seconds a batch stays open for more probes once the first arrives
+MAX_BODY = 16 * 2**20  # Largest accepted request body (bytes)
+
+_GALLERY = None  # Gallery of this worker process (see _init_worker)
+
+
+def _init_worker(match_mode, gallery=None):
+    """
+    Load the gallery into this process: memory-map the file the service
+    enrolled (match_scan.load_gallery_index(enroll=False)), or use the given
+    one. The worker is warmed up before it takes requests.
+    """
+    global _GALLERY
+    cv2.setNumThreads(1)
+    match_scan.MATCH_MODE = match_mode
+    _GALLERY = gallery if gallery is not None else match_scan.load_gallery_index(enroll=False)
+    match_scan.warm_up(_GALLERY)
+
+
+def _result(decision, timings, latency=None):
+    best_person, best_score, sorted_scores, margin = decision
+    return {'name': best_person, 'score': float(best_score), 'matched': best_person != "Unknown",
+            'ranked': [[person, float(score)] for person, score in sorted_scores],
+            'margin': float(margin), 'timings': timings}
+
+
+def _decode(probe):
+    """Grayscale image of encoded bytes or an array; None if unreadable."""
+    if isinstance(probe, (bytes, bytearray, memoryview)):
+        probe = cv2.imdecode(np.frombuffer(probe, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if probe is None or np.asarray(probe).size == 0:
+        return None
+    return probe
+
+
+def _rejected(quality, timings):
+    return {'name': "Unknown", 'score': 0.0, 'matched': False, 'rejected': True, 'quality': quality.score,
+            'reasons': quality.reasons, 'timings': timings}
+
+
+def _identify_batch(probes):
+    """
+    Identify a list of probes (bytes or arrays) with this process's gallery.
+    Returns one result dict per probe, or {'error': message} for a probe
+    that could not be decoded or matched. Probes failing the quality gate
+    (match_scan.QUALITY_GATE) are not matched: their result has
+    rejected=True and the reasons, and the station should scan again.
+    """
+    results = [None] * len(probes)
+    images = []
+    t0 = time.perf_counter()
+    for i, probe in enumerate(probes):
+        image = _decode(probe)
+        if image is None:
+            results[i] = {'error': 'not a readable image'}
+        else:
+            images.append((i, image))
+    decode_ms = (time.perf_counter() - t0) * 1000 / max(len(probes), 1)
+
+    if match_scan.QUALITY_GATE and images:
+        t0 = time.perf_counter()
+        passed, failed = [], []
+        for i, image in images:
+            try:
+                quality = assess_quality(image)
+            except Exception as e:
+                results[i] = {'error': repr(e)}
+                continue
+            if quality.ok:
+                passed.append((i, image))
+            else:
+                failed.append((i, quality))
+        quality_ms = (time.perf_counter() - t0) * 1000 / len(images)
+        base_timings = {'decode': decode_ms, 'quality': quality_ms}
+        for i, quality in failed:
+            results[i] = _rejected(quality, base_timings)
+        images = passed
+    else:
+        base_timings = {'decode': decode_ms}
+
+    if isinstance(_GALLERY, GalleryIndex):
+        # Extract every probe (a failing one only fails its own result), then
+        # score the whole batch in one product
+        t0 = time.perf_counter()
+        extracted, features = [], []
+        for i, image in images:
+            try:
+                features.append(extract_features(prepare_image(image), prepared=True))
+            except Exception as e:
+                results[i] = {'error': repr(e)}
+                continue
+            extracted.append(i)
+        t1 = time.perf_counter()
+        ranked = _GALLERY.identify_batch(np.array(features, dtype=np.float32)) if extracted else []
+        t2 = time.perf_counter()
+        timings = {**base_timings, 'extract': (t1 - t0) * 1000 / max(len(images), 1),
+                   'score': (t2 - t1) * 1000 / max(len(extracted), 1)}
+        for i, (sorted_scores, margin) in zip(extracted, ranked):
+            decision = match_scan.decide(sorted_scores, margin, match_scan.TEMPLATE_MATCH_THRESHOLD)
+            results[i] = _result(decision, timings)
+        return results
+
+    for i, image in images:
+        metrics = Metrics()
+        try:
+            decision = match_scan.identify_probe(image, _GALLERY, metrics)
+        except Exception as e:
+            results[i] = {'error': repr(e)}
+            continue
+        timings = {name: samples[0] for name, samples in metrics.stages.items()}
+        results[i] = _result(decision, {**base_timings, **timings})
+    return results
+
+
+class MatchService:
+    """
+    Batched identification over a worker pool. Up to `workers` batches run
+    at once, one per worker; probes that arrive while all workers are busy
+    wait in the queue and go out together in the next batch. With
+    workers <= 1 batches run on a thread of this process instead. Probes are
+    decoded here and looked up in a result cache of cache_size entries
+    (match_scan.RESULT_CACHE_SIZE) first; only misses are queued. Decoding
+    and the cache lookup run on the default thread pool, not the event loop.
+    Measured throughput and what it depends on are in the module comment.
+    """
+
+    def __init__(self, workers=None, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT, metrics=None,
+                 cache_size=None):
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.metrics = metrics or Metrics(counters=('requests', 'batches', 'matches', 'unknowns', 'rejected', 'errors')
+                                          + CACHE_COUNTERS)
+        self.cache = ResultCache(match_scan.RESULT_CACHE_SIZE if cache_size is None else cache_size,
+                                 match_scan.RESULT_CACHE_TTL, metrics=self.metrics)
+        self.gallery_version = None
+        self.queue = None
+        self.pool = None
+        self._slots = None
+        self._batcher = None
+        self._tasks = set()
+        self._server = None
+
+    async def start(self, enroll=True):
+        """Enroll the dataset once, then start the workers and the batcher."""
+        loop = asyncio.get_running_loop()
+        # Enrollment also writes the keypoint caches the workers will map
+        gallery = await loop.run_in_executor(None, match_scan.load_gallery_index, enroll)
+        self.gallery_version = gallery.version
+        if self.workers <= 1:
+            _init_worker(match_scan.MATCH_MODE, gallery)
+            self.pool = ThreadPoolExecutor(max_workers=1)
+        else:
+            # spawn: workers map the gallery file themselves instead of inheriting it
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                            initializer=_init_worker, initargs=(match_scan.MATCH_MODE,))
+            # Start (and warm up) every worker now rather than on the first requests
+            await asyncio.gather(*(loop.run_in_executor(self.pool, _identify_batch, [])
+                                   for _ in range(self.workers)))
+        self.queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(max(self.workers, 1))
+        self._batcher = asyncio.create_task(self._run_batcher())
+        return self
+
+    async def identify(self, probe):
+        """
+        Identify one probe (encoded image bytes or a grayscale array). Returns
+        a dict with name, score, matched, ranked [[person, score], ...],
+        margin, latency and per-stage timings, or {'error': message}.
+        A capture of too low quality comes back with rejected=True, its
+        quality score and the reasons instead of a ranking. A result answered
+        from the cache has cached=True.
+        """
+        self.metrics.increment('requests')
+        submitted = time.perf_counter()
+        image, result, key = await asyncio.get_running_loop().run_in_executor(None, self._lookup, probe)
+        if image is not None:
+            if result is not None:
+                latency = time.perf_counter() - submitted
+                self.metrics.increment('matches' if result['matched'] else 'unknowns')
+                self.metrics.observe('cache', latency * 1000)
+                self.metrics.observe('total', latency * 1000)
+                return {**result, 'cached': True, 'latency': latency, 'timings': {'cache': latency * 1000}}
+            probe = image
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((probe, future, submitted, key))
+        return await future
+
+    def _lookup(self, probe):
+        """(image, cached result, cache key) of a probe; image None if it cannot be decoded."""
+        image = _decode(probe)
+        if image is None:
+            return None, None, None
+        return (image,) + self.cache.lookup(image, self.gallery_version)
+
+    async def _run_batcher(self):
+        while True:
+            # Wait for a free worker first, so the queue keeps filling meanwhile
+            await self._slots.acquire()
+            batch = [await self.queue.get()]
+            deadline = time.perf_counter() + self.batch_wait
+            while len(batch) < self.batch_size:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            task = asyncio.create_task(self._run_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run_batch(self, batch):
+        try:
+            started = time.perf_counter()
+            for _, _, submitted, _ in batch:
+                self.metrics.observe('queue', (started - submitted) * 1000)
+            self.metrics.increment('batches')
+            self.metrics.observe('batch_size', len(batch))
+            try:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.pool, _identify_batch, [probe for probe, _, _, _ in batch])
+            except Exception as e:
+                results = [{'error': repr(e)}] * len(batch)
+            finished = time.perf_counter()
+            for (_, future, submitted, key), result in zip(batch, results):
+                if 'error' in result:
+                    self.metrics.increment('errors')
+                else:
+                    if not result.get('rejected'):
+                        self.cache.store(key, dict(result))
+                    self.metrics.increment('rejected' if result.get('rejected') else
+                                           'matches' if result['matched'] else 'unknowns')
+                    for stage, ms in result['timings'].items():
+                        self.metrics.observe(stage, ms)
+                    result['latency'] = finished - submitted
+                    self.metrics.observe('total', result['latency'] * 1000)
+                if not future.done():
+                    future.set_result(result)
+        finally:
+            self._slots.release()
+
+    async def serve(self, host=HOST, port=PORT):
+        """
+        Serve the local HTTP API: POST /identify with the image bytes as the
+        body returns the identify() result as JSON; GET /metrics returns the
+        metrics snapshot.
+        """
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    length = int(headers.get('content-length', 0))
+                except ValueError:
+                    length = -1
+                if length < 0:
+                    await self._respond(writer, 400, {'error': 'invalid Content-Length'})
+                    break
+                if length > MAX_BODY:
+                    await self._respond(writer, 413, {'error': 'request body too large'})
+                    break
+                body = await reader.readexactly(length) if length else b''
+                if method == 'POST' and path == '/identify':
+                    result = await self.identify(body)
+                    await self._respond(writer, 400 if 'error' in result else 200, result)
+                elif method == 'GET' and path == '/metrics':
+                    await self._respond(writer, 200, self.metrics.snapshot())
+                else:
+                    await self._respond(writer, 404, {'error': f'no route {method} {path}'})
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ValueError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, payload):
+        body = json.dumps(payload).encode()
+        reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 413: 'Payload Too Large'}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await writer.drain()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+async def _main(args):
+    service = await MatchService(workers=args.workers, batch_size=args.batch_size).start()
+    server = await service.serve(args.host, args.port)
+    print(f"Matching service on http://{args.host}:{args.port}/identify with {service.workers} workers "
+          f"({match_scan.MATCH_MODE} mode). Press Ctrl+C to stop.")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await service.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,33 @@
 # Uses OpenCV's BFMatcher with improved accuracy parameters
 
 import cv2
+import numpy as np
+from scipy.spatial import cKDTree
+
+KEYPOINT_METHODS = ('orb', 'sift')
+_DETECTORS = {}
+
+def detect_keypoints(image, method='orb', n_features=500):
+    """
+    Detect keypoints and compute descriptors on a grayscale image.
+    Returns (points, descriptors): an (N x 2) float32 array of keypoint
+    coordinates, which unlike cv2.KeyPoint can be stored, and the descriptor
+    matrix (uint8 for ORB, float32 for SIFT), with N == 0 if none were found.
+    """
+    key = (method, n_features)
+    if key not in _DETECTORS:
+        if method == 'sift':
+            _DETECTORS[key] = cv2.SIFT_create(nfeatures=n_features)
+        elif method == 'orb':
+            _DETECTORS[key] = cv2.ORB_create(nfeatures=n_features)
+        else:
+            raise ValueError(f"Unknown keypoint method: {method}")
+    keypoints, descriptors = _DETECTORS[key].detectAndCompute(image, None)
+    if descriptors is None:
+        width = 128 if method == 'sift' else 32
+        descriptors = np.zeros((0, width), dtype=np.float32 if method == 'sift' else np.uint8)
+    points = np.array([kp.pt for kp in keypoints], dtype=np.float32).reshape(-1, 2)
+    return points, descriptors
 
 def match_features(desc1, desc2, method='orb'):
     """
@@ -28,10 +55,16 @@ def match_features(desc1, desc2, method='orb'):
         good_matches = [m for m in matches if m.distance < 30]
         return good_matches
 
+def _point(keypoints, i):
+    # cv2.KeyPoint list, or an (N x 2) array of points from detect_keypoints
+    kp = keypoints[i]
+    return kp.pt if isinstance(kp, cv2.KeyPoint) else kp
+
 def calculate_match_confidence(desc1, desc2, good_matches, kp1, kp2, method='orb'):
     """
     Calculate a confidence score for the matches based on quality metrics and geometric verification.
     Returns a normalized confidence score between 0 and 1.
+    kp1/kp2 are cv2.KeyPoint lists or point arrays from detect_keypoints.
     """
     if len(good_matches) == 0:
         return 0.0
@@ -55,11 +88,10 @@ def calculate_match_confidence(desc1, desc2, good_matches, kp1, kp2, method='orb
     if len(good_matches) >= 4:  # Need at least 4 points for homography
         try:
             # Extract matched keypoint coordinates
-            src_pts = [kp1[m.queryIdx].pt for m in good_matches]
-            dst_pts = [kp2[m.trainIdx].pt for m in good_matches]
+            src_pts = [_point(kp1, m.queryIdx) for m in good_matches]
+            dst_pts = [_point(kp2, m.trainIdx) for m in good_matches]
             
             if len(src_pts) >= 4 and len(dst_pts) >= 4:
-                import numpy as np
                 src_pts = np.float32(src_pts).reshape(-1, 1, 2)
                 dst_pts = np.float32(dst_pts).reshape(-1, 1, 2)
                 
@@ -73,4 +105,145 @@ def calculate_match_confidence(desc1, desc2, good_matches, kp1, kp2, method='orb
     
     # Combine all factors: match ratio, distance quality, and geometric consistency
     confidence = (match_ratio * 0.3) + (distance_score * 0.3) + (geometric_score * 0.4)
-    return min(confidence, 1.0)
\ No newline at end of file
+    return min(confidence, 1.0)
+
+# --- Minutiae matching ---
+# Alignment-tolerant matching of minutiae templates (feature_extraction
+# extract_minutiae: x, y, theta, type). Every minutia forms triangles with
+# pairs of its nearest neighbours; the sorted side lengths, quantized to a
+# grid, are a rotation/translation invariant key. Triangle keys are kept
+# sorted, so the candidate triangle pairs of two templates are found by hash
+# bucket lookup (searchsorted) rather than by comparing all pairs. Each
+# candidate whose minutia orientations agree votes for a rigid alignment; the
+# winning one is used to pair up minutiae. Neighbours and pairing candidates
+# come from k-d trees (n log n), so no step builds an n x n distance matrix;
+# only the candidate triangle pairs grow faster, with the number of key
+# collisions between the two templates (about 4x for 2x the minutiae on
+# random templates, few for the ~60 minutiae of a real print).
+
+MINUTIAE_NEIGHBOURS = 4  # Nearest neighbours each minutia forms triangles with
+TRIANGLE_BIN = 4.0  # Side-length grid of the triangle keys (pixels)
+ROTATION_BIN = np.pi / 18  # Alignment vote bins: 10 degrees...
+TRANSLATION_BIN = 8.0  # ...and 8 pixels
+PAIR_DISTANCE = 12.0  # Aligned minutiae closer than this (pixels)...
+PAIR_ANGLE = np.pi / 8  # ...with orientations within this are paired
+_KEY_BITS = 20
+# Key offsets of the neighbouring buckets searched, for side lengths that
+# fall close to a grid line
+_KEY_DELTAS = [(d0 << 2 * _KEY_BITS) + (d1 << _KEY_BITS) + d2
+               for d0, d1, d2 in ((0, 0, 0), (-1, 0, 0), (1, 0, 0), (0, -1, 0), (0, 1, 0), (0, 0, -1), (0, 0, 1))]
+
+def minutiae_triangles(minutiae, k=MINUTIAE_NEIGHBOURS):
+    """
+    Triangle hash table of a minutiae template: (keys, vertices), sorted by
+    key. vertices[t] are the template rows of triangle t, ordered so that
+    the sides opposite them are shortest to longest.
+    """
+    n = len(minutiae)
+    if n < 3:
+        return np.zeros(0, np.int64), np.zeros((0, 3), np.int64)
+    points = minutiae[:, :2].astype(np.float64)
+    k = min(k, n - 1)
+    _, near = cKDTree(points).query(points, k + 1)
+    # Drop each minutia itself, which is not always first when points coincide
+    is_self = near == np.arange(n)[:, None]
+    near = np.take_along_axis(near, np.argsort(is_self, axis=1, kind='stable'), axis=1)[:, :k]
+    u, v = np.triu_indices(k, 1)
+    tri = np.stack([np.repeat(np.arange(n), len(u)), near[:, u].ravel(), near[:, v].ravel()], axis=1)
+    tri = np.unique(np.sort(tri, axis=1), axis=0)
+    p = points[tri]
+    opposite = np.stack([np.linalg.norm(p[:, 1] - p[:, 2], axis=1), np.linalg.norm(p[:, 0] - p[:, 2], axis=1),
+                         np.linalg.norm(p[:, 0] - p[:, 1], axis=1)], axis=1)
+    order = np.argsort(opposite, axis=1)
+    q = np.round(np.take_along_axis(opposite, order, axis=1) / TRIANGLE_BIN).astype(np.int64)
+    keys = (q[:, 0] << 2 * _KEY_BITS) + (q[:, 1] << _KEY_BITS) + q[:, 2]
+    vertices = np.take_along_axis(tri, order, axis=1)
+    by_key = np.argsort(keys, kind='stable')
+    return keys[by_key], vertices[by_key]
+
+def _candidate_pairs(probe_keys, gallery_keys):
+    """(probe, gallery) triangle index pairs whose keys fall in the same or a neighbouring bucket."""
+    a, b = [], []
+    for delta in _KEY_DELTAS:
+        lo = np.searchsorted(gallery_keys, probe_keys + delta, 'left')
+        hi = np.searchsorted(gallery_keys, probe_keys + delta, 'right')
+        counts = hi - lo
+        total = int(counts.sum())
+        if total == 0:
+            continue
+        a.append(np.repeat(np.arange(len(probe_keys)), counts))
+        starts = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        b.append(starts + np.arange(total))
+    if not a:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return np.concatenate(a), np.concatenate(b)
+
+def _angle_difference(a, b):
+    """Absolute difference of orientations modulo pi, in [0, pi/2]."""
+    d = np.mod(a - b, np.pi)
+    return np.minimum(d, np.pi - d)
+
+def match_minutiae(probe, gallery, gallery_triangles=None):
+    """
+    Number of paired minutiae between two minutiae templates after the best
+    rigid alignment. gallery_triangles can be precomputed with
+    minutiae_triangles(gallery) for templates matched many times.
+    """
+    if len(probe) < 3 or len(gallery) < 3:
+        return 0
+    gallery_keys, gallery_vertices = gallery_triangles or minutiae_triangles(gallery)
+    probe_keys, probe_vertices = minutiae_triangles(probe)
+    a, b = _candidate_pairs(probe_keys, gallery_keys)
+    if len(a) == 0:
+        return 0
+    pa = probe[probe_vertices[a]]  # (pairs, 3 vertices, x/y/theta/type)
+    pb = gallery[gallery_vertices[b]]
+    va, vb = pa[:, 2, :2] - pa[:, 0, :2], pb[:, 2, :2] - pb[:, 0, :2]
+    rotation = np.arctan2(vb[:, 1], vb[:, 0]) - np.arctan2(va[:, 1], va[:, 0])
+    rotation = np.mod(rotation + np.pi, 2 * np.pi) - np.pi
+    # Keep pairs whose three minutia orientations agree after the rotation
+    agree = (_angle_difference(pa[:, :, 2] + rotation[:, None], pb[:, :, 2]) < PAIR_ANGLE).all(axis=1)
+    if not agree.any():
+        return 0
+    pa, pb, rotation = pa[agree], pb[agree], rotation[agree]
+    c, s = np.cos(rotation), np.sin(rotation)
+    ca, cb = pa[:, :, :2].mean(axis=1), pb[:, :, :2].mean(axis=1)
+    shift = cb - np.stack([c * ca[:, 0] - s * ca[:, 1], s * ca[:, 0] + c * ca[:, 1]], axis=1)
+
+    # Vote in (rotation, translation) bins; the fullest bin is the alignment
+    bins = np.stack([np.round(rotation / ROTATION_BIN), np.round(shift[:, 0] / TRANSLATION_BIN),
+                     np.round(shift[:, 1] / TRANSLATION_BIN)], axis=1).astype(np.int64)
+    _, bin_ids, counts = np.unique(bins, axis=0, return_inverse=True, return_counts=True)
+    winners = bin_ids.ravel() == np.argmax(counts)
+    rotation = float(np.median(rotation[winners]))
+    shift = np.median(shift[winners], axis=0)
+
+    # Align the probe and pair minutiae greedily, closest first
+    c, s = np.cos(rotation), np.sin(rotation)
+    xy = probe[:, :2] @ np.array([[c, s], [-s, c]]) + shift
+    near = cKDTree(xy).sparse_distance_matrix(cKDTree(gallery[:, :2]), PAIR_DISTANCE, output_type='ndarray')
+    i, j, distance = near['i'], near['j'], near['v']
+    close = (distance < PAIR_DISTANCE) & (_angle_difference(probe[i, 2] + rotation, gallery[j, 2]) < PAIR_ANGLE)
+    i, j, distance = i[close], j[close], distance[close]
+    used_i, used_j = set(), set()
+    # Closest first; ties in (probe, gallery) row order
+    for t in np.lexsort((j, i, distance)):
+        if i[t] not in used_i and j[t] not in used_j:
+            used_i.add(i[t])
+            used_j.add(j[t])
+    return len(used_i)
+
+def minutiae_similarity(paired, n_probe, n_gallery):
+    """Paired count normalized to [0, 1]: paired^2 / (n_probe * n_gallery)."""
+    return paired * paired / max(n_probe * n_gallery, 1)
+
+def match_minutiae_features(term1, bif1, term2, bif2):
+    """
+    Number of matched minutiae between two prints given as terminations and
+    bifurcations (feature_extraction.extract_minutiae_features). Types are
+    not required to agree: noise easily turns an ending into a bifurcation.
+    """
+    def template(term, bif):
+        return np.vstack([np.asarray(term, np.float32).reshape(-1, 3),
+                          np.asarray(bif, np.float32).reshape(-1, 3)])
+    return match_minutiae(template(term1, bif1), template(term2, bif2))
@@ -0,0 +1,195 @@
+# metrics.py
+# Stage timers, counters and on-demand profiling for the matcher service.
+# Every stage keeps a rolling window of its latest durations, so p50/p95/p99
+# follow the current load. Snapshots are written to a JSON file periodically
+# and/or served as JSON on a local HTTP port; a signal starts and stops a
+# cProfile capture of the running service.
+
+import os
+import json
+import time
+import signal
+import pstats
+import cProfile
+import threading
+from collections import deque
+from contextlib import contextmanager
+import numpy as np
+from scan_watcher import atomic_write
+
+WINDOW = 1024  # Latest samples per stage used for the percentiles
+# Signal that toggles the profiler: `kill -USR1 <pid>` on Unix, Ctrl+Break on Windows
+PROFILE_SIGNAL = getattr(signal, 'SIGUSR1', None) or getattr(signal, 'SIGBREAK', None)
+
+
+class Metrics:
+    """
+    Thread-safe per-stage latency windows (milliseconds) and event counters;
+    counters named up front are reported even while still zero.
+    """
+
+    def __init__(self, window=WINDOW, counters=()):
+        self.window = window
+        self.started = time.time()
+        self.stages = {}
+        self.totals = {}
+        self.counters = dict.fromkeys(counters, 0)
+        self.lock = threading.Lock()
+
+    def observe(self, stage, ms):
+        """Record one duration of a stage."""
+        with self.lock:
+            samples = self.stages.get(stage)
+            if samples is None:
+                samples = self.stages[stage] = deque(maxlen=self.window)
+            samples.append(ms)
+            self.totals[stage] = self.totals.get(stage, 0) + 1
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block as one sample of stage `name`."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - t0) * 1000)
+
+    def increment(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def snapshot(self):
+        """Counters and per-stage count/p50/p95/p99/max as a JSON-ready dict."""
+        with self.lock:
+            stages = {name: list(samples) for name, samples in self.stages.items()}
+            totals = dict(self.totals)
+            counters = dict(self.counters)
+        summary = {}
+        for name, samples in stages.items():
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99]) if samples else (0.0, 0.0, 0.0)
+            summary[name] = {'count': totals[name], 'window': len(samples), 'p50_ms': float(p50),
+                             'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(max(samples, default=0.0))}
+        return {'time': time.time(), 'uptime_s': time.time() - self.started,
+                'counters': counters, 'stages': summary}
+
+    def dump(self, path):
+        """Write a snapshot to path atomically."""
+        data = json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+        def write(temp_path):
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+        atomic_write(path, write)
+
+
+class MetricsReporter:
+    """
+    Exposes a Metrics object: dumps it to `path` every `interval` seconds
+    and/or serves GET /metrics as JSON on 127.0.0.1:`port`. Either can be None.
+    """
+
+    def __init__(self, metrics, path=None, interval=10.0, port=None):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.port = port
+        self.server = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.path:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        if self.port is not None:
+            self.server = self._serve()
+            self.port = self.server.server_address[1]
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._dump()
+        self._dump()
+
+    def _dump(self):
+        try:
+            self.metrics.dump(self.path)
+        except OSError as e:
+            print(f"Failed to write metrics to {self.path}: {e}")
+
+    def _serve(self):
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self.metrics
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot(), sort_keys=True).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class SignalProfiler:
+    """
+    cProfile capture toggled by a signal: the first signal starts profiling
+    the main thread (where scans are processed), the next one stops it and
+    writes profile_<time>.prof plus a cumulative-time summary .txt to out_dir.
+    """
+
+    def __init__(self, out_dir, signum=PROFILE_SIGNAL, top=30):
+        self.out_dir = out_dir
+        self.signum = signum
+        self.top = top
+        self.profiler = None
+
+    def install(self):
+        """Register the signal handler; returns False where the signal does not exist."""
+        if self.signum is None:
+            return False
+        signal.signal(self.signum, self._toggle)
+        return True
+
+    def _toggle(self, signum, frame):
+        if self.profiler is None:
+            self.start()
+        else:
+            self.stop()
+
+    def start(self):
+        self.profiler = cProfile.Profile()
+        self.profiler.enable()
+        print("Profiling started; send the signal again to stop and save it")
+
+    def stop(self):
+        """Stop a running capture and save it; returns the .prof path (None if not running)."""
+        if self.profiler is None:
+            return None
+        profiler, self.profiler = self.profiler, None
+        profiler.disable()
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, time.strftime('profile_%Y%m%d_%H%M%S.prof'))
+        profiler.dump_stats(path)
+        with open(os.path.splitext(path)[0] + '.txt', 'w', encoding='utf-8') as f:
+            pstats.Stats(profiler, stream=f).sort_stats('cumulative').print_stats(self.top)
+        print(f"Profile saved to {path}")
+        return path
@@ -0,0 +1,240 @@
+# publisher.py
+# Asynchronous delivery of match results to the API. The matcher only enqueues;
+# a background thread batches results over one reused HTTP connection and
+# spills them to an on-disk outbox while the endpoint is unreachable. Results
+# the API refuses outright (4xx) go to a dead-letter file instead.
+
+import os
+import json
+import time
+import queue
+import base64
+import itertools
+import threading
+import cv2
+import numpy as np
+from scan_watcher import atomic_write
+
+API_URL = 'http://10.21.55.109:8080/fingerprint'
+OUTBOX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'outbox')
+DEAD_LETTER_FILE = 'dead_letter.jsonl'  # In the outbox folder; one refused result per line
+RETRY_STATUSES = (408, 429)  # Client errors that are worth retrying, like 5xx
+IMAGE_MODES = ('full', 'thumbnail', 'id')
+THUMBNAIL_WIDTH = 128
+THUMBNAIL_QUALITY = 80
+
+_STOP = object()
+
+
+def image_fields(mode='full', bmp_bytes=None, image=None, scan_id=None):
+    """
+    Build the image part of a result payload.
+    'full' sends the whole BMP as a base64 data URL (the original format),
+    'thumbnail' a small JPEG data URL, and 'id' only the scan id.
+    """
+    if mode == 'id':
+        return {"fingerprint_img": None, "scan_id": scan_id}
+    if mode == 'thumbnail':
+        if image is None:
+            image = cv2.imdecode(np.frombuffer(bmp_bytes, np.uint8), cv2.IMREAD_GRAYSCALE)
+        h, w = image.shape[:2]
+        thumb = cv2.resize(image, (THUMBNAIL_WIDTH, round(h * THUMBNAIL_WIDTH / w)), interpolation=cv2.INTER_AREA)
+        ok, jpg = cv2.imencode('.jpg', thumb, [cv2.IMWRITE_JPEG_QUALITY, THUMBNAIL_QUALITY])
+        data = 'data:image/jpeg;base64,' + base64.b64encode(jpg.tobytes()).decode("utf-8") if ok else None
+        return {"fingerprint_img": data, "scan_id": scan_id}
+    if bmp_bytes is None and image is not None:
+        ok, bmp = cv2.imencode('.bmp', image)
+        bmp_bytes = bmp.tobytes() if ok else None
+    if bmp_bytes is None:
+        return {"fingerprint_img": None}
+    return {"fingerprint_img": 'data:image/bmp;base64,' + base64.b64encode(bmp_bytes).decode("utf-8")}
+
+
+class ResultPublisher:
+    """
+    Non-blocking result delivery.
+    publish() puts a result on a bounded in-memory queue and returns at once.
+    A worker thread sends results in batches of up to batch_size (a single
+    JSON object when batch_size is 1, as the API expects today, otherwise a
+    JSON list). Only a 2xx response counts as delivered. Results that
+    cannot be delivered (network errors, 5xx, 408, 429), or that arrive
+    while the queue is full, are written to outbox_dir and retried in order
+    every retry_interval seconds, including across restarts. Results refused
+    with any other status would fail again: they are appended to
+    outbox_dir/DEAD_LETTER_FILE with the status and response text.
+    """
+
+    def __init__(self, url=API_URL, max_queue=256, batch_size=1, batch_wait=0.05,
+                 timeout=5, outbox_dir=OUTBOX_DIR, retry_interval=5.0):
+        self.url = url
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.timeout = timeout
+        self.outbox_dir = outbox_dir
+        self.retry_interval = retry_interval
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.session = None  # requests.Session, created by start()
+        self.stats = {"sent": 0, "failed_posts": 0, "spilled": 0, "replayed": 0, "dead_lettered": 0}
+        self._outbox_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._outbox = []
+        self._counter = itertools.count()
+        self._retry_at = 0.0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        # requests is slow to import, so it is only loaded once delivery starts
+        import requests
+        self.session = requests.Session()  # Keep-alive connection reuse
+        os.makedirs(self.outbox_dir, exist_ok=True)
+        # Pick up results spilled by a previous run
+        self._outbox = sorted(n for n in os.listdir(self.outbox_dir) if n.endswith('.json'))
+        self._thread.start()
+        return self
+
+    def publish(self, result):
+        """Enqueue one result dict; never blocks on the network."""
+        try:
+            self.queue.put_nowait(result)
+        except queue.Full:
+            self._spill([result])
+
+    def stop(self, timeout=None):
+        """Deliver what is queued (or spill it to the outbox) and stop the worker."""
+        self._stopping.set()
+        try:
+            # Wakes the worker if it waits on an empty queue; a full queue
+            # needs no wake-up, and the worker stops once it is drained
+            self.queue.put_nowait(_STOP)
+        except queue.Full:
+            pass
+        self._thread.join(timeout)
+        if self.session is not None:
+            self.session.close()
+
+    def pending_outbox(self):
+        with self._outbox_lock:
+            return len(self._outbox)
+
+    def _spill(self, results):
+        name = f"{time.time_ns():020d}-{next(self._counter):06d}.json"
+        path = os.path.join(self.outbox_dir, name)
+
+        def write(temp_path):
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(results, f)
+        try:
+            atomic_write(path, write)
+        except OSError as e:
+            print(f"Failed to write outbox file {path}: {e}")
+            return
+        with self._outbox_lock:
+            self._outbox.append(name)
+            self._outbox.sort()
+            self.stats["spilled"] += len(results)
+
+    def _dead_letter(self, results, status, text):
+        path = os.path.join(self.outbox_dir, DEAD_LETTER_FILE)
+        try:
+            with self._outbox_lock, open(path, 'a', encoding='utf-8') as f:
+                for result in results:
+                    f.write(json.dumps({"status": status, "response": text, "result": result}) + '\n')
+        except OSError as e:
+            print(f"Failed to write dead-letter file {path}: {e}")
+            return
+        self.stats["dead_lettered"] += len(results)
+
+    def _post(self, results):
+        """
+        Send results; True once they are off our hands (delivered, or refused
+        and dead-lettered), False if they should be retried later.
+        """
+        import requests
+        body = results[0] if self.batch_size == 1 and len(results) == 1 else results
+        try:
+            response = self.session.post(self.url, json=body, timeout=self.timeout)
+            status = response.status_code
+            if 200 <= status < 300:
+                self.stats["sent"] += len(results)
+                return True
+            print(f"API response: {status}")
+            if status < 500 and status not in RETRY_STATUSES:
+                # Refused outright: retrying would fail the same way
+                self._dead_letter(results, status, response.text[:500])
+                return True
+        except requests.RequestException as e:
+            print(f"Failed to send API request: {e}")
+        self.stats["failed_posts"] += 1
+        self._retry_at = time.monotonic() + self.retry_interval
+        return False
+
+    def _send(self, results):
+        # Keep delivery in order: while anything waits in the outbox (or the
+        # endpoint is backing off) new results queue up behind it on disk.
+        if self.pending_outbox() or time.monotonic() < self._retry_at or not self._post(results):
+            self._spill(results)
+
+    def _drain_outbox(self):
+        while time.monotonic() >= self._retry_at:
+            with self._outbox_lock:
+                if not self._outbox:
+                    return
+                name = self._outbox[0]
+            path = os.path.join(self.outbox_dir, name)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    results = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Dropping unreadable outbox file {path}: {e}")
+                results = None
+            if results is not None:
+                if self.batch_size == 1:
+                    for i, result in enumerate(results):
+                        if not self._post([result]):
+                            self._rewrite(path, results[i:])
+                            self.stats["replayed"] += i
+                            return
+                elif not self._post(results):
+                    return
+                self.stats["replayed"] += len(results)
+            with self._outbox_lock:
+                self._outbox.remove(name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _rewrite(self, path, results):
+        """Keep only the undelivered tail of a partially replayed outbox file."""
+        def write(temp_path):
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(results, f)
+        atomic_write(path, write)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            self._drain_outbox()
+            # Wake up periodically only while there is something to retry
+            timeout = self.retry_interval if self.pending_outbox() else None
+            try:
+                if self._stopping.is_set():
+                    item = self.queue.get_nowait()
+                else:
+                    item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                if self._stopping.is_set():
+                    break
+                continue
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.batch_wait
+            while len(batch) < self.batch_size:
+                try:
+                    item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._send(batch)
@@ -0,0 +1,68 @@
+# quality.py
+# Fast quality assessment of a capture before it is matched. Near-blank,
+# partial, smudged or washed-out captures can only end up "Unknown", so they
+# are rejected in a few milliseconds and the sensor asked for a recapture
+# instead of running the full match and sending the result to the API.
+# All measures come from 16x16 blocks, like extract_features:
+# - coverage: share of blocks with ridge texture (the finger's footprint)
+# - contrast: ridge-valley intensity spread (std) inside those blocks
+# - coherence: how consistently the block gradients share one orientation
+
+from collections import namedtuple
+import cv2
+import numpy as np
+
+QUALITY_BLOCK = 16
+FOREGROUND_STD = 12.0  # Blocks with a lower intensity std (0-255) are background
+# Minimums sit just below the real captures in scans/, dataset/ and
+# distorted_dataset/ (`python benchmark.py quality`)
+MIN_COVERAGE = 0.20  # Share of the frame covered by ridges
+MIN_CONTRAST = 0.10  # Median ridge-block std / 128
+MIN_COHERENCE = 0.25  # Mean block orientation coherence
+
+QualityResult = namedtuple('QualityResult', ['ok', 'score', 'coverage', 'contrast', 'coherence', 'reasons'])
+
+
+def block_means(image, block=QUALITY_BLOCK):
+    """Mean of every whole block x block tile, as a float32 (rows, cols) map."""
+    h, w = image.shape[0] // block, image.shape[1] // block
+    return cv2.resize(image[:h * block, :w * block], (w, h), interpolation=cv2.INTER_AREA)
+
+
+def assess_quality(image, min_coverage=MIN_COVERAGE, min_contrast=MIN_CONTRAST, min_coherence=MIN_COHERENCE):
+    """
+    Quality of a grayscale capture. Returns a QualityResult: ok is False when
+    any measure is below its minimum, with one reason per failed measure;
+    score in [0, 1] is the geometric mean of the measures, each scaled by
+    its minimum so a capture exactly at every minimum scores 0.5.
+    """
+    if image.ndim > 2:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    image = image.astype(np.float32)
+    # Block statistics by area resizing, which is much faster than numpy reductions
+    mean = block_means(image)
+    std = np.sqrt(np.maximum(block_means(image * image) - mean * mean, 0))
+    foreground = std > FOREGROUND_STD
+    coverage = float(foreground.mean())
+
+    contrast = coherence = 0.0
+    if foreground.any():
+        # Ridge-valley contrast: typical intensity std of the ridge blocks
+        contrast = float(np.median(std[foreground]) / 128.0)
+        # Coherence of the block structure tensors: 1 for parallel ridges, 0 for noise
+        gx = cv2.Sobel(image, cv2.CV_32F, 1, 0, ksize=3)
+        gy = cv2.Sobel(image, cv2.CV_32F, 0, 1, ksize=3)
+        gxx, gyy, gxy = (block_means(g)[foreground] for g in (gx * gx, gy * gy, gx * gy))
+        c = np.sqrt((gxx - gyy) ** 2 + 4 * gxy ** 2) / np.maximum(gxx + gyy, 1e-6)
+        coherence = float(c.mean())
+
+    reasons = []
+    for name, value, minimum in (('coverage', coverage, min_coverage), ('contrast', contrast, min_contrast),
+                                 ('coherence', coherence, min_coherence)):
+        if value < minimum:
+            reasons.append(f"low {name} ({value:.2f} < {minimum:.2f})")
+    # Each measure relative to its minimum, 1.0 at the minimum, capped at 2x
+    ratios = [min(value / minimum, 2.0) / 2.0 for value, minimum in
+              ((coverage, min_coverage), (contrast, min_contrast), (coherence, min_coherence))]
+    score = float(np.prod(ratios) ** (1 / 3))
+    return QualityResult(not reasons, score, coverage, contrast, coherence, reasons)
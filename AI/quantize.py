@@ -0,0 +1,81 @@
+# quantize.py
+# Compact template storage: float16, or int8 with one float32 scale per vector.
+# Scoring works on the quantized matrix directly, dequantizing a small block
+# of rows at a time so no full float32 copy is ever materialized.
+
+import cv2
+import numpy as np
+
+TEMPLATE_DTYPES = ('float32', 'float16', 'int8')
+BLOCK_ROWS = 256  # Rows dequantized at once; small enough to stay in cache
+
+
+class QuantizedTemplates:
+    """
+    An (N x D) template matrix stored as float16 or per-row-scaled int8.
+    Supports len(), .shape, .nbytes and `templates @ query` like a float32
+    array, so GalleryIndex can use either interchangeably.
+    """
+
+    def __init__(self, templates, dtype='int8'):
+        templates = np.asarray(templates, dtype=np.float32)
+        self.dtype = dtype
+        self.shape = templates.shape
+        if dtype == 'float16':
+            self.data = templates.astype(np.float16)
+            self.scales = None
+        elif dtype == 'int8':
+            # Symmetric per-vector scale: the largest magnitude maps to 127
+            self.scales = np.abs(templates).max(axis=1) / 127.0 if len(templates) else np.zeros(0)
+            self.scales = np.where(self.scales > 0, self.scales, 1.0).astype(np.float32)
+            self.data = np.round(templates / self.scales[:, None]).astype(np.int8)
+        else:
+            raise ValueError(f"Unsupported template dtype: {dtype}")
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (0 if self.scales is None else self.scales.nbytes)
+
+    def _block(self, start, stop):
+        """Rows start:stop converted to float32, without the int8 scales."""
+        if self.dtype == 'float16':
+            # OpenCV's SIMD half-float conversion is several times faster than numpy's
+            return cv2.convertFp16(self.data[start:stop].view(np.int16))
+        return self.data[start:stop].astype(np.float32)
+
+    def dequantize(self, start=0, stop=None):
+        """Rows start:stop as float32."""
+        block = self._block(start, len(self) if stop is None else stop)
+        if self.scales is not None:
+            block *= self.scales[start:stop, None]
+        return block
+
+    def take(self, rows):
+        """The given rows (an index array) as float32."""
+        rows = np.asarray(rows, dtype=np.int64)
+        block = self.data[rows].astype(np.float32)
+        if self.scales is not None:
+            block *= self.scales[rows, None]
+        return block
+
+    def __matmul__(self, query):
+        """Scores of every row against a (D,) query or a (D, B) batch of queries."""
+        query = np.asarray(query, dtype=np.float32)
+        out = np.empty((len(self),) + query.shape[1:], dtype=np.float32)
+        for start in range(0, len(self), BLOCK_ROWS):
+            stop = min(start + BLOCK_ROWS, len(self))
+            # int8 rows are scaled after the product: one multiply per score, not per element
+            out[start:stop] = self._block(start, stop) @ query
+        if self.scales is not None:
+            out *= self.scales.reshape((-1,) + (1,) * (query.ndim - 1))
+        return out
+
+
+def quantize_templates(templates, dtype='float32'):
+    """Return templates as a float32 array, or QuantizedTemplates for 'float16'/'int8'."""
+    if dtype == 'float32':
+        return np.ascontiguousarray(templates, dtype=np.float32)
+    return QuantizedTemplates(templates, dtype)
@@ -0,0 +1,188 @@
+# scan_watcher.py
+# Event-driven detection of new fingerprint captures in the scans/ folder.
+# Uses inotify on Linux and falls back to fast directory polling elsewhere.
+
+import os
+import sys
+import time
+import queue
+import select
+import struct
+import ctypes
+import threading
+
+# Writers save to a temp name first and rename it into place once the file
+# is complete, so the watcher never sees half-written captures.
+TEMP_PREFIX = '.partial-'
+POLL_INTERVAL = 0.05  # seconds, polling fallback only
+SEEN_WINDOW = 10.0  # seconds of file mtimes remembered for de-duplication
+
+# inotify constants (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def atomic_write(final_path, write_fn):
+    """
+    Write a file with the temp-then-rename handshake.
+    write_fn(temp_path) must create the complete file at temp_path; it is then
+    renamed to final_path in a single step.
+    """
+    folder, name = os.path.split(final_path)
+    temp_path = os.path.join(folder, TEMP_PREFIX + name)
+    try:
+        write_fn(temp_path)
+        os.replace(temp_path, final_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _load_inotify():
+    """Return libc with the inotify functions, or None if unavailable."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+
+class ScanWatcher:
+    """
+    Watches a folder and queues the path of every completed capture, in
+    arrival order. Each distinct capture (file name and mtime) is queued once;
+    nothing is coalesced. If inotify overflows, the folder is rescanned so no
+    capture is dropped.
+    """
+
+    def __init__(self, scans_dir, prefix='', suffix='.bmp', use_inotify=True,
+                 poll_interval=POLL_INTERVAL, seen_window=SEEN_WINDOW):
+        self.scans_dir = scans_dir
+        self.prefix = prefix
+        self.suffix = suffix.lower()
+        self.poll_interval = poll_interval
+        self.queue = queue.Queue()
+        self.mode = None
+        self._libc = _load_inotify() if use_inotify else None
+        self._stop = threading.Event()
+        self._thread = None
+        # name -> mtime_ns of recently handled files, for de-duplication.
+        # Entries older than seen_window behind the newest file are pruned;
+        # rescans ignore files older than that floor.
+        self._seen = {}
+        self._lock = threading.Lock()
+        self._window_ns = int(seen_window * 1e9)
+        self._newest = 0
+        self._floor = 0
+
+    def _wanted(self, name):
+        return (not name.startswith('.') and name.startswith(self.prefix)
+                and name.lower().endswith(self.suffix))
+
+    def _emit(self, name, detected_at, mtime_ns=None, rescan=False):
+        if not self._wanted(name):
+            return
+        if mtime_ns is None:
+            try:
+                mtime_ns = os.stat(os.path.join(self.scans_dir, name)).st_mtime_ns
+            except OSError:
+                return
+        with self._lock:
+            if self._seen.get(name) == mtime_ns or (rescan and mtime_ns < self._floor):
+                return
+            self._seen[name] = mtime_ns
+            self._newest = max(self._newest, mtime_ns)
+        self.queue.put((os.path.join(self.scans_dir, name), detected_at))
+
+    def _prune(self):
+        with self._lock:
+            self._floor = self._newest - self._window_ns
+            for name in [n for n, m in self._seen.items() if m < self._floor]:
+                del self._seen[name]
+
+    def _rescan(self, detected_at):
+        """Queue any wanted file not handled yet, oldest first."""
+        with os.scandir(self.scans_dir) as entries:
+            new = [(e.stat().st_mtime_ns, e.name) for e in entries if self._wanted(e.name)]
+        for mtime_ns, name in sorted(new):
+            self._emit(name, detected_at, mtime_ns, rescan=True)
+
+    def start(self):
+        """Start watching in a background thread. Existing files are not queued."""
+        os.makedirs(self.scans_dir, exist_ok=True)
+        with os.scandir(self.scans_dir) as entries:
+            for entry in entries:
+                if self._wanted(entry.name):
+                    self._seen[entry.name] = entry.stat().st_mtime_ns
+        self._newest = max(self._seen.values(), default=0)
+        self._prune()
+        fd = None
+        if self._libc is not None:
+            fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and self._libc.inotify_add_watch(
+                    fd, os.fsencode(self.scans_dir), IN_MOVED_TO | IN_CLOSE_WRITE) < 0:
+                os.close(fd)
+                fd = None
+            elif fd < 0:
+                fd = None
+        # Catch files that landed between the snapshot and the watch
+        self._rescan(time.perf_counter())
+        if fd is not None:
+            self.mode = 'inotify'
+            target, args = self._run_inotify, (fd,)
+        else:
+            self.mode = 'polling'
+            target, args = self._run_polling, ()
+        self._thread = threading.Thread(target=target, args=args, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def get(self, timeout=None):
+        """Return (path, detected_at) of the next capture; raises queue.Empty on timeout."""
+        item = self.queue.get(timeout=timeout)
+        self._prune()
+        return item
+
+    def _run_inotify(self, fd):
+        try:
+            while not self._stop.is_set():
+                ready, _, _ = select.select([fd], [], [], 0.25)
+                if not ready:
+                    continue
+                try:
+                    data = os.read(fd, 64 * 1024)
+                except BlockingIOError:
+                    continue
+                detected_at = time.perf_counter()
+                offset = 0
+                while offset < len(data):
+                    _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+                    offset += _EVENT_HEADER.size
+                    name = data[offset:offset + length].rstrip(b'\0').decode(errors='replace')
+                    offset += length
+                    if mask & IN_Q_OVERFLOW:
+                        # Events were lost; fall back to the directory listing
+                        self._rescan(detected_at)
+                    elif mask & (IN_MOVED_TO | IN_CLOSE_WRITE):
+                        self._emit(name, detected_at)
+        finally:
+            os.close(fd)
+
+    def _run_polling(self):
+        while not self._stop.is_set():
+            self._rescan(time.perf_counter())
+            self._stop.wait(self.poll_interval)
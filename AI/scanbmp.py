@@ -1,13 +1,14 @@
 import os
 import time
+import uuid
 import ctypes
+from scan_watcher import atomic_write
 from ctypes import byref, c_int, c_uint, c_ubyte, c_char_p, c_void_p
 
 # ===== User config =====
 DLL_NAME = "SynoAPIEx.dll"         # Put next to this script or add folder to PATH
 DEFAULT_ADDR = 0xFFFFFFFF          # Default module address
 TIMEOUT_SECONDS = 50              # Wait up to 30s for a finger
-import uuid
 # OUTPUT_BMP is now generated per run using a UUID
 def get_output_bmp():
     return f"fingerprint_{uuid.uuid4().hex}.bmp"
@@ -24,8 +25,6 @@ def load_vendor_dll(name: str) -> ctypes.CDLL:
             f"and the DLL is next to this script or in PATH.\nWindows error: {e}"
         )
 
-dll = load_vendor_dll(DLL_NAME)
-
 # ===== Types & constants (from Protocol.h/manual) =====
 HANDLE = c_void_p
 DEVICE_USB, DEVICE_COM, DEVICE_UDISK = 0, 1, 2
@@ -34,44 +33,59 @@ IMAGE_X, IMAGE_Y = 256, 288
 IMAGE_BYTES = IMAGE_X * IMAGE_Y
 
 # ===== Function signatures we use (subset) =====
-dll.PSOpenDeviceEx.argtypes = [ctypes.POINTER(HANDLE), c_int, c_int, c_int, c_int, c_int]
-dll.PSOpenDeviceEx.restype  = c_int
+def _declare(dll):
+    dll.PSOpenDeviceEx.argtypes = [ctypes.POINTER(HANDLE), c_int, c_int, c_int, c_int, c_int]
+    dll.PSOpenDeviceEx.restype  = c_int
+
+    dll.PSAutoOpen.argtypes = [ctypes.POINTER(HANDLE), ctypes.POINTER(c_int), c_int, c_uint, c_int]
+    dll.PSAutoOpen.restype  = c_int
 
-dll.PSAutoOpen.argtypes = [ctypes.POINTER(HANDLE), ctypes.POINTER(c_int), c_int, c_uint, c_int]
-dll.PSAutoOpen.restype  = c_int
+    dll.PSGetUSBDevNum.argtypes = [ctypes.POINTER(c_int)]
+    dll.PSGetUSBDevNum.restype  = c_int
 
-dll.PSGetUSBDevNum.argtypes = [ctypes.POINTER(c_int)]
-dll.PSGetUSBDevNum.restype  = c_int
+    dll.PSGetUDiskNum.argtypes = [ctypes.POINTER(c_int)]
+    dll.PSGetUDiskNum.restype  = c_int
 
-dll.PSGetUDiskNum.argtypes = [ctypes.POINTER(c_int)]
-dll.PSGetUDiskNum.restype  = c_int
+    dll.PSCloseDeviceEx.argtypes = [HANDLE]
+    dll.PSCloseDeviceEx.restype  = c_int
 
-dll.PSCloseDeviceEx.argtypes = [HANDLE]
-dll.PSCloseDeviceEx.restype  = c_int
+    dll.PSGetImage.argtypes = [HANDLE, c_int]
+    dll.PSGetImage.restype  = c_int
 
-dll.PSGetImage.argtypes = [HANDLE, c_int]
-dll.PSGetImage.restype  = c_int
+    dll.PSUpImage.argtypes = [HANDLE, c_int, ctypes.POINTER(c_ubyte), ctypes.POINTER(c_int)]
+    dll.PSUpImage.restype  = c_int
 
-dll.PSUpImage.argtypes = [HANDLE, c_int, ctypes.POINTER(c_ubyte), ctypes.POINTER(c_int)]
-dll.PSUpImage.restype  = c_int
+    dll.PSImgData2BMP.argtypes = [ctypes.POINTER(c_ubyte), c_char_p]
+    dll.PSImgData2BMP.restype  = c_int
 
-dll.PSImgData2BMP.argtypes = [ctypes.POINTER(c_ubyte), c_char_p]
-dll.PSImgData2BMP.restype  = c_int
+    dll.PSErr2Str.argtypes = [c_int]
+    dll.PSErr2Str.restype  = ctypes.c_char_p
+    return dll
 
-dll.PSErr2Str.argtypes = [c_int]
-dll.PSErr2Str.restype  = ctypes.c_char_p
+# The DLL is loaded on first use, so importing this module (e.g. for its
+# constants or helpers) works anywhere and costs nothing
+_dll = None
+
+def get_dll():
+    """The vendor DLL with its function signatures declared, loaded once."""
+    global _dll
+    if _dll is None:
+        _dll = _declare(load_vendor_dll(DLL_NAME))
+    return _dll
 
 def err_text(code: int) -> str:
+    dll = get_dll()
     s = dll.PSErr2Str(code)
     return s.decode(errors="ignore") if s else f"Error 0x{code:02X}"
 
 def close_device(h: HANDLE):
     if h:
-        dll.PSCloseDeviceEx(h)
+        get_dll().PSCloseDeviceEx(h)
 
 # ===== Open helpers =====
 def try_PSAutoOpen() -> tuple[HANDLE, int]:
     """Let the DLL auto-detect device type (USB/COM)."""
+    dll = get_dll()
     h = HANDLE()
     dtype = c_int(-1)
     rc = dll.PSAutoOpen(byref(h), byref(dtype), DEFAULT_ADDR, 0, 1)  # bVfy=1
@@ -84,6 +98,7 @@ def try_USB_explicit() -> HANDLE:
     Try USB explicitly with different nPackageSize values.
     The DLL's default is '2', but some devices accept 0/1/2/3 only.
     """
+    dll = get_dll()
     tried = []
     for nPackageSize in (2, 3, 1, 0, 4):
         h = HANDLE()
@@ -102,6 +117,7 @@ def try_COM_scan() -> HANDLE:
     Scan COM1..COM30. iBaud is a multiple of 9600 per manual note (6 -> 57600).
     Many modules default to 57600 or 115200; we try both.
     """
+    dll = get_dll()
     for com in range(1, 31):
         for ibaud in (6, 12):  # 6*9600=57600, 12*9600=115200
             h = HANDLE()
@@ -120,6 +136,7 @@ def open_device_resilient() -> tuple[HANDLE, str]:
     Try the best sequence: check USB count → PSAutoOpen → USB explicit → COM scan.
     Returns (handle, mode_str).
     """
+    dll = get_dll()
     # Quick visibility: how many USB/UDisk devices the DLL sees
     usb_n = c_int(0)
     if dll.PSGetUSBDevNum(byref(usb_n)) == PS_OK:
@@ -149,7 +166,13 @@ def open_device_resilient() -> tuple[HANDLE, str]:
     return h, "COM"
 
 # ===== Capture helpers =====
-def wait_for_finger_and_capture(h: HANDLE, addr: int, timeout_s: int) -> bytes:
+def wait_for_finger_and_capture(h: HANDLE, addr: int, timeout_s: int, copy: bool = True):
+    """
+    Wait for a finger and upload the raw IMAGE_Y x IMAGE_X pixels.
+    With copy=False the fresh ctypes buffer is returned as a memoryview, which
+    numpy.frombuffer can wrap without another copy.
+    """
+    dll = get_dll()
     t0 = time.time()
     while True:
         rc = dll.PSGetImage(h, addr)
@@ -167,9 +190,12 @@ def wait_for_finger_and_capture(h: HANDLE, addr: int, timeout_s: int) -> bytes:
     rc = dll.PSUpImage(h, addr, img_buf, byref(img_len))
     if rc != PS_OK:
         raise RuntimeError(f"PSUpImage failed: {err_text(rc)}")
+    if not copy:
+        return memoryview(img_buf).cast('B')[:img_len.value]
     return bytes(bytearray(img_buf)[:img_len.value])
 
 def save_bmp_via_dll(img_bytes: bytes, out_path: str):
+    dll = get_dll()
     buf = (c_ubyte * len(img_bytes)).from_buffer_copy(img_bytes)
     rc = dll.PSImgData2BMP(buf, out_path.encode("utf-8"))
     if rc != PS_OK:
@@ -181,18 +207,23 @@ def main():
     h = None
     try:
         while True:
+            # Each capture reopens the device; release the previous handle first
+            close_device(h)
+            h = None
             h, mode = open_device_resilient()
             print(f"Opened in {mode} mode. Place finger on the sensor …")
             try:
                 img = wait_for_finger_and_capture(h, DEFAULT_ADDR, TIMEOUT_SECONDS)
+                # Every capture is saved: match_scan.quality_gate rejects unusable ones
                 scans_dir = os.path.join(os.path.dirname(__file__), "scans")
                 os.makedirs(scans_dir, exist_ok=True)
+                # Write-to-temp-then-rename so the matcher only sees complete files
                 output_bmp = os.path.join(scans_dir, get_output_bmp())
-                save_bmp_via_dll(img, output_bmp)
-                # Also save as input_scan.bmp for matching (in scans/)
+                atomic_write(output_bmp, lambda path: save_bmp_via_dll(img, path))
+                print(f"Capture saved at: {output_bmp}")
+                # Also keep input_scan.bmp as the latest capture (in scans/)
                 input_scan_path = os.path.join(scans_dir, "input_scan.bmp")
-                save_bmp_via_dll(img, input_scan_path)
-                print(f"input_scan.bmp saved at: {input_scan_path}")
+                atomic_write(input_scan_path, lambda path: save_bmp_via_dll(img, path))
                 print("Done.")
                 time.sleep(2)  # Sleep for 2 seconds before next iteration
             except Exception as e:
@@ -0,0 +1,76 @@
+# test_capture.py
+# A replayed capture pipeline run: every frame reaches on_frame in order,
+# accepted frames are archived as BMP files, and a frame rejected by the
+# quality gate is neither archived nor lost silently (recapture requested).
+
+import os
+import glob
+import cv2
+import numpy as np
+from capture import ReplaySensor, run_pipeline, IMAGE_X, IMAGE_Y
+from quality import QualityResult
+
+N_FRAMES = 4
+
+
+class _RecordingSensor(ReplaySensor):
+    def __init__(self, folder):
+        super().__init__(folder, loop=False)
+        self.recaptures = []
+        self.closed = False
+
+    def request_recapture(self, reasons):
+        self.recaptures.append(reasons)
+
+    def close(self):
+        self.closed = True
+
+
+def _replay_folder(folder):
+    rng = np.random.default_rng(0)
+    frames = []
+    for i in range(N_FRAMES):
+        frame = rng.integers(0, 256, (IMAGE_Y, IMAGE_X), dtype=np.uint8)
+        assert cv2.imwrite(os.path.join(folder, f"fingerprint_{i:02d}.bmp"), frame)
+        frames.append(frame)
+    return frames
+
+
+def test_replayed_pipeline_run(tmp_path):
+    frames = _replay_folder(str(tmp_path))
+    archive_dir = tmp_path / 'archive'
+    source = _RecordingSensor(str(tmp_path))
+    seen = []
+
+    def on_frame(image, frame_id, captured_at):
+        seen.append((image.copy(), frame_id))
+        if len(seen) == 2:
+            return QualityResult(False, 0.1, 0.2, 5.0, 0.1, ['low contrast'])
+        return None
+
+    run_pipeline(source, on_frame, scans_dir=str(archive_dir))
+
+    assert len(seen) == N_FRAMES
+    for (image, _), frame in zip(seen, frames):
+        np.testing.assert_array_equal(image, frame)
+    assert source.recaptures == [['low contrast']]
+    assert source.closed
+
+    archived = sorted(glob.glob(str(archive_dir / 'fingerprint_*.bmp')))
+    accepted = {frame_id for i, (_, frame_id) in enumerate(seen) if i != 1}
+    assert {os.path.splitext(os.path.basename(p))[0] for p in archived} == accepted
+    for path in archived:
+        frame_id = os.path.splitext(os.path.basename(path))[0]
+        image = next(image for image, seen_id in seen if seen_id == frame_id)
+        np.testing.assert_array_equal(cv2.imread(path, cv2.IMREAD_GRAYSCALE), image)
+    assert not any(name.startswith('.') for name in os.listdir(archive_dir))
+
+
+def test_max_frames_stops_the_replay(tmp_path):
+    _replay_folder(str(tmp_path))
+    source = ReplaySensor(str(tmp_path), loop=True)
+    seen = []
+    run_pipeline(source, lambda image, frame_id, captured_at: seen.append(frame_id), archive=False,
+                 max_frames=N_FRAMES * 2 + 1)
+    assert len(seen) == N_FRAMES * 2 + 1
+    assert len(set(seen)) == len(seen)
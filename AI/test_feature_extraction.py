@@ -0,0 +1,31 @@
+# test_feature_extraction.py
+# Regression test: the vectorized extract_features must reproduce the original
+# block-by-block implementation exactly, so existing galleries stay valid.
+
+import os
+import glob
+import cv2
+import numpy as np
+from feature_extraction import extract_features, extract_features_reference
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def _images(folder):
+    paths = sorted(glob.glob(os.path.join(HERE, folder, '*', '*.bmp')))
+    assert paths, f"No images found in {folder}/"
+    return paths
+
+
+def test_matches_reference_on_dataset():
+    for path in _images('dataset'):
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        assert img is not None, f"Failed to read {path}"
+        np.testing.assert_array_equal(extract_features(img), extract_features_reference(img), err_msg=path)
+
+
+def test_matches_reference_on_distorted_dataset():
+    for path in _images('distorted_dataset'):
+        img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        assert img is not None, f"Failed to read {path}"
+        np.testing.assert_array_equal(extract_features(img), extract_features_reference(img), err_msg=path)
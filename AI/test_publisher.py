@@ -0,0 +1,143 @@
+# test_publisher.py
+# ResultPublisher against a local http.server stub: results are delivered in
+# order, retried through the on-disk outbox while the API fails (also across
+# restarts), refused results go to the dead-letter file, and stop() returns
+# even with a full queue.
+
+import os
+import json
+import time
+import threading
+import http.server
+import pytest
+from publisher import ResultPublisher, DEAD_LETTER_FILE
+
+TIMEOUT = 5.0
+
+
+class _StubAPI:
+    """Records the JSON bodies it accepts; answers each POST with the next scripted status (200 after)."""
+
+    def __init__(self, statuses=()):
+        self.statuses = list(statuses)
+        self.received = []
+        stub = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                status = stub.statuses.pop(0) if stub.statuses else 200
+                if 200 <= status < 300:
+                    stub.received.extend(body if isinstance(body, list) else [body])
+                payload = b'{"error": "refused"}' if status >= 400 else b'{}'
+                self.send_response(status)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/fingerprint"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    api = _StubAPI()
+    yield api
+    api.close()
+
+
+def _wait_for(condition, timeout=TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def _publisher(url, outbox, **kwargs):
+    return ResultPublisher(url, timeout=1, outbox_dir=str(outbox), retry_interval=0.1, **kwargs).start()
+
+
+def test_results_are_delivered_in_order(stub, tmp_path):
+    publisher = _publisher(stub.url, tmp_path / 'outbox')
+    for i in range(20):
+        publisher.publish({'seq': i})
+    assert _wait_for(lambda: len(stub.received) == 20)
+    publisher.stop(timeout=TIMEOUT)
+    assert [r['seq'] for r in stub.received] == list(range(20))
+    assert publisher.stats['sent'] == 20
+    assert publisher.pending_outbox() == 0
+
+
+def test_server_errors_are_retried_from_the_outbox(stub, tmp_path):
+    stub.statuses = [503, 500]
+    publisher = _publisher(stub.url, tmp_path / 'outbox')
+    for i in range(5):
+        publisher.publish({'seq': i})
+    assert _wait_for(lambda: len(stub.received) == 5)
+    publisher.stop(timeout=TIMEOUT)
+    assert [r['seq'] for r in stub.received] == list(range(5))
+    assert publisher.stats['failed_posts'] == 2
+    assert publisher.stats['spilled'] >= 1
+    assert publisher.pending_outbox() == 0
+    assert [n for n in os.listdir(tmp_path / 'outbox') if n.endswith('.json')] == []
+
+
+def test_outbox_survives_a_restart(stub, tmp_path):
+    outbox = tmp_path / 'outbox'
+    # The API is unreachable for the first run: everything is spilled to disk
+    offline = _publisher('http://127.0.0.1:9/fingerprint', outbox)
+    for i in range(3):
+        offline.publish({'seq': i})
+    assert _wait_for(lambda: offline.stats['spilled'] == 3)
+    offline.stop(timeout=TIMEOUT)
+    assert offline.pending_outbox() > 0
+
+    publisher = _publisher(stub.url, outbox)
+    publisher.publish({'seq': 3})
+    assert _wait_for(lambda: len(stub.received) == 4)
+    publisher.stop(timeout=TIMEOUT)
+    assert [r['seq'] for r in stub.received] == [0, 1, 2, 3]
+    assert publisher.stats['replayed'] == 3
+
+
+def test_refused_results_go_to_the_dead_letter_file(stub, tmp_path):
+    stub.statuses = [400, 422]
+    publisher = _publisher(stub.url, tmp_path / 'outbox')
+    for i in range(4):
+        publisher.publish({'seq': i})
+    assert _wait_for(lambda: len(stub.received) == 2)
+    publisher.stop(timeout=TIMEOUT)
+    assert [r['seq'] for r in stub.received] == [2, 3]
+    assert publisher.stats['sent'] == 2
+    assert publisher.stats['dead_lettered'] == 2
+    assert publisher.pending_outbox() == 0
+    with open(tmp_path / 'outbox' / DEAD_LETTER_FILE, encoding='utf-8') as f:
+        dead = [json.loads(line) for line in f]
+    assert [(d['status'], d['result']['seq']) for d in dead] == [(400, 0), (422, 1)]
+
+
+def test_batches_are_sent_as_lists(stub, tmp_path):
+    publisher = _publisher(stub.url, tmp_path / 'outbox', batch_size=8, batch_wait=0.2)
+    for i in range(8):
+        publisher.publish({'seq': i})
+    assert _wait_for(lambda: len(stub.received) == 8)
+    publisher.stop(timeout=TIMEOUT)
+    assert [r['seq'] for r in stub.received] == list(range(8))
+
+
+def test_stop_returns_with_a_full_queue(tmp_path):
+    publisher = _publisher('http://127.0.0.1:9/fingerprint', tmp_path / 'outbox', max_queue=2)
+    for i in range(10):
+        publisher.publish({'seq': i})
+    started = time.monotonic()
+    publisher.stop(timeout=TIMEOUT)
+    assert time.monotonic() - started < TIMEOUT
+    assert not publisher._thread.is_alive()
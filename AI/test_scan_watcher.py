@@ -0,0 +1,80 @@
+# test_scan_watcher.py
+# The watcher must queue every capture written with the temp-then-rename
+# handshake exactly once, and never a half-written temp file, with inotify
+# and with the polling fallback.
+
+import os
+import queue
+import pytest
+from scan_watcher import ScanWatcher, atomic_write, TEMP_PREFIX
+
+TIMEOUT = 2.0  # Seconds to wait for a capture that should be queued
+QUIET = 0.3  # Seconds to wait for one that should not
+
+
+def _write(path, data=b'BM' + bytes(64)):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+@pytest.fixture(params=[True, False], ids=['inotify', 'polling'])
+def watcher(request, tmp_path):
+    w = ScanWatcher(str(tmp_path), prefix='fingerprint_', use_inotify=request.param).start()
+    yield w
+    w.stop()
+
+
+def test_atomic_writes_are_queued_once_in_order(watcher, tmp_path):
+    names = [f"fingerprint_{i}.bmp" for i in range(3)]
+    for name in names:
+        atomic_write(str(tmp_path / name), _write)
+    queued = [os.path.basename(watcher.get(timeout=TIMEOUT)[0]) for _ in names]
+    assert queued == names
+    with pytest.raises(queue.Empty):
+        watcher.get(timeout=QUIET)
+
+
+def test_partial_write_is_not_queued_until_renamed(watcher, tmp_path):
+    final = tmp_path / 'fingerprint_partial.bmp'
+    temp = tmp_path / (TEMP_PREFIX + final.name)
+    with open(temp, 'wb') as f:
+        f.write(b'BM')
+        f.flush()
+        # Half-written, and even complete but not yet renamed: nothing is queued
+        with pytest.raises(queue.Empty):
+            watcher.get(timeout=QUIET)
+        f.write(bytes(64))
+    with pytest.raises(queue.Empty):
+        watcher.get(timeout=QUIET)
+    os.replace(temp, final)
+    path, _ = watcher.get(timeout=TIMEOUT)
+    assert path == str(final)
+    with pytest.raises(queue.Empty):
+        watcher.get(timeout=QUIET)
+
+
+def test_failed_atomic_write_leaves_nothing(watcher, tmp_path):
+    def fail(temp_path):
+        _write(temp_path, b'BM')
+        raise OSError("device unplugged")
+
+    with pytest.raises(OSError):
+        atomic_write(str(tmp_path / 'fingerprint_failed.bmp'), fail)
+    assert os.listdir(tmp_path) == []
+    with pytest.raises(queue.Empty):
+        watcher.get(timeout=QUIET)
+
+
+def test_existing_and_unwanted_files_are_ignored(tmp_path):
+    _write(tmp_path / 'fingerprint_old.bmp')
+    w = ScanWatcher(str(tmp_path), prefix='fingerprint_').start()
+    try:
+        _write(tmp_path / 'input_scan.bmp')
+        _write(tmp_path / 'fingerprint_notes.txt')
+        atomic_write(str(tmp_path / 'fingerprint_new.bmp'), _write)
+        path, _ = w.get(timeout=TIMEOUT)
+        assert os.path.basename(path) == 'fingerprint_new.bmp'
+        with pytest.raises(queue.Empty):
+            w.get(timeout=QUIET)
+    finally:
+        w.stop()
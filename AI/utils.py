@@ -1,7 +1,117 @@
 # Utility functions for file handling, logging, etc.
 import os
+import queue
+import tempfile
+import threading
+from collections import namedtuple
+import numpy as np
+
+IMAGE_EXTS = ('.bmp',)
+
+# One image under <root>/<person>/; stat is the os.stat_result from the scan
+ImageRecord = namedtuple('ImageRecord', ['person', 'path', 'stat'])
+
+_DONE = object()
+
+
+def save_npz_atomic(path, **arrays):
+    """
+    np.savez to path through a temp file of this process in the same folder,
+    renamed into place, so concurrent writers and readers never see a
+    half-written file.
+    """
+    fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def _has_ext(name, exts):
+    return name.lower().endswith(exts)
+
 
 def list_images(folder, ext='.bmp'):
     """List all image files in a folder with a given extension."""
-    return [os.path.join(folder, f) for f in os.listdir(folder) if f.lower().endswith(ext)]
-  
\ No newline at end of file
+    return [os.path.join(folder, f) for f in os.listdir(folder) if _has_ext(f, (ext.lower(),))]
+
+
+def _scan(path, keep, sort):
+    """Yield the DirEntries of path accepted by keep; sorted by name if sort."""
+    with os.scandir(path) as it:
+        if not sort:
+            for entry in it:
+                if keep(entry):
+                    yield entry
+            return
+        entries = [entry for entry in it if keep(entry)]
+    yield from sorted(entries, key=lambda e: e.name)
+
+
+def iter_images(root, exts=IMAGE_EXTS, shard=0, num_shards=1, sort=True):
+    """
+    Lazily yield an ImageRecord for every root/<person>/<file> whose
+    extension is in exts (case-insensitive), using os.scandir so processing
+    starts before the tree has been listed. With sort=True each directory is
+    sorted as it is reached, giving a stable order; worker `shard` of
+    `num_shards` takes every num_shards-th record of that order.
+    """
+    exts = tuple(e.lower() for e in exts)
+    index = 0
+    for person in _scan(root, lambda e: e.is_dir() and not e.name.startswith('.'), sort):
+        for entry in _scan(person.path, lambda e: _has_ext(e.name, exts) and e.is_file(), sort):
+            if index % num_shards == shard:
+                yield ImageRecord(person.name, entry.path, entry.stat())
+            index += 1
+
+
+def prefetch(items, load, depth=8):
+    """
+    Yield (item, load(item)) for every item, with a background thread
+    running load up to `depth` items ahead so I/O and decoding overlap with
+    the caller's processing. load should return None for an item it cannot
+    read; an exception it raises is re-raised when its item is reached.
+    """
+    q = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(value):
+        # Give up if the consumer went away, instead of blocking forever
+        while not stop.is_set():
+            try:
+                q.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run():
+        try:
+            for item in items:
+                try:
+                    result = (item, load(item), None)
+                except Exception as e:
+                    result = (item, None, e)
+                if not put(result):
+                    return
+        except Exception as e:
+            put((None, None, e))
+        put(_DONE)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        while True:
+            result = q.get()
+            if result is _DONE:
+                return
+            item, value, error = result
+            if error is not None:
+                raise error
+            yield item, value
+    finally:
+        stop.set()